@@ -2,7 +2,6 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -11,9 +10,21 @@ from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from elasticsearch import Elasticsearch
 from config import Config
+from app.search import BulkIndexer, ElasticsearchBackend
+from app.cache import LocalCache, RedisCache
+from app.passwords import PasswordHasher
+from app.translate import Translator
+from app.fragments import FragmentCache, post_fragment
+from app.assets import StaticFiles
+from app.localsearch import LocalSearch
+from app.replicas import RoutingSQLAlchemy, ReplicaRouter
+from app.database import tune_engine
+from app.instrumentation import Instrumentation
+from app.metrics import Metrics
 
 #the database will be represented in the application by the database instance. The migration engine will also have an instance
-db = SQLAlchemy()
+#its session sends reads to the replicas when there are any, see app/replicas.py
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 login = LoginManager()
 #the function the user will be redirected to if they try to access a @loginrequired route
@@ -28,8 +39,20 @@ babel = Babel()
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['SQLALCHEMY_REPLICA_URLS']:
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {},
+                                              **ReplicaRouter.binds(app.config['SQLALCHEMY_REPLICA_URLS']))
     #must initialaize extensions this way because
     db.init_app(app)
+    #the engines are made here, before anything connects, so the pragmas run on every connection
+    binds = list(app.config.get('SQLALCHEMY_BINDS') or {})
+    engines = [db.get_engine(app, bind) for bind in [None] + binds]
+    if app.config['DATABASE_TUNING']:
+        for engine in engines:
+            tune_engine(app, engine)
+    #before the blueprints, so their before_request runs first and their after_request last
+    app.metrics = Metrics(app, dict(zip(['default'] + binds, engines))) if app.config['METRICS'] else None
+    app.instrumentation = Instrumentation(app, engines) if app.config['INSTRUMENTATION'] else None
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -41,6 +64,42 @@ def create_app(config_class=Config):
     #create an instance of class Elasticsearch to do the searching
     #make the elasticsearch attribute None if I didn't configure the env variable
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    #app/search.py talks to the backend, not the client, so search still works without an elasticsearch server
+    if app.elasticsearch:
+        app.search_backend = ElasticsearchBackend(app.elasticsearch)
+    elif app.config['LOCAL_SEARCH']:
+        app.search_backend = LocalSearch(app.config['LOCAL_SEARCH_PATH'])
+    else:
+        app.search_backend = None
+    #commits queue their index changes for a background thread instead of sending them before the response goes out
+    app.search_indexer = BulkIndexer(app) if app.elasticsearch and app.config['ELASTICSEARCH_ASYNC'] else None
+    #redis is optional, only import it when it's configured
+    if app.config['REDIS_URL']:
+        from redis import Redis
+        app.redis = Redis.from_url(app.config['REDIS_URL'])
+    else:
+        app.redis = None
+    app.replicas = ReplicaRouter(app, db) if app.config['SQLALCHEMY_REPLICA_URLS'] else None
+    app.password_hasher = PasswordHasher(app)
+    #API token -> user id, see User.check_token()
+    if not app.config['TOKEN_CACHE_TTL']:
+        app.token_cache = None
+    elif app.redis:
+        app.token_cache = RedisCache(app.redis, 'token:')
+    else:
+        app.token_cache = LocalCache(app.config['TOKEN_CACHE_SIZE'])
+    app.translator = Translator(app)
+    if not app.config['FRAGMENT_CACHE_TTL']:
+        app.fragment_cache = None
+    else:
+        app.fragment_cache = FragmentCache(
+            RedisCache(app.redis, 'fragment:') if app.redis else LocalCache(app.config['FRAGMENT_CACHE_SIZE']),
+            app.config['FRAGMENT_CACHE_TTL'])
+    app.add_template_global(post_fragment)
+    #content hashed static urls with far future cache headers
+    app.static_files = StaticFiles(app)
+    app.url_defaults(app.static_files.url_defaults)
+    app.view_functions['static'] = app.static_files.send
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -54,6 +113,16 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    #imported here for the same reason as the blueprints, these import from the app package
+    from app.lastseen import LastSeenTracker
+    app.last_seen = LastSeenTracker(app)
+    from app.email import MailQueue
+    app.mail_queue = MailQueue(app)
+    from app.language import LanguageDetector
+    app.language_detector = LanguageDetector(app)
+    from app.timeline import TimelinePusher
+    app.timeline_pusher = TimelinePusher(app) if app.config['TIMELINE_PUSH_ASYNC'] else None
+
     #add not app.testing so that all this logging is skipped during unit tests.
     #TESTING varable will be set to true when testing
     if not app.debug and not app.testing:
@@ -1,6 +1,7 @@
 from flask import g
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from flask_login import current_user
+from app import db
 from app.models import User
 from app.api.errors import error_response
 
@@ -16,7 +17,11 @@ def verify_password(username, password):
     #save this as a global variable to access in API view functions
     g.current_user = user
     #returns true or false
-    return user.check_password(password)
+    if not user.check_password(password):
+        return False
+    #saves the new hash if check_password() had to redo it
+    db.session.commit()
+    return True
 
 #if credentials aren't valid during the verify_password function, return an unauthorized error
 @basic_auth.error_handler
@@ -0,0 +1,100 @@
+from datetime import datetime
+from itertools import groupby, islice
+from flask import Response, request, stream_with_context
+from app import db
+from app.models import User, Post, followers
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.api.responses import dumps
+
+#rows fetched from the database cursor at a time, and serialized together
+EXPORT_CHUNK_SIZE = 1000
+
+
+#the export endpoints write one JSON object per line (NDJSON) as the rows come off a streaming cursor, in id order,
+#so they run in constant memory however big the table is. A client that gets cut off carries on with
+#after_id=<the last id it got>, and an incremental pull passes since=<when it last started one>
+def export_args():
+    after_id = request.args.get('after_id', 0, type=int)
+    since = request.args.get('since')
+    if since:
+        try:
+            since = parse_timestamp(since)
+        except ValueError:
+            return after_id, None, bad_request('since must be an ISO 8601 timestamp')
+    return after_id, since or None, None
+
+
+def parse_timestamp(value):
+    #the format the API writes timestamps in, 2026-10-18T09:30:00.123456Z, with or without the fraction and the Z
+    value = value.rstrip('Z')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def ndjson(lines):
+    #lines are produced a chunk at a time, each chunk becomes one write
+    def generate():
+        for chunk in lines:
+            yield b''.join(dumps(line) + b'\n' for line in chunk)
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def chunks(rows):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+#users whose row changed since the timestamp, which includes their counts changing
+@bp.route('/export/users', methods=['GET'])
+@token_auth.login_required
+def export_users():
+    after_id, since, error = export_args()
+    if error:
+        return error
+    query = User.query.filter(User.id > after_id)
+    if since:
+        query = query.filter(User.updated_at >= since)
+    rows = query.with_entities(*[getattr(User, column) for column in User.API_COLUMNS]).order_by(
+        User.id).yield_per(EXPORT_CHUNK_SIZE)
+    return ndjson(User.to_dicts(chunk) for chunk in chunks(rows))
+
+
+#posts written or changed since the timestamp, a post comes again once its language has been detected
+@bp.route('/export/posts', methods=['GET'])
+@token_auth.login_required
+def export_posts():
+    after_id, since, error = export_args()
+    if error:
+        return error
+    query = db.session.query(Post.id, Post.body, Post.timestamp, Post.user_id, Post.language,
+                             Post.updated_at).filter(Post.id > after_id)
+    if since:
+        query = query.filter(Post.updated_at >= since)
+    rows = query.order_by(Post.id).yield_per(EXPORT_CHUNK_SIZE)
+    return ndjson([{'id': id, 'body': body, 'timestamp': timestamp.isoformat() + 'Z', 'user_id': user_id,
+                    'language': language, 'updated_at': updated_at.isoformat() + 'Z'}
+                   for id, body, timestamp, user_id, language, updated_at in chunk]
+                  for chunk in chunks(rows))
+
+
+#the followers graph, a line per user with the ids of everyone they follow. Following or unfollowing changes the
+#user's row, so since gives the users whose list changed, with the whole list
+@bp.route('/export/followers', methods=['GET'])
+@token_auth.login_required
+def export_followers():
+    after_id, since, error = export_args()
+    if error:
+        return error
+    query = db.session.query(User.id, followers.c.followed_id).outerjoin(
+        followers, followers.c.follower_id == User.id).filter(User.id > after_id)
+    if since:
+        query = query.filter(User.updated_at >= since)
+    rows = query.order_by(User.id, followers.c.followed_id).yield_per(EXPORT_CHUNK_SIZE)
+    users = ({'id': id, 'followed': [followed_id for _, followed_id in group if followed_id is not None]}
+             for id, group in groupby(rows, key=lambda row: row[0]))
+    return ndjson(chunks(users))
@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import json
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+from app.api import bp
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#fast settings, the responses are compressed on every request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def etag(*parts):
+    #parts are whatever the representation is made from, not the representation itself
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def dumps(data):
+    #bytes, with orjson when it is installed. The representations are only plain types, so neither needs Flask's
+    #encoder, and the keys aren't sorted
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(data):
+    #jsonify() for the big responses
+    return current_app.response_class(dumps(data), mimetype='application/json')
+
+
+def conditional(tag, last_modified, render):
+    #a client whose If-None-Match or If-Modified-Since still holds gets an empty 304 before render() is called, so
+    #nothing is serialized for it. The tags are weak, a gzipped body is the same representation as the plain one
+    if is_resource_modified(request.environ, etag=tag, last_modified=last_modified):
+        response = render()
+    else:
+        response = current_app.response_class(status=304)
+    response.set_etag(tag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    #the representation depends on the token it was asked for with, and has to be checked every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.after_request
+def compress(response):
+    minimum = current_app.config['API_COMPRESS_MIN_SIZE']
+    if not minimum or response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < minimum:
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -4,45 +4,53 @@ from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.api.responses import etag, conditional, json_response
 
 #return a user
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    #if the user exists, return its's representation
-    return jsonify(User.query.get_or_404(int(id)).to_dict())
+    #if the user exists, return its's representation. It only changes when the row does, the viewer's follow state
+    #included, following someone changes their follower count
+    user = User.query.get_or_404(int(id))
+    viewer = g.current_user
+    return conditional(etag('user', user.id, user.updated_at, viewer.id), user.updated_at,
+                       lambda: json_response(user.to_dict(viewer=viewer)))
+
+def user_collection(query, endpoint, owner=None, **kwargs):
+    #page 1 will be default
+    page = request.args.get('page', 1, type=int)
+    #take whichever one is smaller, don't let user pick something over 100
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    viewer = g.current_user
+    resources = User.paginate_api(query, page, per_page, viewer=viewer)
+    #a page can change without any of its rows changing, when a row before it goes away, so collections get an
+    #ETag made from the rows on the page and the total but no Last-Modified
+    tag = etag(endpoint, kwargs, page, per_page, viewer.id, resources.total,
+               owner.updated_at if owner is not None else None,
+               [(user.id, user.updated_at) for user in resources.items])
+    return conditional(tag, None, lambda: json_response(User.to_collection_dict(
+        query, page, per_page, endpoint, viewer=viewer, resources=resources, **kwargs)))
 
 #return a collection of users
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    return user_collection(User.query, 'api.get_users')
 
 #return followers of a user
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    #page 1 will be default
-    page = request.args.get('page', 1, type=int)
-    #take whichever one is smaller, don't let user pick something over 100
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
-    return jsonify(data)
+    return user_collection(user.followers, 'api.get_followers', owner=user, id=id)
 
 #return users the user is following
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,'api.get_followed', id=id)
-    return jsonify(data)
+    return user_collection(user.followed, 'api.get_followed', owner=user, id=id)
 
 #register a new account. no login required because a new user won't have an account
 @bp.route('/users', methods=['POST'])
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import re
+from flask import send_from_directory
+
+#avatar images are named <name><size>.<ext>, like python70.jpg
+AVATAR_RE = re.compile(r'^([A-Za-z]+)(\d+)\.(\w+)$')
+#a year, the longest most caches will keep anything
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class StaticFiles(object):
+    #url_for('static', ...) gives out names with a hash of the file's content in them, style.3f2a9c1d2e4b.css for
+    #style.css, so the files can be cached forever: new content means a new name. The hashes are worked out once at
+    #start up, except in debug mode where the files are being edited and the plain names are used
+    def __init__(self, app):
+        self.folder = app.static_folder
+        self.hashed = {}
+        self.originals = {}
+        self.avatars = {}
+        for filename in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, filename)
+            if not os.path.isfile(path):
+                continue
+            match = AVATAR_RE.match(filename)
+            if match:
+                self.avatars.setdefault((match.group(1), match.group(3)), []).append(int(match.group(2)))
+            if app.debug:
+                continue
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            root, ext = os.path.splitext(filename)
+            self.hashed[filename] = '{}.{}{}'.format(root, digest, ext)
+            self.originals[self.hashed[filename]] = filename
+        for sizes in self.avatars.values():
+            sizes.sort()
+
+    def url_defaults(self, endpoint, values):
+        #registered with app.url_defaults, swaps in the hashed name whenever a static url is built
+        if endpoint == 'static' and values.get('filename') in self.hashed:
+            values['filename'] = self.hashed[values['filename']]
+
+    def send(self, filename):
+        #replaces the app's static view. Plain names still work, with the default caching
+        if filename in self.originals:
+            response = send_from_directory(self.folder, self.originals[filename], cache_timeout=IMMUTABLE_MAX_AGE)
+            response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(IMMUTABLE_MAX_AGE)
+            return response
+        return send_from_directory(self.folder, filename)
+
+    def avatar(self, name, ext, size):
+        #the smallest variant at least as big as asked for, so it's only ever scaled down, or the biggest there is
+        sizes = self.avatars.get((name, ext)) or [size]
+        best = next((s for s in sizes if s >= size), sizes[-1])
+        return '{}{}.{}'.format(name, best, ext)
@@ -22,6 +22,8 @@ def login():
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        #saves the new hash if check_password() had to redo it
+        db.session.commit()
         next_page = request.args.get('next')
         #Checks to make sure a full URL isn't injected into the next arg to redirect to maliciuous site
         if not next_page or url_parse(next_page).netloc != '':
@@ -0,0 +1,100 @@
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+#small key/value caches with a time to live on every entry. Values have to survive a trip through json so the
+#in-process cache and the shared one can be swapped for each other
+class LocalCache(object):
+    #in-process and bounded, the least recently used entry goes first once there are max_size of them
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class FileCache(LocalCache):
+    #a LocalCache that also appends every change to a file and reads it back on start, so it survives a restart.
+    #Once the file holds twice as many lines as the cache can, it is rewritten with just the live entries
+    def __init__(self, path, max_size=10000):
+        super().__init__(max_size)
+        self.path = path
+        self.lines = 0
+        if os.path.exists(path):
+            now = time()
+            with open(path) as f:
+                for line in f:
+                    key, value, expires = json.loads(line)
+                    self.lines += 1
+                    #later lines win, a delete is written as an entry that has already expired
+                    if expires > now:
+                        super().set(key, value, expires - now)
+                    else:
+                        self.entries.pop(key, None)
+
+    def set(self, key, value, ttl):
+        super().set(key, value, ttl)
+        self.append([key, value, time() + ttl])
+
+    def delete(self, key):
+        super().delete(key)
+        self.append([key, None, 0])
+
+    def append(self, entry):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.lines += 1
+            if self.lines > 2 * self.max_size:
+                #write to a temporary file first so a crash never leaves a half written one
+                tmp = self.path + '.tmp'
+                with open(tmp, 'w') as f:
+                    f.writelines(json.dumps([key, value, expires]) + '\n'
+                                 for key, (value, expires) in self.entries.items())
+                os.replace(tmp, self.path)
+                self.lines = len(self.entries)
+
+
+class RedisCache(object):
+    #shared between every process that talks to the same redis server, so a delete in one is seen by all of them.
+    #Redis expires the entries itself
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        #redis only takes whole seconds, round down so an entry never outlives what it was given
+        if int(ttl) > 0:
+            self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
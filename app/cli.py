@@ -1,9 +1,44 @@
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import time
 import click
+from sqlalchemy import bindparam
+from app import db
+from app.models import User, Post, SearchableMixin
+from app.language import detect_languages
+from app.passwords import calibrate as calibrate_iterations
+from app.seed import seed as seed_database
 
 
 #these commands are registered at start up, not during the handling of a request, which is the only time when current_app can be used
 def register(app):
+    @app.cli.command()
+    @click.option('--users', default=1000, help='Users to add.')
+    @click.option('--posts', default=10000, help='Posts to add.')
+    @click.option('--following', default=20, help='How many users each one follows on average.')
+    @click.option('--exponent', default=1.0, help='Power law exponent of followers and posts per user.')
+    @click.option('--days', default=365, help='How far back the posts go.')
+    @click.option('--password', default='password', help='Password of every new user.')
+    @click.option('--chunk-size', default=10000, help='Rows per INSERT.')
+    @click.option('--seed', 'rng_seed', default=None, type=int, help='Random seed, for the same data every time.')
+    def seed(users, posts, following, exponent, days, password, chunk_size, rng_seed):
+        """Fill the database with generated users, followers and posts."""
+        start = time()
+        done = {}
+
+        def progress(table, count):
+            done[table] = done.get(table, 0) + count
+            click.echo('\r' + ', '.join('{} {}'.format(count, table) for table, count in done.items()), nl=False)
+
+        seed_database(users, posts, following=following, exponent=exponent, days=days, password=password,
+                      chunk_size=chunk_size, rng_seed=rng_seed, progress=progress)
+        click.echo('\nfinished in {:.1f}s'.format(time() - start))
+        if app.search_backend:
+            click.echo('run "flask search reindex" to make the new posts searchable')
+        if app.config['TIMELINE_FANOUT']:
+            click.echo('run "flask timeline rebuild" to fill the new users\' timelines')
+
     @app.cli.group()
     def translate():
         """Translation and localization commands."""
@@ -36,4 +71,169 @@ def register(app):
     def compile():
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
-            raise RuntimeError('compile command failed')
\ No newline at end of file
+            raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def timeline():
+        """Precomputed home timeline commands."""
+        pass
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild every user's timeline from the followers table."""
+        for user in User.query:
+            user.rebuild_timeline()
+        db.session.commit()
+
+    @timeline.command()
+    def check():
+        """Compare the timeline store with the followers query."""
+        broken = 0
+        for user in User.query:
+            missing, extra = user.check_timeline()
+            if missing or extra:
+                broken += 1
+                click.echo('{}: {} missing, {} extra'.format(user.username, len(missing), len(extra)))
+        click.echo('{} of {} timelines out of date'.format(broken, User.query.count()))
+
+    @timeline.command()
+    def push():
+        """Copy the posts of accounts back under the fan-out limit into their followers' timelines."""
+        for user in User.query.filter(User.pushing == True).all():
+            click.echo('{}: {} timeline rows added'.format(user.username, user.push_pulled_posts()))
+
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--model', default='post', help='Table of the searchable model to reindex.')
+    @click.option('--chunk-size', default=500, help='Rows per bulk request.')
+    @click.option('--workers', default=4, help='Bulk requests in flight at once.')
+    @click.option('--checkpoint', default=None, help='Resume file, defaults to .reindex-<model>.json.')
+    @click.option('--swap-alias', is_flag=True, help='Build a new index, then point the alias at it.')
+    def reindex(model, chunk_size, workers, checkpoint, swap_alias):
+        """Rebuild the search index from the database."""
+        models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+        if model not in models:
+            raise click.BadParameter('must be one of ' + ', '.join(models), param_hint='--model')
+        if not app.search_backend:
+            raise click.ClickException('search is not configured')
+        start = time()
+        done = [0]
+
+        def progress(count):
+            done[0] += count
+            click.echo('\r{} rows indexed, {:.0f} rows/s'.format(done[0], done[0] / (time() - start)), nl=False)
+
+        try:
+            models[model].reindex(chunk_size=chunk_size, workers=workers, swap_alias=swap_alias,
+                                  checkpoint=checkpoint or '.reindex-{}.json'.format(model), progress=progress)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('\nfinished in {:.1f}s'.format(time() - start))
+
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    def repair():
+        """Recalculate every user's post, follower and following counts."""
+        User.repair_counters()
+        db.session.commit()
+
+
+    @app.cli.group()
+    def passwords():
+        """Password hashing commands."""
+        pass
+
+    @passwords.command()
+    @click.option('--target-ms', default=250, help='How long one password check should take.')
+    def calibrate(target_ms):
+        """Pick PASSWORD_HASH_ITERATIONS for this machine."""
+        algorithm = app.config['PASSWORD_HASH_ALGORITHM']
+        iterations = calibrate_iterations(target_ms, algorithm)
+        click.echo('pbkdf2:{}:{} takes about {}ms here, currently {} iterations are used'.format(
+            algorithm, iterations, target_ms, app.config['PASSWORD_HASH_ITERATIONS']))
+        click.echo('PASSWORD_HASH_ITERATIONS={}'.format(iterations))
+
+
+    @app.cli.group()
+    def language():
+        """Post language detection commands."""
+        pass
+
+    @language.command()
+    @click.option('--chunk-size', default=1000, help='Posts per chunk.')
+    @click.option('--workers', default=4, help='Processes detecting languages at once.')
+    def backfill(chunk_size, workers):
+        """Detect the language of every post that doesn't have one yet."""
+        #guess_language is pure python, so the chunks go to separate processes rather than threads. The results are
+        #written back here in one executemany UPDATE per chunk
+        table = Post.__table__
+        update = table.update().where(table.c.id == bindparam('_id')).values(language=bindparam('_language'))
+        start = time()
+        done = 0
+
+        def chunks():
+            after_id = 0
+            while True:
+                rows = db.session.query(Post.id, Post.body).filter(Post.id > after_id, Post.language == None) \
+                    .order_by(Post.id).limit(chunk_size).all()
+                if not rows:
+                    return
+                yield rows
+                after_id = rows[-1][0]
+
+        def finish(pending):
+            rows, future = pending.popleft()
+            db.session.execute(update, [{'_id': id, '_language': language}
+                                        for (id, _), language in zip(rows, future.result())])
+            db.session.commit()
+            return len(rows)
+
+        pending = deque()
+        with ProcessPoolExecutor(workers) as pool:
+            for rows in chunks():
+                pending.append((rows, pool.submit(detect_languages, [body for _, body in rows])))
+                #don't read too far ahead of the workers
+                while len(pending) > workers * 2:
+                    done += finish(pending)
+                    click.echo('\r{} posts, {:.0f} posts/s'.format(done, done / (time() - start)), nl=False)
+            while pending:
+                done += finish(pending)
+        click.echo('\r{} posts, {:.0f} posts/s'.format(done, done / (time() - start) if done else 0))
+        if app.config['SEARCH_STORED_RESULTS']:
+            click.echo('search results show the stored language, run "flask search reindex" to update them')
+
+
+    @app.cli.group()
+    def assets():
+        """Static file commands."""
+        pass
+
+    @assets.command()
+    @click.option('--sizes', default='64,70,128,140,256', help='Comma separated avatar sizes to make.')
+    def avatars(sizes):
+        """Make the missing sizes of every avatar image (needs Pillow)."""
+        try:
+            from PIL import Image
+        except ImportError:
+            raise click.ClickException('resizing images needs Pillow, pip install Pillow')
+        folder = app.static_folder
+        for (name, ext), existing in sorted(app.static_files.avatars.items()):
+            #scale down from the biggest one there is
+            source = Image.open(os.path.join(folder, '{}{}.{}'.format(name, existing[-1], ext)))
+            for size in sorted(int(size) for size in sizes.split(',')):
+                if size in existing or size > existing[-1]:
+                    continue
+                filename = '{}{}.{}'.format(name, size, ext)
+                source.resize((size, size), Image.LANCZOS).save(os.path.join(folder, filename))
+                click.echo('made ' + filename)
+        click.echo('restart the app to pick up the new files')
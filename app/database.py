@@ -0,0 +1,56 @@
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+#engine settings from the DATABASE_* and SQLITE_* config, applied by RoutingSQLAlchemy and create_app when
+#DATABASE_TUNING is on. Without them a SQLite file gets a new connection per session in rollback journal mode,
+#where a writer locks out every reader, and a server database gets SQLAlchemy's small default pool
+def engine_options(config, sa_url, options):
+    if sa_url.drivername.startswith('sqlite'):
+        if sa_url.database in (None, '', ':memory:'):
+            #a single shared connection already
+            return
+        #sessions take turns on pooled connections instead of opening the file every time, so they can't be tied
+        #to the thread that opened them
+        options['poolclass'] = QueuePool
+        options['pool_size'] = config['SQLITE_POOL_SIZE']
+        options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+        options['pool_timeout'] = config['DATABASE_POOL_TIMEOUT']
+        options.setdefault('connect_args', {})['check_same_thread'] = False
+        return
+    options['pool_size'] = config['DATABASE_POOL_SIZE']
+    options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+    options['pool_timeout'] = config['DATABASE_POOL_TIMEOUT']
+    #servers and proxies close idle connections, recycle them before that and check them before use
+    options['pool_recycle'] = config['DATABASE_POOL_RECYCLE']
+    options['pool_pre_ping'] = True
+
+
+def sqlite_pragmas(config):
+    #WAL lets readers carry on while a write is going on, and synchronous=NORMAL only syncs at checkpoints, which
+    #can lose the last transactions on power loss but not corrupt the file
+    pragmas = []
+    if config['SQLITE_JOURNAL_MODE']:
+        pragmas.append('PRAGMA journal_mode={}'.format(config['SQLITE_JOURNAL_MODE']))
+    if config['SQLITE_SYNCHRONOUS']:
+        pragmas.append('PRAGMA synchronous={}'.format(config['SQLITE_SYNCHRONOUS']))
+    pragmas.append('PRAGMA busy_timeout={:d}'.format(config['SQLITE_BUSY_TIMEOUT']))
+    if config['SQLITE_CACHE_SIZE']:
+        pragmas.append('PRAGMA cache_size={:d}'.format(config['SQLITE_CACHE_SIZE']))
+    if config['SQLITE_MMAP_SIZE']:
+        pragmas.append('PRAGMA mmap_size={:d}'.format(config['SQLITE_MMAP_SIZE']))
+    return pragmas
+
+
+def tune_engine(app, engine):
+    #the pragmas are per connection, so they are run on every new one
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(app.config)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
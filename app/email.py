@@ -1,22 +1,164 @@
-from threading import Thread
+import atexit
+import heapq
+from collections import deque
+from itertools import count
+from queue import Queue, Full, Empty
+from threading import Thread, Lock, Condition
+from time import time
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
 
+class MailQueue(object):
+    #outgoing mail goes through a bounded queue to MAIL_WORKERS threads instead of a thread and an SMTP connection per
+    #message. A worker keeps its connection open while mail keeps coming and closes it after MAIL_IDLE_TIMEOUT
+    #seconds without any. A failed send is tried again after MAIL_RETRY_DELAY seconds, doubling each time, up to
+    #MAIL_RETRIES times. Whatever is still queued when the process exits is sent first
+    def __init__(self, app):
+        self.app = app
+        self.queue = Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.workers = app.config['MAIL_WORKERS']
+        self.retries = app.config['MAIL_RETRIES']
+        self.retry_delay = app.config['MAIL_RETRY_DELAY']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        #(due time, sequence number, time queued, attempts so far, message) for the messages waiting to be tried again
+        self.waiting = []
+        self.sequence = count()
+        self.lock = Lock()
+        #messages accepted and not yet sent or given up on, flush() waits for this to reach 0
+        self.pending = 0
+        self.done = Condition(self.lock)
+        self.flushing = False
+        self.started = False
+        self.threads = []
+        self.counts = {'sent': 0, 'retried': 0, 'failed': 0, 'dropped': 0, 'connections': 0}
+        #seconds from put() to the message being handed to the server, for the most recent messages
+        self.latencies = deque(maxlen=1000)
 
-#create a new background thread for the email being sent
-#have to manually create application context for custom threads
-def send_async_email(app, msg):
-    #mail.send() needs to access the configuration values for the email server, and that can only be done by knowing where application is
-    with app.app_context():
-        mail.send(msg)
+    def put(self, msg):
+        #returns False when the queue is full and the message was dropped
+        self.start()
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put_nowait((time(), 0, msg))
+        except Full:
+            with self.lock:
+                self.pending -= 1
+                self.counts['dropped'] += 1
+            self.app.logger.error('Mail queue full, dropped %r to %s', msg.subject, msg.recipients)
+            return False
+        return True
+
+    def start(self):
+        #the workers start with the first message, most processes never send any
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            self.threads = [Thread(target=self._run, daemon=True) for _ in range(self.workers)]
+            atexit.register(self.flush)
+        for thread in self.threads:
+            thread.start()
+
+    def flush(self, timeout=30):
+        #blocks until everything accepted so far is sent or given up on. Retries don't wait out their delay
+        with self.lock:
+            self.flushing = True
+            waiting = bool(self.waiting)
+        if waiting:
+            #wake up the workers that are waiting on the queue
+            for _ in self.threads:
+                try:
+                    self.queue.put_nowait(None)
+                except Full:
+                    break
+        with self.lock:
+            self.done.wait_for(lambda: self.pending == 0, timeout)
+            self.flushing = False
+            return self.pending == 0
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counts, depth=self.queue.qsize() + len(self.waiting))
+        for p in (50, 95, 99):
+            stats['latency_p{}'.format(p)] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)] \
+                if latencies else None
+        return stats
+
+    def next_message(self, timeout):
+        #a message whose retry is due comes first, otherwise wait on the queue, but no longer than until the next
+        #retry is due. Returns None when there's nothing to send yet
+        with self.lock:
+            now = time()
+            if self.waiting and (self.flushing or self.waiting[0][0] <= now):
+                return heapq.heappop(self.waiting)[2:]
+            if self.waiting:
+                due = self.waiting[0][0] - now
+                timeout = due if timeout is None else min(timeout, due)
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def _run(self):
+        #flask-mail needs an app context to find its configuration
+        with self.app.app_context():
+            connection = None
+            last_sent = 0
+            while True:
+                item = self.next_message(self.idle_timeout if connection else None)
+                if connection and time() - last_sent >= self.idle_timeout:
+                    self.close(connection)
+                    connection = None
+                if item is None:
+                    continue
+                queued, attempts, msg = item
+                try:
+                    if connection is None:
+                        connection = mail.connect()
+                        connection.__enter__()
+                        with self.lock:
+                            self.counts['connections'] += 1
+                    connection.send(msg)
+                except Exception:
+                    #the connection is in an unknown state, the next message gets a new one
+                    if connection is not None:
+                        self.close(connection)
+                        connection = None
+                    self.failed(queued, attempts, msg)
+                    continue
+                last_sent = time()
+                with self.lock:
+                    self.counts['sent'] += 1
+                    self.latencies.append(last_sent - queued)
+                    self.pending -= 1
+                    self.done.notify_all()
+
+    def close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def failed(self, queued, attempts, msg):
+        with self.lock:
+            if attempts < self.retries:
+                self.counts['retried'] += 1
+                due = time() + self.retry_delay * 2 ** attempts
+                heapq.heappush(self.waiting, (due, next(self.sequence), queued, attempts + 1, msg))
+                return
+            self.counts['failed'] += 1
+            self.pending -= 1
+            self.done.notify_all()
+        self.app.logger.exception('Sending %r to %s failed %d times', msg.subject, msg.recipients, attempts + 1)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    #This allows sending the email to run in the background, and once process is over the the thread will end
-    #extracts the actual application instance from inside the proxy object
-    Thread(target=send_async_email,args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+    #the request doesn't wait on the mail server, see MailQueue
+    return current_app.mail_queue.put(msg)
@@ -0,0 +1,62 @@
+import hashlib
+from time import time
+from uuid import uuid4
+from flask import current_app, g, has_app_context, render_template, Markup
+
+
+#what a version token covers. 'user' is everything about the user, for fragments like the popup that show their
+#counts and last seen time. 'posts' only changes with the username, post rows show nothing else of the author, so
+#followers and page views don't throw away every row they wrote
+VERSIONS = ('user', 'posts')
+
+
+class FragmentCache(object):
+    #rendered pieces of pages, in app.cache style caches. Every username has version tokens kept alongside the
+    #fragments, and each fragment that shows the user has one of them in its key. Forgetting a token orphans all of
+    #its fragments at once, and they age out of the cache on their own. A token that was evicted is replaced by a
+    #new one, which can't bring stale fragments back
+    def __init__(self, cache, ttl):
+        self.cache = cache
+        self.ttl = ttl
+
+    def version(self, username, kind='user'):
+        #looked up once per request, a page of posts by the same author only asks the cache once
+        versions = g.setdefault('fragment_versions', {})
+        key = 'version:{}:{}'.format(kind, username)
+        if key not in versions:
+            version = self.cache.get(key)
+            if version is None:
+                version = uuid4().hex
+                self.cache.set(key, version, self.ttl)
+            versions[key] = version
+        return versions[key]
+
+    def forget(self, username, renamed=False):
+        #any change to the user forgets their 'user' token, only a new username their 'posts' one too
+        for kind in VERSIONS if renamed else ('user',):
+            key = 'version:{}:{}'.format(kind, username)
+            self.cache.delete(key)
+            #in case the request that made the change renders a page afterwards
+            if has_app_context():
+                g.get('fragment_versions', {}).pop(key, None)
+
+    def get(self, key, render):
+        #{'html', 'etag', 'modified'} for the fragment under key, rendering it with render() if it isn't cached
+        entry = self.cache.get(key)
+        if entry is None:
+            html = render()
+            entry = {'html': html, 'etag': hashlib.sha1(html.encode('utf-8')).hexdigest(), 'modified': int(time())}
+            self.cache.set(key, entry, self.ttl)
+        return entry
+
+
+#used by the post lists in place of {% include '_post.html' %}
+def post_fragment(post):
+    fragments = current_app.fragment_cache
+    if fragments is None:
+        return Markup(render_template('_post.html', post=post))
+    #the row shows the author and, depending on the reader's locale and the post's language, a translate link.
+    #The language is in the key because it's filled in after the post is first shown
+    key = 'post:{}:{}:{}:{}'.format(post.id, post.language, g.locale,
+                                    fragments.version(post.author.username, 'posts'))
+    return Markup(fragments.get(key, lambda: render_template('_post.html', post=post))['html'])
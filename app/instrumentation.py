@@ -0,0 +1,125 @@
+import heapq
+from functools import wraps
+from time import perf_counter
+from flask import g, current_app, has_app_context, has_request_context, request, before_render_template, \
+    template_rendered
+from sqlalchemy import event
+
+#what goes in the Server-Timing header, in this order
+CATEGORIES = ['sql', 'search', 'translate', 'render']
+#statements kept for the slow request log
+SLOWEST_QUERIES = 3
+
+
+class RequestTimings(object):
+    #what one request spent its time on, kept in g.request_timings
+    def __init__(self):
+        self.start = perf_counter()
+        self.durations = dict.fromkeys(CATEGORIES, 0.0)
+        self.queries = 0
+        #(seconds, statement) min-heap of the slowest statements
+        self.slowest = []
+        self.rendering = 0
+        self.render_start = None
+
+    def query(self, duration, statement):
+        self.queries += 1
+        self.durations['sql'] += duration
+        if len(self.slowest) < SLOWEST_QUERIES:
+            heapq.heappush(self.slowest, (duration, statement))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, statement))
+
+
+def current_timings():
+    return g.get('request_timings') if has_request_context() else None
+
+
+def timed(category):
+    #decorator for calls out to search and the translator, adds the time to the request's category and to the
+    #<category>_duration_seconds histogram of app/metrics.py
+    metric = '{}_duration_seconds'.format(category)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            timings = current_timings()
+            metrics = current_app.metrics if has_app_context() else None
+            if timings is None and metrics is None:
+                return f(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                duration = perf_counter() - start
+                if timings is not None:
+                    timings.durations[category] += duration
+                if metrics is not None:
+                    metrics.observe(metric, duration)
+        return wrapper
+    return decorator
+
+
+class Instrumentation(object):
+    #times each request's SQL, search, translation and template rendering and sends the totals back in a
+    #Server-Timing header, which browser dev tools show next to the request. Requests slower than
+    #SLOW_REQUEST_THRESHOLD milliseconds are logged with their slowest statements. The hooks only add up
+    #perf_counter() differences, cheap enough to leave on
+    def __init__(self, app, engines):
+        self.app = app
+        self.server_timing = app.config['SERVER_TIMING']
+        self.threshold = app.config['SLOW_REQUEST_THRESHOLD'] / 1000.0
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.rendered, app)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.request_timings = RequestTimings()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context.query_start = perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        timings = current_timings()
+        if timings is not None:
+            timings.query(perf_counter() - context.query_start, statement)
+
+    #templates rendered inside another one, like the cached post rows, are part of the outer one's time
+    def before_render(self, sender, template, context, **extra):
+        timings = current_timings()
+        if timings is not None:
+            if not timings.rendering:
+                timings.render_start = perf_counter()
+            timings.rendering += 1
+
+    def rendered(self, sender, template, context, **extra):
+        timings = current_timings()
+        if timings is not None and timings.rendering:
+            timings.rendering -= 1
+            if not timings.rendering:
+                timings.durations['render'] += perf_counter() - timings.render_start
+
+    def after_request(self, response):
+        timings = g.pop('request_timings', None)
+        if timings is None:
+            return response
+        total = perf_counter() - timings.start
+        if self.server_timing:
+            metrics = ['sql;dur={:.1f};desc="{} queries"'.format(timings.durations['sql'] * 1000, timings.queries)]
+            metrics += ['{};dur={:.1f}'.format(category, timings.durations[category] * 1000)
+                        for category in CATEGORIES[1:] if timings.durations[category]]
+            metrics.append('total;dur={:.1f}'.format(total * 1000))
+            response.headers.add('Server-Timing', ', '.join(metrics))
+        if self.threshold and total >= self.threshold:
+            self.app.logger.warning(
+                'Slow request %s %s %d: %.0fms, %s, slowest queries: %s', request.method, request.full_path,
+                response.status_code, total * 1000,
+                ', '.join('{} {:.0f}ms'.format(category, timings.durations[category] * 1000)
+                          for category in CATEGORIES),
+                '; '.join('{:.0f}ms {}'.format(duration * 1000, ' '.join(statement.split()))
+                          for duration, statement in sorted(timings.slowest, reverse=True)))
+        return response
@@ -0,0 +1,78 @@
+import atexit
+from functools import lru_cache
+from queue import Queue, Empty
+from threading import Thread, Lock
+from guess_language import guess_language
+from app import db
+from app.models import Post
+
+
+#the same text always gets the same answer, and reposts and short replies like "thanks!" come up a lot
+@lru_cache(maxsize=4096)
+def detect_language(text):
+    language = guess_language(text)
+    #Save lang as "" if it isn't known or unexpected result returned
+    if language == 'UNKNOWN' or len(language) > 5:
+        return ''
+    return language
+
+
+def detect_languages(texts):
+    #module level so a process pool can run it, see the language backfill command
+    return [detect_language(text) for text in texts]
+
+
+def fill_languages(ids):
+    #posts whose language is still None haven't been looked at yet, '' means it couldn't be told. They were only
+    #just written, so they are read from the primary
+    db.session().use_primary()
+    for post in Post.query.filter(Post.id.in_(ids), Post.language == None):
+        post.language = detect_language(post.body)
+
+
+class LanguageDetector(object):
+    #fills in Post.language after the post is committed, so submitting a post doesn't wait on guess_language.
+    #Until then the language is None, which the templates treat like an unknown language. Like BulkIndexer,
+    #anything queued while a batch is being worked on goes into the next one
+    def __init__(self, app, max_batch=100):
+        self.app = app
+        self.max_batch = max_batch
+        self.background = app.config['LANGUAGE_DETECTION_ASYNC']
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def put(self, post_id):
+        if not self.background:
+            fill_languages([post_id])
+            db.session.commit()
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+                #don't leave queued posts without a language when the process exits normally
+                atexit.register(self.flush)
+        self.queue.put(post_id)
+
+    def flush(self):
+        #blocks until everything queued so far has a language
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            ids = [self.queue.get()]
+            while len(ids) < self.max_batch:
+                try:
+                    ids.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    fill_languages(ids)
+                    db.session.commit()
+            except Exception:
+                self.app.logger.exception('Language detection for %d posts failed', len(ids))
+            finally:
+                for _ in ids:
+                    self.queue.task_done()
@@ -0,0 +1,70 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from time import sleep
+from sqlalchemy import bindparam, or_
+from app import db
+from app.models import User
+
+
+class LastSeenTracker(object):
+    #keeps the last_seen times of active users in memory and writes them out in batches, instead of a commit on
+    #every request. A user is only written again once the stored time is LAST_SEEN_THRESHOLD seconds old, so the
+    #value shown on a profile lags by at most the threshold plus LAST_SEEN_FLUSH_INTERVAL. With an interval of 0
+    #the write happens in the request, still only past the threshold. The users' popups are forgotten after each
+    #write, the UPDATE doesn't go through the session hooks that do it for other changes
+    def __init__(self, app):
+        self.engine = db.get_engine(app)
+        self.logger = app.logger
+        self.threshold = timedelta(seconds=app.config['LAST_SEEN_THRESHOLD'])
+        self.interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        #user id -> newest time they were seen that hasn't been written yet
+        self.pending = {}
+        #user id -> username, the fragment cache's key, for the same users
+        self.usernames = {}
+        self.fragment_cache = app.fragment_cache
+        self.lock = Lock()
+        if self.interval:
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            if user.id in self.pending:
+                self.pending[user.id] = now
+                return
+            if user.last_seen and now - user.last_seen < self.threshold:
+                return
+            self.pending[user.id] = now
+            self.usernames[user.id] = user.username
+        if not self.interval:
+            self.flush()
+
+    def flush(self):
+        #one executemany UPDATE for everyone seen since the last flush. The where clause keeps a slow flush from
+        #another process from moving a time backwards
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            usernames, self.usernames = self.usernames, {}
+        if not pending:
+            return 0
+        table = User.__table__
+        stmt = table.update().where(table.c.id == bindparam('_id')).where(
+            or_(table.c.last_seen == None, table.c.last_seen < bindparam('_last_seen'))).values(
+            last_seen=bindparam('_last_seen'))
+        with self.engine.begin() as connection:
+            connection.execute(stmt, [{'_id': id, '_last_seen': seen} for id, seen in pending.items()])
+        if self.fragment_cache:
+            for username in usernames.values():
+                self.fragment_cache.forget(username)
+        return len(pending)
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('Writing last seen times failed')
@@ -0,0 +1,344 @@
+import json
+import math
+import os
+import re
+import zlib
+try:
+    import fcntl
+except ImportError:
+    #no locking between processes on windows
+    fcntl = None
+from bisect import bisect_left, insort
+from collections import defaultdict
+from contextlib import contextmanager
+from heapq import heappush, heapreplace
+from threading import RLock
+from app.search import SearchBackend, STORED_FIELD
+
+#\w is unicode aware, so spanish posts tokenize properly too
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(str(text).lower())
+
+
+def searchable_terms(payload):
+    return [term for field, value in payload.items() if field != STORED_FIELD for term in tokenize(value)]
+
+
+class InvertedIndex(object):
+    #one index per searchable table. postings maps each term to {doc id: BM25 term weight}, and impacts keeps the same
+    #entries sorted best first so a query can stop reading a long posting list once the top results are settled.
+    #Big batches append their entries and put each touched list back in order once at the end.
+    #The length normalisation uses the average doc length at the time a doc is added, which settles quickly as the
+    #index grows and is exact again after a reload
+    K1 = 1.2
+    B = 0.75
+    TRACK_TOTAL_HITS = 10000
+
+    def __init__(self):
+        self.postings = {}
+        self.impacts = {}
+        self.lengths = {}
+        self.docs = {}
+        self.total_length = 0
+        #term -> how many entries were appended to the end of its impact list since it was last sorted
+        self.unsorted = {}
+
+    def sorted_impacts(self, term):
+        appended = self.unsorted.pop(term, 0)
+        impacts = self.impacts[term]
+        if appended * 20 < len(impacts):
+            #a short tail on a long list, inserting each entry is cheaper than a pass over the whole list
+            tail = impacts[-appended:] if appended else []
+            del impacts[len(impacts) - appended:]
+            for entry in tail:
+                insort(impacts, entry)
+        elif appended:
+            impacts.sort()
+        return impacts
+
+    def sort(self):
+        for term in list(self.unsorted):
+            self.sorted_impacts(term)
+
+    def add(self, id, payload, defer_sort=False):
+        if id in self.docs:
+            self.remove(id)
+        terms = defaultdict(int)
+        for term in searchable_terms(payload):
+            terms[term] += 1
+        length = sum(terms.values())
+        self.docs[id] = payload
+        self.lengths[id] = length
+        self.total_length += length
+        avgdl = self.total_length / len(self.docs) or 1
+        norm = self.K1 * (1 - self.B + self.B * length / avgdl)
+        for term, tf in terms.items():
+            weight = tf * (self.K1 + 1) / (tf + norm)
+            self.postings.setdefault(term, {})[id] = weight
+            impacts = self.impacts.setdefault(term, [])
+            if defer_sort:
+                impacts.append((-weight, -id))
+                self.unsorted[term] = self.unsorted.get(term, 0) + 1
+            else:
+                insort(self.sorted_impacts(term), (-weight, -id))
+
+    def remove(self, id):
+        payload = self.docs.pop(id, None)
+        if payload is None:
+            return
+        self.total_length -= self.lengths.pop(id)
+        for term in set(searchable_terms(payload)):
+            weight = self.postings[term].pop(id)
+            impacts = self.sorted_impacts(term)
+            del impacts[bisect_left(impacts, (-weight, -id))]
+            if not impacts:
+                del self.postings[term]
+                del self.impacts[term]
+
+    def search(self, query, start, size, stored=False):
+        #BM25 over every field. Like the multi_match query sent to elasticsearch, a doc matches if it has any of the terms
+        n = len(self.docs)
+        terms = []
+        for term in set(tokenize(query)):
+            if term in self.postings:
+                df = len(self.postings[term])
+                terms.append((math.log(1 + (n - df + 0.5) / (df + 0.5)), self.postings[term], self.sorted_impacts(term)))
+        if not terms:
+            return [], 0
+        k = start + size
+        sizes = [len(postings) for _, postings, _ in terms]
+        #like elasticsearch's track_total_hits, counting stops being exact past a limit and the biggest posting list
+        #is reported instead, which is still a lower bound
+        if len(terms) == 1 or sum(sizes) > self.TRACK_TOTAL_HITS:
+            total = max(sizes)
+        else:
+            total = len(set(terms[0][1]).union(*(postings for _, postings, _ in terms[1:])))
+        top = self.top(terms, k, everywhere=len(terms) > 1)
+        if len(terms) > 1:
+            #a doc missing a term can score at most the best weights of the other terms. Only when that could still
+            #make the top k is it worth ranking the partial matches too
+            best = [idf * -impacts[0][0] for idf, _, impacts in terms]
+            if len(top) < k or top[0][0] < sum(best) - min(best):
+                top = self.top(terms, k)
+        #ties go to the newest doc, which is what a post timeline would show first
+        ids = [id for score, id in sorted(top, reverse=True)[start:]]
+        if stored:
+            return [(id, self.docs[id]) for id in ids], total
+        return ids, total
+
+    @staticmethod
+    def top(terms, k, everywhere=False):
+        #threshold algorithm: walk the impact lists side by side. No doc that hasn't been seen yet can score more than
+        #the sum of the weights under the cursors, so stop once the k best seen so far all beat that. The best matches
+        #nearly always contain every term, so with everywhere only those are ranked. Returns a heap of (score, id)
+        required = [postings for _, postings, _ in terms] if everywhere else []
+        #when every term has to be there, walking a list far longer than the shortest one mostly skips docs, so those
+        #lists just count with their best weight
+        walk, fixed = terms, 0
+        if everywhere:
+            shortest = min(len(postings) for _, postings, _ in terms)
+            walk = [term for term in terms if len(term[1]) <= 8 * shortest]
+            fixed = sum(-idf * impacts[0][0] for idf, postings, impacts in terms if len(postings) > 8 * shortest)
+        top = []
+        seen = set()
+        cursors = [0] * len(walk)
+        while True:
+            threshold = fixed
+            for i, (idf, postings, impacts) in enumerate(walk):
+                cursor = cursors[i]
+                while cursor < len(impacts):
+                    id = -impacts[cursor][1]
+                    if id not in seen and all(id in p for p in required):
+                        break
+                    cursor += 1
+                cursors[i] = cursor + 1
+                if cursor >= len(impacts):
+                    continue
+                threshold -= idf * impacts[cursor][0]
+                seen.add(id)
+                entry = (sum(i * p.get(id, 0) for i, p, _ in terms), id)
+                if len(top) < k:
+                    heappush(top, entry)
+                elif entry > top[0]:
+                    heapreplace(top, entry)
+            if threshold == fixed or (len(top) >= k and top[0][0] >= threshold):
+                return top
+
+
+class LocalSearch(SearchBackend):
+    #in-process search engine for when ELASTICSEARCH_URL isn't set. Kept up to date by the same SearchableMixin commit
+    #hooks. With a path, every change is appended to a journal file, and the journal is folded into a zlib compressed
+    #snapshot of the documents once it grows bigger than the snapshot. The postings are rebuilt from the documents on load.
+    #Several processes can share a path: appends and compaction hold a lock on the directory, and every process reads
+    #what the others appended to the journal, or the new snapshot after one of them compacted, before using its index
+    def __init__(self, path=None):
+        self.path = path
+        self.indexes = defaultdict(InvertedIndex)
+        self.lock = RLock()
+        self.journal_ops = 0
+        #how far into the journal this process has applied, and which snapshot that journal follows
+        self.offset = 0
+        self.snapshot_id = None
+        self.lock_depth = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.load()
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.path, 'snapshot.json.z')
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.path, 'journal.jsonl')
+
+    def bulk(self, actions):
+        ops = []
+        actions = iter(actions)
+        for action in actions:
+            op, meta = next(iter(action.items()))
+            if op == 'index':
+                ops.append(['index', meta['_index'], meta['_id'], next(actions)])
+            else:
+                ops.append(['delete', meta['_index'], meta['_id']])
+        self.apply(ops, log=True)
+
+    def search(self, index, query, start, size, fields=None, stored=False):
+        #every field apart from the stored ones is searched, fields is only there to match the interface
+        with self.lock:
+            self.sync()
+            if index not in self.indexes:
+                return [], 0
+            return self.indexes[index].search(query, start, size, stored)
+
+    def create_index(self, index):
+        #like Elasticsearch's, leaves an index that's already there alone, a resumed reindex keeps what it has done
+        self.apply([['create', index]], log=True)
+
+    def swap_alias(self, alias, target):
+        self.apply([['swap', alias, target]], log=True)
+
+    @contextmanager
+    def locked(self, shared=False):
+        #the file lock between processes, opened every time so forked workers don't share one open file and its lock
+        #Held again further down the same call, like save() inside apply(), it's already ours
+        with self.lock:
+            if not self.path or fcntl is None or self.lock_depth:
+                yield
+                return
+            with open(os.path.join(self.path, 'lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def apply(self, ops, log=False):
+        with self.lock:
+            if log and self.path:
+                with self.locked():
+                    #catch up first, so the journal and this process's index have the changes in the same order
+                    self.sync(locked=True)
+                    self._apply(ops)
+                    with open(self.journal_file, 'a') as f:
+                        f.writelines(json.dumps(op, separators=(',', ':')) + '\n' for op in ops)
+                        self.offset = f.tell()
+                    self.journal_ops += len(ops)
+                    if self.journal_ops > max(1000, sum(len(i.docs) for i in self.indexes.values())):
+                        self.save()
+            else:
+                self._apply(ops)
+
+    def _apply(self, ops):
+        defer_sort = len(ops) > 100
+        for op in ops:
+            if op[0] == 'index':
+                self.indexes[op[1]].add(op[2], op[3], defer_sort)
+            elif op[0] == 'delete':
+                if op[1] in self.indexes:
+                    self.indexes[op[1]].remove(op[2])
+            elif op[0] == 'create':
+                if op[1] not in self.indexes:
+                    self.indexes[op[1]] = InvertedIndex()
+            elif op[0] == 'swap':
+                #there are no real aliases here, the new index simply takes over the name
+                self.indexes[op[1]] = self.indexes.pop(op[2])
+        for index in self.indexes.values():
+            index.sort()
+
+    def current_snapshot(self):
+        #a compaction replaces the snapshot file, which gives it a new inode
+        try:
+            stat = os.stat(self.snapshot_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def sync(self, locked=False):
+        #apply what other processes have written since this one last looked. Only a stat() when nothing has changed
+        if not self.path:
+            return
+        with self.lock:
+            try:
+                size = os.path.getsize(self.journal_file)
+            except FileNotFoundError:
+                size = 0
+            if size == self.offset and self.current_snapshot() == self.snapshot_id:
+                return
+            if not locked:
+                with self.locked(shared=True):
+                    return self.sync(locked=True)
+            if self.current_snapshot() != self.snapshot_id or size < self.offset:
+                #another process compacted, start again from its snapshot
+                self.indexes.clear()
+                self.offset = 0
+                self.journal_ops = 0
+                self.read_snapshot()
+            ops = []
+            if os.path.exists(self.journal_file):
+                with open(self.journal_file) as f:
+                    f.seek(self.offset)
+                    ops = [json.loads(line) for line in f if line.strip()]
+                    self.offset = f.tell()
+            self._apply(ops)
+            self.journal_ops += len(ops)
+
+    def save(self):
+        #write the snapshot to a temporary file first so a crash never leaves a half written one. The journal is caught
+        #up first, the snapshot then has everything every process wrote and the journal can be emptied
+        with self.locked():
+            self.sync(locked=True)
+            data = {name: [[id, doc] for id, doc in index.docs.items()] for name, index in self.indexes.items()}
+            tmp = self.snapshot_file + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')))
+            os.replace(tmp, self.snapshot_file)
+            open(self.journal_file, 'w').close()
+            self.journal_ops = 0
+            self.offset = 0
+            self.snapshot_id = self.current_snapshot()
+
+    def read_snapshot(self):
+        self.snapshot_id = self.current_snapshot()
+        if self.snapshot_id is None:
+            return
+        with open(self.snapshot_file, 'rb') as f:
+            data = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        for name, docs in data.items():
+            index = self.indexes[name]
+            for id, doc in docs:
+                index.add(id, doc, defer_sort=True)
+            index.sort()
+
+    def load(self):
+        with self.locked(shared=True):
+            self.indexes.clear()
+            self.offset = 0
+            self.journal_ops = 0
+            self.snapshot_id = None
+            self.sync(locked=True)
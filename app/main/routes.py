@@ -1,13 +1,11 @@
-from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort, make_response
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 from app import db
 from app.main.forms import EditProfileForm, PostForm, SearchForm
-from app.models import User, Post
-from app.translate import translate
+from app.models import User, Post, paginate_posts
+from app.translate import translate, translate_many
 from app.main import bp
 
 
@@ -17,8 +15,8 @@ from app.main import bp
 #Flask-Babel returns the selected language and locale for a given request via the get_locale() function
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        #batched by the tracker, a commit here on every request would serialize the whole site on sqlite
+        current_app.last_seen.touch(current_user)
         #put form here bc it's used in almost every request
         g.search_form = SearchForm()
      #The get_locale() function from Flask-Babel returns a locale object, but I just want to have the language code, which can be obtained by converting the object to a string
@@ -33,21 +31,20 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        #assign language to the post based off it's content, to be used for translations later
-        language = guess_language(form.post.data)
-        #Save lang as "" if it isn't known or unexpected result returned
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        #push the post into the followers' timelines, does nothing unless TIMELINE_FANOUT is on
+        post.fan_out()
         db.session.commit()
+        #the language, used for translations later, is worked out from the content in the background
+        current_app.language_detector.put(post.id)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
     #Only display posts of followed users, and the current user
-    posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    posts = paginate_posts(current_user.followed_posts, current_app.config['POSTS_PER_PAGE'],
+                           before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.index', before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.index', after=posts.prev_cursor) if posts.has_prev else None
     return render_template('index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
                            prev_url=prev_url)
@@ -56,13 +53,12 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    #get the query string, or if its not there use 1 as default page
-    page = request.args.get('page', 1, type=int)
-    #Get all posts even ppl current user isnt following, order by date, paginate based of config variarable
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    #Get all posts even ppl current user isnt following, newest first, starting from the cursor in the query string
+    posts = paginate_posts(Post.query.filter, current_app.config['POSTS_PER_PAGE'],
+                           before=request.args.get('before'), after=request.args.get('after'))
     #Make the next/previous URL point to the next/previous page if it exists
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for('main.explore', before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', after=posts.prev_cursor) if posts.has_prev else None
     #reusing the index.html template, but not passing a form argument so the form never renders
     #post.items returns the paginate object as a list so we can use in in templates
     return render_template('index.html', title=_('Explore'), posts=posts.items, next_url=next_url, prev_url=prev_url,explore =True)
@@ -72,19 +68,33 @@ def explore():
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    posts = paginate_posts(user.posts.filter, current_app.config['POSTS_PER_PAGE'],
+                           before=request.args.get('before'), after=request.args.get('after'))
+    next_url = url_for('main.user', username=user.username, before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username, after=posts.prev_cursor) if posts.has_prev else None
     return render_template('user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url)
 
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user_popup.html', user=user)
+    def render():
+        user = User.query.filter_by(username=username).first_or_404()
+        return render_template('user_popup.html', user=user)
+
+    fragments = current_app.fragment_cache
+    if fragments is None:
+        return render()
+    #the follow link depends on who is looking, so every viewer gets their own copy
+    key = 'popup:{}:{}:{}:{}'.format(username, g.locale, current_user.id, fragments.version(username))
+    entry = fragments.get(key, render)
+    response = make_response(entry['html'])
+    #the browser asks again every time, but gets an empty 304 while the popup hasn't changed
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['modified']
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -145,6 +155,21 @@ def translate_text():
     #translate function defined in translate.py
     return jsonify({'text': translate(request.form['text'], request.form['source_language'], request.form['dest_language'])})
 
+#the "translate all" link sends the ids of the foreign language posts on the page, they are translated side by side
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('posts')
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        abort(400)
+    dest_language = data.get('dest_language') or g.locale
+    #one page worth, not the whole site in one request
+    posts = Post.query.filter(Post.id.in_(ids[:100])).all()
+    posts = [post for post in posts if post.language and post.language != dest_language]
+    translations = translate_many([(post.body, post.language) for post in posts], dest_language)
+    return jsonify({'translations': {post.id: text for post, text in zip(posts, translations)}})
+
 @bp.route('/search')
 @login_required
 def search():
@@ -153,7 +178,8 @@ def search():
         return redirect(url_for('main.explore'))
     #default should be 1st page
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    posts, total = Post.search_results(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'],
+                                       stored=current_app.config['SEARCH_STORED_RESULTS'])
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) if page > 1 else None
     return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
@@ -0,0 +1,324 @@
+import atexit
+import hmac
+import json
+import os
+import weakref
+try:
+    import fcntl
+except ImportError:
+    #no locking between processes on windows, the files of processes that have gone are left where they are
+    fcntl = None
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Thread, Lock, local
+from time import perf_counter, sleep
+from uuid import uuid4
+from flask import g, request
+from sqlalchemy import event
+
+#seconds, for requests and calls out to other services
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+#name: (type, help, histogram buckets)
+DEFINITIONS = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status code.', None),
+    'http_request_duration_seconds': ('histogram', 'Time to handle a request, by endpoint.', LATENCY_BUCKETS),
+    'db_pool_checkouts_total': ('counter', 'Connections handed out by the pool, by bind.', None),
+    'db_pool_checked_out': ('gauge', 'Connections in use right now, by bind.', None),
+    'search_duration_seconds': ('histogram', 'Time spent in calls to the search backend.', LATENCY_BUCKETS),
+    'translate_duration_seconds': ('histogram', 'Time spent in calls to the translator.', LATENCY_BUCKETS),
+    'mail_queue_depth': ('gauge', 'Messages waiting to be sent or retried.', None),
+}
+#in METRICS_DIR, the numbers of the processes that have gone, see Metrics.prune()
+ARCHIVE = 'archive.json'
+
+
+class Shard(object):
+    #one thread's numbers. Only that thread writes to it, so recording needs no lock
+    def __init__(self):
+        self.counters = {}
+        #(name, labels): [count per bucket, then the +Inf bucket, then the sum]
+        self.histograms = {}
+
+    def add(self, counters, histograms):
+        #adds this shard's numbers to the totals given. Copied in one go, the thread that owns it may be adding to it
+        for key, value in dict(self.counters).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, entry in dict(self.histograms).items():
+            entry = list(entry)
+            total = histograms.get(key)
+            histograms[key] = entry if total is None else [a + b for a, b in zip(total, entry)]
+
+
+class ShardOwner(object):
+    #only referenced from its thread's local storage, so it goes away with the thread and takes the shard off the
+    #live list, see Metrics.retire()
+    __slots__ = ('__weakref__',)
+
+
+class Metrics(object):
+    #a Prometheus registry served at /metrics. Counters and histograms are kept per thread and added up when scraped.
+    #With METRICS_DIR set, every process writes its numbers to its own file there every METRICS_FLUSH_INTERVAL
+    #seconds and at exit, and a scrape of any process adds up all of the files. Counters of processes that have gone
+    #are kept, their gauges aren't. The numbers are only served with METRICS_TOKEN set, to a scraper that sends it
+    def __init__(self, app, engines):
+        #engines is {bind name: engine}, the name is the pool's label
+        self.app = app
+        self.gauges = {}
+        self.directory = app.config['METRICS_DIR']
+        self.token = app.config['METRICS_TOKEN']
+        self.reset()
+        #servers that load the app before forking their workers, like gunicorn --preload, would otherwise have all of
+        #them writing the one file with the master's pid in its name
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+        for bind, engine in engines.items():
+            self.watch_pool(bind, engine)
+        self.gauge('mail_queue_depth', (), lambda: app.mail_queue.stats()['depth'])
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        if self.token:
+            app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def reset(self):
+        #at start up and in a forked child, which starts from nothing: the parent's numbers are the parent's
+        self.local = local()
+        #{id: shard} of the threads that are running, and the numbers of the ones that have finished
+        self.shards = {}
+        self.retired = Shard()
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, '{}-{}.json'.format(self.pid, uuid4().hex[:8])) \
+            if self.directory else None
+        self.started = False
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            #servers that start a thread per request would otherwise pile up a shard for every request
+            self.local.owner = ShardOwner()
+            weakref.finalize(self.local.owner, self.retire, shard)
+            with self.lock:
+                self.shards[id(shard)] = shard
+            return shard
+
+    def retire(self, shard):
+        #the shard's thread has finished, its numbers are kept in the retired total
+        with self.lock:
+            if self.shards.get(id(shard)) is shard:
+                del self.shards[id(shard)]
+                shard.add(self.retired.counters, self.retired.histograms)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        histograms = self.shard().histograms
+        key = (name, labels)
+        buckets = DEFINITIONS[name][2]
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [0] * (len(buckets) + 2)
+        entry[bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    def gauge(self, name, labels, read):
+        #read() is called when the metrics are collected
+        self.gauges[(name, labels)] = read
+
+    def watch_pool(self, bind, engine):
+        labels = (('bind', bind),)
+        event.listen(engine, 'checkout', lambda *args: self.inc('db_pool_checkouts_total', labels))
+        if hasattr(engine.pool, 'checkedout'):
+            self.gauge('db_pool_checked_out', labels, engine.pool.checkedout)
+
+    def before_request(self):
+        #the flushing thread starts with the first request, not in processes that never serve one
+        if self.directory and not self.started:
+            self.start()
+        g.metrics_start = perf_counter()
+
+    def after_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'none'
+            self.observe('http_request_duration_seconds', perf_counter() - start, (('endpoint', endpoint),))
+            self.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                             ('status', str(response.status_code))))
+        return response
+
+    def snapshot(self):
+        #this process's numbers, all threads added up
+        counters, histograms = {}, {}
+        with self.lock:
+            self.retired.add(counters, histograms)
+            shards = list(self.shards.values())
+        for shard in shards:
+            shard.add(counters, histograms)
+        gauges = {}
+        for key, read in self.gauges.items():
+            try:
+                gauges[key] = read()
+            except Exception:
+                self.app.logger.exception('Reading metric %s failed', key[0])
+        return {'pid': self.pid, 'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, entry] for (name, labels), entry in histograms.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in gauges.items()]}
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        os.makedirs(self.directory, exist_ok=True)
+        Thread(target=self._run, daemon=True).start()
+        atexit.register(self.write)
+
+    def _run(self):
+        while True:
+            sleep(self.app.config['METRICS_FLUSH_INTERVAL'])
+            try:
+                self.write()
+            except Exception:
+                self.app.logger.exception('Writing metrics to %s failed', self.path)
+
+    def write(self):
+        #written next to the real file and renamed over it, a scrape never reads half a file
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, self.path)
+
+    @contextmanager
+    def directory_lock(self):
+        with open(os.path.join(self.directory, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def prune(self):
+        #adds the files of processes that have gone to the archive and deletes them, or every restart and every
+        #recycled worker would leave one more file behind for each scrape to read. The archive lists the files it
+        #has taken in, one still there after a crash between writing the archive and deleting it isn't added twice
+        if fcntl is None:
+            return
+        with self.directory_lock():
+            archive = read_snapshot(os.path.join(self.directory, ARCHIVE)) or \
+                {'pid': None, 'counters': [], 'histograms': [], 'gauges': [], 'folded': []}
+            gone = []
+            for filename in os.listdir(self.directory):
+                pid = filename.split('-')[0]
+                if filename.endswith('.json') and pid.isdigit() and int(pid) != self.pid and not alive(int(pid)):
+                    gone.append(filename)
+            new = [filename for filename in gone if filename not in archive['folded']]
+            if new:
+                counters, histograms = {}, {}
+                for snapshot in [archive] + [read_snapshot(os.path.join(self.directory, f)) for f in new]:
+                    if snapshot:
+                        add_snapshot(snapshot, counters, histograms)
+                archive = {'pid': None, 'folded': gone, 'gauges': [],
+                           'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                           'histograms': [[name, labels, entry] for (name, labels), entry in histograms.items()]}
+                path = os.path.join(self.directory, ARCHIVE)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(archive, f)
+                os.replace(path + '.tmp', path)
+            for filename in gone:
+                os.remove(os.path.join(self.directory, filename))
+
+    def collect(self):
+        snapshots = [self.snapshot()]
+        if self.directory and os.path.isdir(self.directory):
+            self.prune()
+            for filename in os.listdir(self.directory):
+                path = os.path.join(self.directory, filename)
+                if not filename.endswith('.json') or path == self.path:
+                    continue
+                snapshot = read_snapshot(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in snapshots:
+            add_snapshot(snapshot, counters, histograms)
+            #the archive has no gauges, and a process that went after the prune doesn't count either
+            if snapshot['pid'] is None or snapshot['pid'] != self.pid and not alive(snapshot['pid']):
+                continue
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(label) for label in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        return counters, histograms, gauges
+
+    def render(self):
+        #the Prometheus text format
+        counters, histograms, gauges = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in DEFINITIONS.items():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'histogram':
+                for (metric, labels), entry in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ['+Inf'], entry[:-1]):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', str(bound)),)),
+                                                             cumulative))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), entry[-1]))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+            else:
+                values = counters if kind == 'counter' else gauges
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        #Prometheus sends the token with "authorization: credentials" in its scrape config
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+            return 'Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer', 'Content-Type': 'text/plain'}
+        return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def read_snapshot(path):
+    #None if the file is gone or half written by something other than write()
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_snapshot(snapshot, counters, histograms):
+    #adds a snapshot's counters and histograms to the totals given, keyed by (name, labels)
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, entry in snapshot['histograms']:
+        key = (name, tuple(tuple(label) for label in labels))
+        total = histograms.get(key)
+        histograms[key] = entry if total is None else [a + b for a, b in zip(total, entry)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for key, value in labels) + '}'
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
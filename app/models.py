@@ -1,17 +1,73 @@
 import base64
 from datetime import datetime, timedelta
 from time import time
-from flask import current_app, url_for
+from flask import current_app, url_for, g
 from flask_login import UserMixin
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
-from random import randint
+from app.search import query_index, index_actions, delete_actions, bulk_index, bulk_reindex, STORED_FIELD
+import zlib
+from sqlalchemy.orm import make_transient_to_detached
+from flask_sqlalchemy import Pagination
 from flask_login import current_user
 
 
+#the stock avatars in app/static, (name, extension)
+AVATARS = [('python', 'jpg'), ('flask', 'png')]
+
+#cursors look like "20190319194617903647_42", the post timestamp followed by its id
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+STORED_TIMESTAMP = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(post):
+    return '{}_{}'.format(post.timestamp.strftime(CURSOR_FORMAT), post.id)
+
+
+def decode_cursor(cursor):
+    #a cursor that can't be parsed is treated like no cursor, so a bad link just shows the first page
+    try:
+        timestamp, id = cursor.split('_')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class CursorPagination(object):
+    #same has_next/has_prev/items interface as flask_sqlalchemy's Pagination, but pages are addressed by cursors
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = encode_cursor(items[-1]) if has_next and items else None
+        self.prev_cursor = encode_cursor(items[0]) if has_prev and items else None
+
+
+def paginate_posts(query_for, per_page, before=None, after=None):
+    #keyset pagination keyed on (timestamp, id). Instead of COUNT + OFFSET, each page starts right where the
+    #cursor points, so page 1000 costs the same as page 1. query_for(*criterion) must return a Post query
+    #with the criterion applied, e.g. Post.query.filter or User.followed_posts
+    newer = after is not None
+    cursor = decode_cursor(after if newer else before)
+    criterion = [Post.cursor_filter(cursor, newer)] if cursor else []
+    if newer and cursor:
+        order = (Post.timestamp.asc(), Post.id.asc())
+    else:
+        order = (Post.timestamp.desc(), Post.id.desc())
+    #fetch one extra row to find out if there is another page without counting. _post.html shows the author of every
+    #post, so load them in the same query instead of one lazy load per row
+    items = query_for(*criterion).options(db.joinedload(Post.author)).order_by(None).order_by(*order).limit(
+        per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if newer and cursor:
+        #rows came back oldest first, flip them back to newest first for the templates
+        items.reverse()
+        return CursorPagination(items, has_next=True, has_prev=more)
+    return CursorPagination(items, has_next=more, has_prev=cursor is not None)
+
+
 class SearchableMixin(object):
     #wraps the query_index() function in app/search.py
     @classmethod
@@ -30,50 +86,97 @@ class SearchableMixin(object):
         return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
     @classmethod
-    #before_commit is an event from sql_alchemy
-    def before_commit(cls, session):
-        #after commit these objects won't be available, so save them in dict and use to update elasticsearch
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def eager_query(cls):
+        #cls.query with the __search_eager__ relationships joined in, for everything that builds index documents
+        return cls.query.options(*[db.joinedload(name) for name in getattr(cls, '__search_eager__', [])])
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
+    def search_results(cls, expression, page, per_page, stored=False):
+        #like search(), but returns a list. The rows come back in one plain IN query with __search_eager__ relationships
+        #joined in, and are put back in ranking order in python instead of with a CASE in the ORDER BY.
+        #With stored, the objects are built from the fields saved in the index and the database isn't touched at all.
+        #How long the search and the database took is left in g.search_timings
+        start = time()
+        hits, total = query_index(cls.__tablename__, expression, page, per_page,
+                                  fields=cls.__searchable__, stored=stored)
+        searched = time()
+        if stored:
+            results = [cls.from_stored(id, payload) for id, payload in hits]
+        elif hits:
+            rows = {obj.id: obj for obj in cls.eager_query().filter(cls.id.in_(hits))}
+            #an id can be in the index but gone from the database if the delete hasn't been indexed yet
+            results = [rows[id] for id in hits if id in rows]
+        else:
+            results = []
+        g.search_timings = {'search': (searched - start) * 1000, 'db': (time() - searched) * 1000}
+        current_app.logger.debug('search %s for %r: %.1fms search, %.1fms db', cls.__tablename__, expression,
+                                 g.search_timings['search'], g.search_timings['db'])
+        return results, total
+
+    @classmethod
+    #after_flush is an event from sql_alchemy
+    def after_flush(cls, session, flush_context):
+        #build the index actions at every flush, not only right before the commit. Autoflush, or flushing to get a new
+        #id, writes objects out early and they are no longer in session.new by the time the commit happens. The
+        #documents are built here because objects are expired by the commit and no SQL can run in after_commit.
+        #An object flushed more than once only keeps its last action
+        changes = getattr(session, '_changes', None) or {}
+        #updated rows are reindexed the same way as new ones, the new document replaces the old one
+        for obj in list(session.new) + list(session.dirty):
             #Add each record if it belongs to a class that inherits SearchableMixin
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+                changes[(obj.__tablename__, obj.id)] = index_actions(obj.__tablename__, obj)
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                changes[(obj.__tablename__, obj.id)] = delete_actions(obj.__tablename__, obj)
+        session._changes = changes
+
+    @classmethod
+    def after_commit(cls, session):
+        #send every change from the commit to the search backend as one bulk request
+        changes = getattr(session, '_changes', None)
+        session._changes = None
+        if changes:
+            bulk_index([action for actions in changes.values() for action in actions])
+
+    @classmethod
+    def after_rollback(cls, session):
+        #nothing that was flushed made it into the database
         session._changes = None
 
     @classmethod
-    def reindex(cls):
-        #adds all posts in db to search index
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, **kwargs):
+        #adds all rows in db to search index, see bulk_reindex() for the options
+        return bulk_reindex(cls.__tablename__, cls.chunks, **kwargs)
 
-#call beofre_commit and after_commit before and after each commit
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @classmethod
+    def chunks(cls, after_id=0, size=500):
+        #walk the table in primary key order, a fixed number of rows at a time, instead of loading one big result
+        while True:
+            chunk = cls.eager_query().filter(cls.id > after_id).order_by(cls.id).limit(size).all()
+            if not chunk:
+                return
+            yield chunk
+            after_id = chunk[-1].id
+
+#call after_flush after each flush and after_commit/after_rollback when the transaction ends
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
+    @classmethod
     #produces a dictionary with the user collection representation
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        #take the query and add pagnation to it, returns empty list if page doesn't exist
-        resources = query.paginate(page, per_page, False)
+    def to_collection_dict(cls, query, page, per_page, endpoint, viewer=None, resources=None, **kwargs):
+        #take the query and add pagnation to it, returns empty list if page doesn't exist. A page that was already
+        #loaded with paginate_api() can be passed in as resources
+        if resources is None:
+            resources = cls.paginate_api(query, page, per_page)
         data = {
-            #get the actual items from the query. Trying to make a generic function, so it will call to_dict()
-            #on each item to get it's representation for whatever type it is
-            'items': [item.to_dict() for item in resources.items],
+            #get the actual items from the query. Trying to make a generic function, so it will call to_dicts()
+            #on the items to get their representation for whatever type they are
+            'items': cls.to_dicts(resources.items, viewer=viewer),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -89,6 +192,25 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    #a model can override these two to load and serialize a page in bulk, see User
+    @staticmethod
+    def paginate_api(query, page, per_page):
+        return query.paginate(page, per_page, False)
+
+    @staticmethod
+    def to_dicts(items, viewer=None):
+        return [item.to_dict(viewer=viewer) for item in items]
+
+
+#a stand-in id for url_template(), nothing else in an url looks like it
+URL_ID_PLACEHOLDER = 2147483647
+
+
+def url_template(endpoint, **values):
+    #url_for() once, with the placeholder for the id, then str.format() per row. url_for() is the slow part of
+    #serializing a page, with 4 links a row
+    return url_for(endpoint, id=URL_ID_PLACEHOLDER, **values).replace(str(URL_ID_PLACEHOLDER), '{}')
+
 
 followers = db.Table(
     'followers',
@@ -96,6 +218,21 @@ followers = db.Table(
     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
 )
 
+#precomputed home timelines, one row per (reader, post). Only used when TIMELINE_FANOUT is turned on
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True)
+)
+
+
+def avatar_choice(id, username):
+    #picked from a hash of the id rather than at random, so a user's avatar has the same url on every page and
+    #browsers can cache it
+    if username == "Jordan":
+        return 'J', 'jpeg'
+    return AVATARS[zlib.crc32(str(id).encode('utf-8')) % len(AVATARS)]
+
 
 class User(UserMixin, PaginatedAPIMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -108,6 +245,19 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     #I'll need to search the db by the token, so make it indexed
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    #kept up to date by follow(), unfollow() and the Post insert/delete events below, so pages and the API don't
+    #have to count rows. "flask counters repair" recalculates them if they ever drift
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    #set again by every UPDATE of the row, the ORM's and the core ones above and in LastSeenTracker alike, so the API
+    #can tell a client that its copy of the user is still current
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    #set while this user's posts are pulled into their followers' timelines on read instead of pushed, to when that
+    #started. pushing means they are back under the limit and the posts since then are being copied into the
+    #timelines, they are still pulled until that is done. See start_pulling() and stop_pulling()
+    pulled_since = db.Column(db.DateTime, index=True)
+    pushing = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
     followed = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -119,36 +269,169 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
 
     #called whenever a user is created/user requests pass change to hash whatever password they give
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not current_app.password_hasher.verify(self.password_hash, password):
+            return False
+        #the password is only known right now, so this is the one chance to bring an old hash up to the current
+        #settings. The caller commits it
+        if current_app.password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def avatar(self, size,username = None):
-        if username == "Jordan":
-            return f"/static/J{size}.jpeg"
-        if randint(1, 2) == 1:
-                return f"/static/python{size}.jpg"
-        return f"/static/flask{size}.png"
+        #app.static_files picks the closest size that exists
+        name, ext = avatar_choice(self.id, username or self.username)
+        return url_for('static', filename=current_app.static_files.avatar(name, ext, size))
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.__dict__.setdefault('_follow_states', {})[user.id] = True
+            #SQL expressions instead of python arithmetic so two requests at once can't lose an update
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            if current_app.config.get('TIMELINE_FANOUT'):
+                self.backfill_timeline(user)
+                user.start_pulling()
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.__dict__.setdefault('_follow_states', {})[user.id] = False
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
+            if current_app.config.get('TIMELINE_FANOUT'):
+                self.prune_timeline(user)
+                user.stop_pulling()
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return self.follow_states([user])[user.id]
+
+    def follow_states(self, users):
+        #{user id: whether this user follows them} for a whole page of users in one query. Answers are cached on this
+        #object until it is expired, which every commit does, so in a request the templates can ask again for free
+        if self.id is None or any(user.id is None for user in users):
+            #new users only get their ids on flush, which the query below would do too late
+            db.session.flush()
+        states = self.__dict__.setdefault('_follow_states', {})
+        missing = {user.id for user in users} - set(states)
+        if missing:
+            followed = {id for id, in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(missing))}
+            for id in missing:
+                states[id] = id in followed
+        return {user.id: states[user.id] for user in users}
+
+    def followed_posts(self, *criterion):
+        #read the precomputed timeline when fan-out-on-write is turned on, otherwise work it out from the followers table
+        if current_app.config.get('TIMELINE_FANOUT'):
+            return self.timeline_posts(*criterion)
+        return self.computed_posts(*criterion)
+
+    #one filtered query instead of a UNION of the followed posts and the user's own posts. The database can walk the
+    #timestamp index newest first and stop after a page, rather than building and sorting the whole union
+    def computed_posts(self, *criterion):
+        followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)
+        return Post.query.filter(
+            db.or_(Post.user_id.in_(followed), Post.user_id == self.id), *criterion).order_by(
+                Post.timestamp.desc(), Post.id.desc())
+
+    #a post is in the timeline if it was pushed there, checked per row on the timeline's primary key. An IN over the
+    #pushed ids would make the database collect and sort every post the user was ever sent before returning a page
+    def timeline_posts(self, *criterion):
+        pushed = db.exists().where(db.and_(timeline.c.user_id == self.id, timeline.c.post_id == Post.id))
+        #posts from accounts with too many followers are never pushed, so pull them in at read time
+        celebrities = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(User.celebrity_ids()))
+        return Post.query.filter(
+            db.or_(pushed, Post.user_id.in_(celebrities)), *criterion).order_by(
+                Post.timestamp.desc(), Post.id.desc())
 
-    def followed_posts(self):
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+    @staticmethod
+    def celebrity_ids():
+        #accounts whose posts are fanned out on read
+        return db.session.query(User.id).filter(User.pulled_since != None)
+
+    def is_celebrity(self):
+        #whether new posts skip the followers' timelines, true from going over TIMELINE_FANOUT_MAX_FOLLOWERS until
+        #dropping TIMELINE_FANOUT_HYSTERESIS below it
+        return self.pulled_since is not None and not self.pushing
+
+    #the switches between pushing and pulling are conditional UPDATEs on the user's row, which checks the count and
+    #changes the state in one step, so of several follows or unfollows at once exactly one makes each switch
+    def start_pulling(self):
+        db.session.flush()
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id).where(
+            table.c.follower_count > current_app.config['TIMELINE_FANOUT_MAX_FOLLOWERS']).where(
+                db.or_(table.c.pulled_since == None, table.c.pushing)).values(
+                    pulled_since=db.func.coalesce(table.c.pulled_since, datetime.utcnow()), pushing=False))
+        db.session.expire(self, ['pulled_since', 'pushing'])
+
+    def stop_pulling(self):
+        #a band of TIMELINE_FANOUT_HYSTERESIS followers under the limit keeps an account that hovers around it from
+        #switching on every follow and unfollow. The posts are copied after the commit, see push_pulled_posts()
+        db.session.flush()
+        table = User.__table__
+        result = db.session.execute(table.update().where(table.c.id == self.id).where(
+            table.c.follower_count <= current_app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] -
+            current_app.config['TIMELINE_FANOUT_HYSTERESIS']).where(table.c.pulled_since != None).where(
+                table.c.pushing == False).values(pushing=True))
+        db.session.expire(self, ['pulled_since', 'pushing'])
+        if result.rowcount:
+            session = db.session()
+            session._timeline_pushes = (getattr(session, '_timeline_pushes', None) or set()) | {self.id}
+
+    def backfill_timeline(self, user):
+        #copy the posts of a newly followed user into this user's timeline
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id'],
+            db.select([db.literal(self.id), Post.id]).where(Post.user_id == user.id).where(
+                ~Post.id.in_(db.select([timeline.c.post_id]).where(timeline.c.user_id == self.id)))))
+
+    def prune_timeline(self, user):
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id).where(
+            timeline.c.post_id.in_(db.select([Post.id]).where(Post.user_id == user.id))))
+
+    def push_pulled_posts(self, chunk_size=500):
+        #for a user stop_pulling() has set to pushing: copies the posts written since pulled_since into the
+        #followers' timelines, chunk_size posts per commit so no transaction gets big, then stops pulling them. Run by
+        #app.timeline_pusher or "flask timeline push", never in a request. Returns how many timeline rows were added
+        since = self.pulled_since
+        last = copied = 0
+        while True:
+            ids = [id for id, in db.session.query(Post.id).filter(
+                Post.user_id == self.id, Post.timestamp >= since, Post.id > last).order_by(Post.id).limit(chunk_size)]
+            if not ids:
+                break
+            result = db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id'],
+                db.select([followers.c.follower_id, Post.id]).where(followers.c.followed_id == self.id).where(
+                    Post.id.in_(ids)).where(~db.exists().where(db.and_(
+                        timeline.c.user_id == followers.c.follower_id, timeline.c.post_id == Post.id)))))
+            db.session.commit()
+            last = ids[-1]
+            copied += result.rowcount
+        #unless they went back over the limit in the meantime
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id).where(table.c.pulled_since == since).where(
+            table.c.pushing == True).values(pulled_since=None, pushing=False))
+        db.session.commit()
+        return copied
+
+    def rebuild_timeline(self):
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id'],
+            db.select([db.literal(self.id), Post.id]).where(self.computed_posts().whereclause)))
+
+    def check_timeline(self):
+        #consistency check, returns the post ids the timeline store is missing and the ones it shouldn't have
+        stored = {p.id for p in self.timeline_posts()}
+        expected = {p.id for p in self.computed_posts()}
+        return expected - stored, stored - expected
 
     #called in email.py to generate a token that is sent with the email
     def get_reset_password_token(self, expires_in=600):
@@ -171,23 +454,72 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return User.query.get(id)
 
     #used to get a representation of each user for the API
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'followed': url_for('api.get_followed', id=self.id),
-                #same avatar method used to render avatars in the web pages
-                'avatar': self.avatar(140)
+    #viewer adds whether that user follows this one
+    #the columns the API representation is made from, paginate_api() loads just these as plain rows
+    API_COLUMNS = ['id', 'username', 'last_seen', 'about_me', 'post_count', 'follower_count', 'followed_count',
+                   'updated_at']
+
+    @classmethod
+    def paginate_api(cls, query, page, per_page, viewer=None):
+        columns = [getattr(cls, column) for column in cls.API_COLUMNS]
+        rows = query
+        if viewer is not None:
+            #the viewer's follow state comes along in the same query, as a viewer_follows column
+            follows = followers.alias()
+            rows = rows.outerjoin(follows, db.and_(follows.c.followed_id == cls.id,
+                                                     follows.c.follower_id == viewer.id))
+            columns.append(follows.c.follower_id.isnot(None).label('viewer_follows'))
+        items = rows.with_entities(*columns).limit(per_page).offset((page - 1) * per_page).all()
+        if page == 1 and len(items) < per_page:
+            total = len(items)
+        else:
+            #count(id) straight off the query, query.count() would wrap it in a subquery, join and all
+            total = query.order_by(None).with_entities(db.func.count(cls.id)).scalar()
+        return Pagination(query, page, per_page, total, items)
+
+    @staticmethod
+    def to_dicts(users, viewer=None):
+        #users can be User objects or paginate_api() rows. The links come from templates made once per call, the
+        #avatar urls are made once per file, and the viewer's follow states are looked up in one query unless the
+        #rows already have them
+        user_url = url_template('api.get_user')
+        followers_url = url_template('api.get_followers')
+        followed_url = url_template('api.get_followed')
+        avatars = {}
+        states = {}
+        if viewer is not None:
+            if users and hasattr(users[0], 'viewer_follows'):
+                states = {user.id: bool(user.viewer_follows) for user in users}
+            else:
+                states = viewer.follow_states(users)
+        items = []
+        for user in users:
+            choice = avatar_choice(user.id, user.username)
+            if choice not in avatars:
+                avatars[choice] = url_for('static', filename=current_app.static_files.avatar(*choice, 140))
+            data = {
+                'id': user.id,
+                'username': user.username,
+                'last_seen': user.last_seen.isoformat() + 'Z',
+                'about_me': user.about_me,
+                'post_count': user.post_count,
+                'follower_count': user.follower_count,
+                'followed_count': user.followed_count,
+                '_links': {
+                    'self': user_url.format(user.id),
+                    'followers': followers_url.format(user.id),
+                    'followed': followed_url.format(user.id),
+                    #same avatar method used to render avatars in the web pages
+                    'avatar': avatars[choice]
+                }
             }
-        }
+            if viewer is not None and viewer.id != user.id:
+                data['is_following'] = states[user.id]
+            items.append(data)
+        return items
+
+    def to_dict(self, include_email=False, viewer=None):
+        data = User.to_dicts([self], viewer=viewer)[0]
         #only include email when user requests their own data
         if include_email:
             data['email'] = self.email
@@ -208,6 +540,8 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         #returns current token if a current token exists and has > 60 seconds left
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        #the old token stops working, so it can't stay in the token cache either
+        self.forget_token(self.token)
         #encoded in base64 so all characters are readable
         self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
@@ -217,13 +551,47 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     def revoke_token(self):
         #used to remove token, sets the exp date to 1 second
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        self.forget_token(self.token)
+
+    @staticmethod
+    def forget_token(token):
+        #dropped from the token cache once the commit goes through. Until then the database still accepts the token
+        #too, and dropping it earlier would let a request in between cache it again
+        if token:
+            session = db.session()
+            session._stale_tokens = (getattr(session, '_stale_tokens', None) or set()) | {token}
+
+    @staticmethod
+    def repair_counters():
+        #recalculate every user's counters from the tables they summarise
+        db.session.execute(User.__table__.update().values(
+            post_count=db.select([db.func.count(Post.id)]).where(Post.user_id == User.id).as_scalar(),
+            follower_count=db.select([db.func.count()]).select_from(followers).where(
+                followers.c.followed_id == User.id).as_scalar(),
+            followed_count=db.select([db.func.count()]).select_from(followers).where(
+                followers.c.follower_id == User.id).as_scalar()))
 
     @staticmethod
     def check_token(token):
+        cache = current_app.token_cache
+        id = cache.get(token) if cache else None
+        if id is not None:
+            #a cached token skips the lookup. The user is attached to the session without being loaded, so a view
+            #that only needs g.current_user.id doesn't run any SQL, and anything else is loaded fresh on first use
+            user = User(id=id)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
         user = User.query.filter_by(token=token).first()
+        if user is None and db.session().use_primary():
+            #a token handed out a moment ago may not have reached the replica yet
+            user = User.query.filter_by(token=token).first()
         #if user is not found or token is expired
         if user is None or user.token_expiration < datetime.utcnow():
             return None
+        if cache:
+            #never cache a token for longer than it has left
+            ttl = min(current_app.config['TOKEN_CACHE_TTL'], (user.token_expiration - datetime.utcnow()).total_seconds())
+            cache.set(token, user.id, ttl)
         return user
 
 
@@ -231,15 +599,146 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
 class Post(SearchableMixin, db.Model):
     # this __searchable__ attribute is just a variable, it does not have any behavior associated with it
     __searchable__ = ['body']
+    #relationships loaded in the same query as the search results, _post.html shows the author of every post
+    __search_eager__ = ['author']
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    #like User.updated_at, set again by every UPDATE of the row. The language is filled in after the post is written,
+    #the export's since has to find the post again then
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
-    #
+
+    #everything _post.html needs, saved in the search index so results can be rendered without a database hit.
+    #The author's name is copied in, so it is only as fresh as the last time the post was indexed
+    def stored_fields(self):
+        return {'timestamp': self.timestamp.strftime(STORED_TIMESTAMP), 'language': self.language,
+                'user_id': self.user_id, 'username': self.author.username if self.author else None}
+
+    @classmethod
+    def from_stored(cls, id, payload):
+        #a transient Post built from its indexed document, never added to the session. Its author is transient too
+        fields = payload[STORED_FIELD]
+        post = cls(id=id, body=payload['body'], timestamp=datetime.strptime(fields['timestamp'], STORED_TIMESTAMP),
+                   language=fields['language'], user_id=fields['user_id'])
+        post.author = User(id=fields['user_id'], username=fields['username'])
+        return post
+
+    @classmethod
+    def cursor_filter(cls, cursor, newer=False):
+        #rows older than the cursor in (timestamp, id) order, or newer ones when newer is True. The plain range on
+        #timestamp in front lets the database seek the timestamp index to the cursor, an OR at the top makes it scan
+        #from the newest row instead
+        timestamp, id = cursor
+        if newer:
+            return db.and_(cls.timestamp >= timestamp, db.or_(cls.timestamp > timestamp, cls.id > id))
+        return db.and_(cls.timestamp <= timestamp, db.or_(cls.timestamp < timestamp, cls.id < id))
+
+    def fan_out(self):
+        #push a new post into the author's timeline and the timelines of everyone following them. Authors with
+        #more than TIMELINE_FANOUT_MAX_FOLLOWERS followers only get their own copy, readers pull the rest on read
+        if not current_app.config.get('TIMELINE_FANOUT'):
+            return
+        if self.id is None:
+            db.session.flush()
+        db.session.execute(timeline.insert(), {'user_id': self.user_id, 'post_id': self.id})
+        if not self.author.is_celebrity():
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id'],
+                db.select([followers.c.follower_id, db.literal(self.id)]).where(
+                    followers.c.followed_id == self.user_id)))
+
+@db.event.listens_for(db.session, 'after_commit')
+def drop_stale_tokens(session):
+    tokens = getattr(session, '_stale_tokens', None)
+    session._stale_tokens = None
+    if tokens and current_app.token_cache:
+        for token in tokens:
+            current_app.token_cache.delete(token)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def keep_stale_tokens(session):
+    #the tokens are still good if the change never made it
+    session._stale_tokens = None
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def queue_timeline_pushes(session):
+    #queued after the commit, the pusher's own session has to see the users set to pushing
+    ids = getattr(session, '_timeline_pushes', None)
+    session._timeline_pushes = None
+    if ids and current_app.timeline_pusher:
+        for id in ids:
+            current_app.timeline_pusher.put(id)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def drop_timeline_pushes(session):
+    session._timeline_pushes = None
+
+
+#the columns that show up in a rendered post row or user popup, see app/fragments.py
+FRAGMENT_COLUMNS = ['username', 'about_me', 'last_seen', 'follower_count', 'followed_count']
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def find_stale_fragments(session, flush_context, instances):
+    #edit_profile, the API's update_user and follow/unfollow all end up here. This has to be before the flush, the
+    #counters set to SQL expressions are expired by the flush along with their history. {username: renamed}
+    usernames = getattr(session, '_stale_fragments', None) or {}
+    for user in session.dirty:
+        if isinstance(user, User):
+            state = db.inspect(user)
+            for column in FRAGMENT_COLUMNS:
+                history = state.attrs[column].history
+                if history.has_changes():
+                    renamed = column == 'username'
+                    usernames[user.username] = usernames.get(user.username) or renamed
+                    if renamed:
+                        usernames.update((name, True) for name in history.deleted if name)
+    session._stale_fragments = usernames
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def drop_stale_fragments(session):
+    usernames = getattr(session, '_stale_fragments', None)
+    session._stale_fragments = None
+    if usernames and current_app.fragment_cache:
+        for username, renamed in usernames.items():
+            current_app.fragment_cache.forget(username, renamed)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def keep_stale_fragments(session):
+    session._stale_fragments = None
+
+
+@db.event.listens_for(User, 'expire')
+def forget_follow_states(user, attrs):
+    #the cached follow states go stale along with the rest of the object. attrs is None when the whole object is
+    #expired, a flush only expires the counters that were set to SQL expressions
+    if attrs is None:
+        user.__dict__.pop('_follow_states', None)
+
+
+#keep User.post_count in step with the post table whichever code path adds or deletes the post. These run inside the
+#flush, so they go straight to the connection
+@db.event.listens_for(Post, 'after_insert')
+def count_new_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(User.id == post.user_id).values(
+        post_count=User.post_count + 1))
+
+
+@db.event.listens_for(Post, 'after_delete')
+def count_deleted_post(mapper, connection, post):
+    connection.execute(User.__table__.update().where(User.id == post.user_id).values(
+        post_count=User.post_count - 1))
+
 
 @login.user_loader
 def load_user(id):
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    #werkzeug's pbkdf2 hashes with the cost taken from the config. With PASSWORD_HASH_WORKERS set, at most that many
+    #hashes run at once and the rest wait their turn, so a burst of logins can't take every core away from the
+    #requests serving pages. hashlib lets go of the GIL while it hashes, the waiting threads cost nothing
+    def __init__(self, app):
+        self.method = 'pbkdf2:{}:{}'.format(app.config['PASSWORD_HASH_ALGORITHM'],
+                                            app.config['PASSWORD_HASH_ITERATIONS'])
+        self.salt_length = app.config['PASSWORD_SALT_LENGTH']
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        self.pool = ThreadPoolExecutor(workers) if workers else None
+
+    def run(self, fn, *args):
+        if self.pool is None:
+            return fn(*args)
+        return self.pool.submit(fn, *args).result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        #hashes look like method$salt$hash, anything made with other settings is redone the next time the password
+        #is known
+        method, salt, _ = password_hash.split('$', 2)
+        return method != self.method or len(salt) < self.salt_length
+
+
+def calibrate(target_ms, algorithm='sha256', rounds=5):
+    #the iteration count that makes one hash take about target_ms on this machine. pbkdf2 time is linear in the
+    #iterations, so time a known count and scale it, taking the fastest round so a busy moment doesn't skew it
+    iterations = 10000
+    best = min(timed(generate_password_hash, 'password', 'pbkdf2:{}:{}'.format(algorithm, iterations))
+               for _ in range(rounds))
+    return max(1000, int(iterations * target_ms / best // 1000 * 1000))
+
+
+def timed(fn, *args):
+    start = perf_counter()
+    fn(*args)
+    return (perf_counter() - start) * 1000
@@ -0,0 +1,123 @@
+import hashlib
+import random
+from time import time
+from flask import has_request_context, request, session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import Select, CompoundSelect
+from app.cache import LocalCache, RedisCache
+from app.database import engine_options
+
+#methods that only read, anything else is served from the primary from start to finish so it never decides what to
+#write from data a replica hasn't caught up with
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class RoutingSession(SignallingSession):
+    #sends SELECTs to one of the replicas, picked once per session so a request sees one consistent copy, and
+    #everything else to the primary. Once a session writes it reads from the primary too, and so does the client
+    #for REPLICA_LAG_TOLERANCE seconds after, see ReplicaRouter
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.router = getattr(self.app, 'replicas', None)
+        self.replica = None
+        self.primary = self.router is None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.primary and mapper is not None and \
+                getattr(mapper.persist_selectable, 'info', {}).get('bind_key') is not None:
+            #models with their own __bind_key__ aren't replicated
+            return SignallingSession.get_bind(self, mapper, clause)
+        if not self.primary and not self._flushing and isinstance(clause, (Select, CompoundSelect)) and \
+                clause._for_update_arg is None:
+            if self.replica is None:
+                #decided at the first read, the rest of the session follows it
+                if self.router.sticky():
+                    self.primary = True
+                    return SignallingSession.get_bind(self, mapper, clause)
+                self.replica = self.router.choose()
+            return self.replica
+        if not isinstance(clause, (Select, CompoundSelect)) and clause is not None:
+            #an UPDATE, INSERT or DELETE run straight on the session
+            self.written()
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def use_primary(self):
+        #reads from here on go to the primary. Returns False if they already did
+        if self.primary:
+            return False
+        self.primary = True
+        return True
+
+    def written(self):
+        self.primary = True
+        self.wrote = True
+
+
+def flushing(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        session.written()
+
+
+def committed(session):
+    if session.wrote and session.router is not None:
+        session.router.remember_write()
+    session.wrote = False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'before_flush', flushing)
+        event.listen(factory, 'after_commit', committed)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if app.config['DATABASE_TUNING']:
+            engine_options(app.config, sa_url, options)
+
+
+class ReplicaRouter(object):
+    #the replicas are the binds replica0, replica1, ... made from SQLALCHEMY_REPLICA_URLS. A client that wrote
+    #something reads from the primary for the next REPLICA_LAG_TOLERANCE seconds, so it sees its own change
+    #whichever replica it would have got. Browsers are remembered in their session cookie, API clients by their
+    #Authorization header, in redis when there is one so every process knows
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.names = ['replica{}'.format(i) for i in range(len(app.config['SQLALCHEMY_REPLICA_URLS']))]
+        self.lag_tolerance = app.config['REPLICA_LAG_TOLERANCE']
+        self.writers = RedisCache(app.redis, 'writer:') if app.redis else LocalCache(10000)
+
+    @staticmethod
+    def binds(urls):
+        return {'replica{}'.format(i): url for i, url in enumerate(urls)}
+
+    def choose(self):
+        return self.db.get_engine(self.app, random.choice(self.names))
+
+    def client_key(self):
+        authorization = request.headers.get('Authorization')
+        return hashlib.sha1(authorization.encode('utf-8')).hexdigest() if authorization else None
+
+    def sticky(self):
+        #outside of requests, in the CLI and background threads, reads always go to the replicas
+        if not has_request_context():
+            return False
+        if request.method not in READ_METHODS:
+            return True
+        key = self.client_key()
+        if key is not None:
+            return self.writers.get(key) is not None
+        return cookie_session.get('primary_until', 0) > time()
+
+    def remember_write(self):
+        if not has_request_context() or not self.lag_tolerance:
+            return
+        key = self.client_key()
+        if key is not None:
+            self.writers.set(key, 1, self.lag_tolerance)
+        else:
+            cookie_session['primary_until'] = time() + self.lag_tolerance
@@ -1,37 +1,229 @@
+import atexit
+import json
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread
 from flask import current_app
+from app.instrumentation import timed
+
+
+#everything below talks to current_app.search_backend, which is set up in create_app(). Elasticsearch is used when
+#ELASTICSEARCH_URL is configured, otherwise the in-process engine in app/localsearch.py
+class SearchBackend(ABC):
+    #send a list of bulk API actions, see index_actions() and delete_actions() for the format
+    @abstractmethod
+    def bulk(self, actions):
+        pass
+
+    #returns the ids of the matches from start to start + size, best match first, and the total number of matches.
+    #fields limits the match to those fields. With stored, each match is an (id, indexed document) pair instead of just the id
+    @abstractmethod
+    def search(self, index, query, start, size, fields=None, stored=False):
+        pass
+
+    @abstractmethod
+    def create_index(self, index):
+        pass
+
+    #point alias at target and drop whatever it pointed at before
+    @abstractmethod
+    def swap_alias(self, alias, target):
+        pass
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, actions):
+        result = self.client.bulk(body=actions)
+        if result and result.get('errors'):
+            raise RuntimeError('bulk request had errors')
+
+    def search(self, index, query, start, size, fields=None, stored=False):
+        search = self.client.search(
+            index=index, doc_type=index,
+            #fields are individual columns that we added to the payload when indexing a record. For Posts, only 1 field is present
+            #multimatch used to query multiple fields. [*] means to look in all fields
+            body={'query': {'multi_match': {'query': query, 'fields': fields or ['*']}},
+                  'from': start, 'size': size,
+                  #only ship the documents back when they are going to be used
+                  '_source': stored})
+        #list of all the element ids from the search results
+        if stored:
+            hits = [(int(hit['_id']), hit['_source']) for hit in search['hits']['hits']]
+        else:
+            hits = [int(hit['_id']) for hit in search['hits']['hits']]
+        return hits, search['hits']['total']
+
+    def create_index(self, index):
+        if not self.client.indices.exists(index=index):
+            self.client.indices.create(index=index)
+
+    def swap_alias(self, alias, target):
+        #the alias moves in one atomic request so searches never see a missing index
+        actions = [{'add': {'index': target, 'alias': alias}}]
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = [name for name in self.client.indices.get_alias(name=alias) if name != target]
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif self.client.indices.exists(index=alias):
+            #a real index with the alias' name, left over from before aliases were used
+            actions.append({'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for name in old:
+            self.client.indices.delete(index=name)
+
+
+#payload key for the data a model keeps in the index so search results can be shown without a database hit.
+#It isn't searched
+STORED_FIELD = 'stored'
+
+
+def payload_for(model):
+    #the body is a dictionary containing the data from every field marked as "searchable" in the model
+    payload = {field: getattr(model, field) for field in model.__searchable__}
+    if hasattr(model, 'stored_fields'):
+        payload[STORED_FIELD] = model.stored_fields()
+    return payload
 
 #args passed from model are (cls.__tablename__, instance of model)
 def add_to_index(index, model):
-    # when the Elasticsearch server isn't configured,
+    # when search isn't configured,
     # the application continues to run without the search capability and without giving any errors.
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    payload = {}
-    #define a general way to extract all the data you marked as being indexable from a given model
-    for field in model.__searchable__:
-        #each field is entered as a value | body = {columnName1:data,columnName2:data}
-        payload[field] = getattr(model, field)
-    #the body is a dictionary containing the data from every field marked as "searchable" in the model
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload)
+    current_app.search_backend.bulk(index_actions(index, model))
 
 #args passed from model are (cls.__tablename__, instance of model)
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
     #This function deletes the JSON obj containing the given id
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    current_app.search_backend.bulk(delete_actions(index, model))
+
+
+#bulk API actions come in pairs, an action line followed by the document for index actions
+#doc_type only differs from index when building into a new index that an alias will point to later
+def index_actions(index, model, doc_type=None):
+    return [{'index': {'_index': index, '_type': doc_type or index, '_id': model.id}}, payload_for(model)]
+
+
+def delete_actions(index, model):
+    return [{'delete': {'_index': index, '_type': index, '_id': model.id}}]
+
+
+#send a whole commit's worth of changes in one bulk request instead of one HTTP call per object
+@timed('search')
+def bulk_index(actions):
+    if not current_app.search_backend or not actions:
+        return
+    #hand the request to the background indexer if there is one so the commit doesn't wait on the search cluster
+    if current_app.search_indexer:
+        current_app.search_indexer.put(actions)
+    else:
+        current_app.search_backend.bulk(actions)
+
+
+class BulkIndexer(object):
+    #background thread that ships bulk requests. Anything queued while a request is in flight is merged into the next one
+    def __init__(self, app, max_batch=1000):
+        self.backend = app.search_backend
+        self.logger = app.logger
+        self.max_batch = max_batch
+        self.queue = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        #don't lose queued changes when the process exits normally
+        atexit.register(self.flush)
+
+    def put(self, actions):
+        self.queue.put(actions)
+
+    def flush(self):
+        #blocks until everything queued so far has been sent
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            batches = [self.queue.get()]
+            while len(batches) < self.max_batch:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.backend.bulk([action for batch in batches for action in batch])
+            except Exception:
+                self.logger.exception('Bulk indexing of %d commits failed', len(batches))
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+
+def bulk_reindex(index, read_chunks, chunk_size=500, workers=4, checkpoint=None, swap_alias=False, progress=None):
+    #read_chunks(after_id, chunk_size) yields lists of models in primary key order. Each chunk goes out as one bulk
+    #request from a pool of workers. The checkpoint file records the last id that is known to be indexed along with
+    #every id before it, so an interrupted run picks up where it stopped. It has to be resumed the way it was started,
+    #with or without swap_alias, or the rest would go to a different index than the part that is done
+    backend = current_app.search_backend
+    if not backend:
+        return 0
+    state = {}
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        #checkpoints from before swap_alias was saved only build into a separate index with it
+        if state.get('swap_alias', state['target'] != index) != swap_alias:
+            raise ValueError('{} is from a reindex {} swap_alias, resume it the same way or delete it'.format(
+                checkpoint, 'with' if not swap_alias else 'without'))
+    #with swap_alias, build into a fresh index and only point the alias at it once it is complete
+    target = state.get('target') or (
+        '{}-{}'.format(index, datetime.utcnow().strftime('%Y%m%d%H%M%S')) if swap_alias else index)
+    if swap_alias:
+        backend.create_index(target)
+
+    def save(last_id):
+        if checkpoint:
+            with open(checkpoint, 'w') as f:
+                json.dump({'target': target, 'swap_alias': swap_alias, 'last_id': last_id}, f)
+
+    def finish(pending):
+        last_id, count, future = pending.popleft()
+        future.result()
+        save(last_id)
+        if progress:
+            progress(count)
+        return count
+
+    total = 0
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for chunk in read_chunks(state.get('last_id', 0), chunk_size):
+            actions = [action for model in chunk for action in index_actions(target, model, doc_type=index)]
+            pending.append((chunk[-1].id, len(chunk), pool.submit(backend.bulk, actions)))
+            #finish chunks in order so the checkpoint never skips over one that is still in flight,
+            #and don't read too far ahead of the workers
+            while pending and (len(pending) > workers * 2 or pending[0][2].done()):
+                total += finish(pending)
+        while pending:
+            total += finish(pending)
+
+    if swap_alias:
+        backend.swap_alias(index, target)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return total
 
 
-def query_index(index, query, page, per_page):
-    #return this if elasticsearch isn't configured
-    if not current_app.elasticsearch:
+@timed('search')
+def query_index(index, query, page, per_page, fields=None, stored=False):
+    #return this if search isn't configured
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        #fields are individual columns that we added to the payload when indexing a record. For Posts, only 1 field is present
-        #multimatch used to query multiple fields. [*] means to look in all fields
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}}, 'from': (page - 1) * per_page, 'size': per_page})
-    #list of all the element ids from the search results
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
     #returns the ids of all the models that matched the query and a total number of matches you got
-    return ids, search['hits']['total']
\ No newline at end of file
+    return current_app.search_backend.search(index, query, (page - 1) * per_page, per_page, fields, stored)
@@ -0,0 +1,132 @@
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+from flask import current_app
+from sqlalchemy import bindparam
+from app import db
+from app.models import User, Post, followers
+
+#(weight, words) per language, enough for guess_language to agree with the language the post is stored with
+LANGUAGES = {
+    'en': (55, 'the people time year way day thing world life hand part child work week case point government '
+               'company number group problem fact good new first last long great little own other old right big '
+               'high small large next early young important few public bad same able today just really'.split()),
+    'es': (20, 'el la los las una tiempo persona año camino día cosa mundo vida mano parte niño ojo mujer lugar '
+               'trabajo semana caso punto gobierno empresa grande nuevo bueno primero último largo pequeño mismo '
+               'hoy muy también pero porque cuando donde siempre'.split()),
+    'pt': (8, 'o os uma tempo pessoa ano caminho dia coisa mundo vida mão parte criança olho mulher lugar trabalho '
+              'semana caso ponto governo empresa grande novo bom primeiro último longo pequeno mesmo hoje muito '
+              'também mas porque quando onde sempre não'.split()),
+    'fr': (7, 'le les une temps personne année chemin jour chose monde vie main partie enfant oeil femme endroit '
+              'travail semaine cas point gouvernement entreprise grand nouveau bon premier dernier long petit même '
+              "aujourd'hui très aussi mais parce quand où toujours".split()),
+    'de': (6, 'der die das eine Zeit Person Jahr Weg Tag Ding Welt Leben Hand Teil Kind Auge Frau Ort Arbeit '
+              'Woche Fall Punkt Regierung Firma groß neu gut erste letzte lang klein heute sehr auch aber weil '
+              'wenn wo immer nicht'.split()),
+    'it': (4, 'il gli una tempo persona anno strada giorno cosa mondo vita mano parte bambino occhio donna posto '
+              'lavoro settimana caso punto governo azienda grande nuovo buono primo ultimo lungo piccolo stesso '
+              'oggi molto anche ma perché quando dove sempre'.split()),
+}
+#relative number of posts written in each hour of the day, quiet at night and busiest in the evening
+HOURS = [2, 1, 1, 1, 1, 2, 4, 6, 8, 8, 7, 7, 8, 8, 7, 7, 8, 9, 10, 11, 11, 10, 7, 4]
+
+
+def zipf_weights(n, exponent):
+    #cumulative weights of n items where the k-th most popular one is picked 1/k**exponent as often as the first
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def sentence(rng, language, low=4, high=18):
+    body = ' '.join(rng.choices(LANGUAGES[language][1], k=low + int(rng.random() * (high - low + 1))))
+    return (body[0].upper() + body[1:])[:140]
+
+
+def timestamp(rng, today, now, days):
+    #newer posts are more common than old ones, and most are written during the day. today is midnight of now
+    hour = bisect_left(HOUR_WEIGHTS, rng.random() * HOUR_WEIGHTS[-1])
+    moment = today + timedelta(seconds=(hour - 24 * int(days * rng.random() ** 2)) * 3600 + int(rng.random() * 3600))
+    return moment - timedelta(days=1) if moment > now else moment
+
+
+HOUR_WEIGHTS = list(accumulate(HOURS))
+LANGUAGE_NAMES = list(LANGUAGES)
+LANGUAGE_WEIGHTS = list(accumulate(weight for weight, _ in LANGUAGES.values()))
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(users, posts, following=20, exponent=1.0, days=365, password='password', chunk_size=10000, rng_seed=None,
+         progress=None):
+    #adds that many users called user<id>, followers drawn from a power law and posts, written with executemany
+    #INSERTs a chunk at a time. A few accounts get most of the followers and write most of the posts, like on a real
+    #site. The counters are worked out here, the search index and the timelines are left to their rebuild commands.
+    #progress(table, rows) is called after every chunk. Returns the ids of the new users
+    rng = random.Random(rng_seed)
+    now = datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    first = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    ids = list(range(first, first + users))
+    #one hash for everyone, hashing each password on its own would take longer than everything else
+    password_hash = current_app.password_hasher.hash(password)
+    #popularity and activity are separate rankings, someone who posts a lot isn't necessarily followed a lot
+    popular = rng.sample(ids, len(ids))
+    active = rng.sample(ids, len(ids))
+    popularity = zipf_weights(users, exponent)
+    activity = zipf_weights(users, exponent)
+    counts = {id: [0, 0, 0] for id in ids}
+
+    def user_rows():
+        for id in ids:
+            yield {'id': id, 'username': 'user{}'.format(id), 'email': 'user{}@example.com'.format(id),
+                   'password_hash': password_hash, 'about_me': sentence(rng, 'en', 3, 10),
+                   'last_seen': now - timedelta(seconds=int(days * 86400 * rng.random() ** 4)), 'updated_at': now}
+
+    def follow_rows():
+        for id in ids:
+            #how many others someone follows is heavy tailed too, a pareto variable with a mean of following
+            wanted = min(users - 1, int(following * rng.paretovariate(1.5) / 3))
+            if not wanted:
+                continue
+            followed = set(rng.choices(popular, cum_weights=popularity, k=wanted))
+            followed.discard(id)
+            counts[id][2] += len(followed)
+            for other in followed:
+                counts[other][1] += 1
+                yield {'follower_id': id, 'followed_id': other}
+
+    def post_rows():
+        for _ in range(posts):
+            author = active[bisect_left(activity, rng.random() * activity[-1])]
+            language = LANGUAGE_NAMES[bisect_left(LANGUAGE_WEIGHTS, rng.random() * LANGUAGE_WEIGHTS[-1])]
+            counts[author][0] += 1
+            yield {'body': sentence(rng, language), 'timestamp': timestamp(rng, today, now, days), 'user_id': author,
+                   'language': language}
+
+    for table, rows in [(User.__table__, user_rows()), (followers, follow_rows()), (Post.__table__, post_rows())]:
+        for chunk in chunked(rows, chunk_size):
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            if progress:
+                progress(table.name, len(chunk))
+    update = User.__table__.update().where(User.id == bindparam('_id')).values(
+        post_count=bindparam('_posts'), follower_count=bindparam('_followers'),
+        followed_count=bindparam('_followed'), pulled_since=bindparam('_pulled'))
+    #accounts over the fan-out limit have had their posts pulled all along
+    limit = current_app.config['TIMELINE_FANOUT_MAX_FOLLOWERS']
+    first_post = today - timedelta(days=days + 1)
+    for chunk in chunked(ids, chunk_size):
+        db.session.execute(update, [{'_id': id, '_posts': counts[id][0], '_followers': counts[id][1],
+                                     '_followed': counts[id][2],
+                                     '_pulled': first_post if counts[id][1] > limit else None} for id in chunk])
+        db.session.commit()
+    return ids
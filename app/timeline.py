@@ -0,0 +1,43 @@
+import atexit
+from queue import Queue
+from threading import Thread, Lock
+from app import db
+from app.models import User
+
+
+class TimelinePusher(object):
+    #copies the posts of users who have dropped back under the fan-out limit into their followers' timelines, in a
+    #background thread after the unfollow that did it is committed, see User.push_pulled_posts(). Their followers
+    #keep pulling the posts until it is done. Users a process didn't get to, because it crashed or was killed, stay
+    #set to pushing and are picked up by "flask timeline push"
+    def __init__(self, app):
+        self.app = app
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def put(self, user_id):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+        self.queue.put(user_id)
+
+    def flush(self):
+        #blocks until everything queued so far has been pushed
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            user_id = self.queue.get()
+            try:
+                with self.app.app_context():
+                    user = User.query.get(user_id)
+                    if user is not None and user.pushing:
+                        user.push_pulled_posts()
+            except Exception:
+                self.app.logger.exception('Pushing the pulled posts of user %d failed', user_id)
+                db.session.rollback()
+            finally:
+                self.queue.task_done()
@@ -1,16 +1,75 @@
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
 from flask_babel import _
+from app.cache import LocalCache, FileCache, RedisCache
+from app.instrumentation import timed
 
 
 def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    r = requests.get('https://api.microsofttranslator.com/v2/Ajax.svc'
-                     '/Translate?text={}&from={}&to={}'.format(text, source_language, dest_language),headers=auth)
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return json.loads(r.content.decode('utf-8-sig'))
\ No newline at end of file
+    return current_app.translator.translate_many([(text, source_language)], dest_language)[0]
+
+
+def translate_many(items, dest_language):
+    #items are (text, source language) pairs, the translations come back in the same order
+    return current_app.translator.translate_many(items, dest_language)
+
+
+class Translator(object):
+    #talks to Microsoft Translator through one pooled session, so the connection is reused instead of a new TLS
+    #handshake per translation, with a cache in front of it. Every reader of a post asks for the same translation
+    def __init__(self, app):
+        self.url = app.config['MS_TRANSLATOR_URL']
+        self.key = app.config['MS_TRANSLATOR_KEY']
+        self.timeout = app.config['TRANSLATOR_TIMEOUT']
+        self.ttl = app.config['TRANSLATION_CACHE_TTL']
+        workers = app.config['TRANSLATOR_WORKERS']
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        #the upstream calls for a batch run side by side in here
+        self.pool = ThreadPoolExecutor(workers)
+        if app.redis:
+            self.cache = RedisCache(app.redis, 'translation:')
+        elif app.config['TRANSLATION_CACHE_PATH']:
+            self.cache = FileCache(app.config['TRANSLATION_CACHE_PATH'], app.config['TRANSLATION_CACHE_SIZE'])
+        else:
+            self.cache = LocalCache(app.config['TRANSLATION_CACHE_SIZE'])
+
+    @staticmethod
+    def cache_key(text, source_language, dest_language):
+        return '{}:{}:{}'.format(hashlib.sha1(text.encode('utf-8')).hexdigest(), source_language, dest_language)
+
+    @timed('translate')
+    def translate_many(self, items, dest_language):
+        if not self.key:
+            return [_('Error: the translation service is not configured.')] * len(items)
+        keys = [self.cache_key(text, source, dest_language) for text, source in items]
+        results = {key: self.cache.get(key) for key in keys}
+        #the same text twice on a page is only sent once
+        missing = {key: item for key, item in zip(keys, items) if results[key] is None}
+        if len(missing) == 1:
+            fetched = [self.fetch(*next(iter(missing.values())), dest_language)]
+        else:
+            fetched = self.pool.map(lambda item: self.fetch(*item, dest_language), missing.values())
+        for key, translation in zip(list(missing), fetched):
+            #failures aren't cached, the next request tries again
+            if translation is not None:
+                self.cache.set(key, translation, self.ttl)
+            results[key] = translation
+        return [_('Error: the translation service failed.') if results[key] is None else results[key] for key in keys]
+
+    def fetch(self, text, source_language, dest_language):
+        #runs in the pool threads too, so it can't touch current_app or flask_babel. None means it failed
+        try:
+            r = self.session.get(self.url, params={'text': text, 'from': source_language, 'to': dest_language},
+                                 headers={'Ocp-Apim-Subscription-Key': self.key}, timeout=self.timeout)
+        except requests.RequestException:
+            return None
+        if r.status_code != 200:
+            return None
+        return json.loads(r.content.decode('utf-8-sig'))
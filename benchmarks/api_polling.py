@@ -0,0 +1,85 @@
+"""Polling throughput on the users API with and without conditional requests.
+
+Seeds a throwaway SQLite database and has a client poll a page of users
+and a single user through the test client, first fetching the full body
+every time, then sending back the ETag it was given so unchanged
+resources come back as 304. --change-every edits a user on the polled
+page every so many requests, so some polls do see new data:
+
+    python benchmarks/api_polling.py --users 1000 --per-page 100 --requests 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def run(conditional, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        REDIS_URL = None
+
+    app = create_app(BenchConfig)
+    expiration = datetime.utcnow() + timedelta(hours=1)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+             'about_me': 'about user{}'.format(i), 'last_seen': datetime.utcnow(),
+             'token': 'token{}'.format(i), 'token_expiration': expiration}
+            for i in range(1, args.users + 1)])
+        db.session.commit()
+
+    client = app.test_client()
+    urls = ['/api/users?per_page={}'.format(args.per_page), '/api/users/2']
+    tags = {}
+    statuses = {200: 0, 304: 0}
+    sent = 0
+    start = perf_counter()
+    for i in range(args.requests):
+        if args.change_every and i and i % args.change_every == 0:
+            with app.app_context():
+                user = User.query.get(i % min(args.users, args.per_page) + 1)
+                user.about_me = 'changed {}'.format(i)
+                db.session.commit()
+        url = urls[i % len(urls)]
+        headers = {'Authorization': 'Bearer token1', 'Accept-Encoding': 'gzip'}
+        if conditional and url in tags:
+            headers['If-None-Match'] = tags[url]
+        response = client.get(url, headers=headers)
+        statuses[response.status_code] += 1
+        sent += len(response.data)
+        tags[url] = response.headers['ETag']
+    elapsed = perf_counter() - start
+    return args.requests / elapsed, sent / args.requests, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--change-every', type=int, default=0)
+    args = parser.parse_args()
+    plain, plain_bytes, _ = run(False, args)
+    conditional, conditional_bytes, statuses = run(True, args)
+    print('full bodies: {:.0f} req/s, {:.0f} bytes/response'.format(plain, plain_bytes))
+    print('if-none-match: {:.0f} req/s ({:+.0f}%), {:.0f} bytes/response, {} x 200, {} x 304'.format(
+        conditional, (conditional / plain - 1) * 100, conditional_bytes, statuses[200], statuses[304]))
+
+
+if __name__ == '__main__':
+    main()
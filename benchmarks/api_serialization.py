@@ -0,0 +1,111 @@
+"""Serializing a page of /api/users, row by row and in bulk.
+
+Seeds a throwaway SQLite database with users, some of them followed by
+the viewer, and times building the JSON for a page: loading User objects
+and calling to_dict() and jsonify() per row, against paginate_api(),
+to_collection_dict() and json_response(). Then the whole request through
+the test client. The serializing is also timed on its own, on a page that
+is already loaded:
+
+    python benchmarks/api_serialization.py --users 1000 --per-page 100 --pages 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from flask import jsonify, url_for
+from app import create_app, db
+from app.models import User, followers
+from app.api.responses import json_response
+from config import Config
+
+
+def per_row(viewer, page, per_page):
+    resources = User.query.paginate(page, per_page, False)
+    viewer.follow_states(resources.items)
+    return jsonify({
+        'items': [user.to_dict(viewer=viewer) for user in resources.items],
+        '_meta': {'page': page, 'per_page': per_page, 'total_pages': resources.pages,
+                  'total_items': resources.total},
+        '_links': {'self': url_for('api.get_users', page=page, per_page=per_page)}})
+
+
+def bulk(viewer, page, per_page):
+    resources = User.paginate_api(User.query, page, per_page, viewer=viewer)
+    return json_response(User.to_collection_dict(User.query, page, per_page, 'api.get_users', viewer=viewer,
+                                                 resources=resources))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=500)
+    args = parser.parse_args()
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        REDIS_URL = None
+        API_COMPRESS_MIN_SIZE = 0
+
+    app = create_app(BenchConfig)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+             'about_me': 'about user{}'.format(i), 'last_seen': now, 'token': 'token{}'.format(i),
+             'token_expiration': now + timedelta(hours=1)}
+            for i in range(1, args.users + 1)])
+        db.session.execute(followers.insert(), [
+            {'follower_id': 1, 'followed_id': i} for i in range(2, args.users + 1, 3)])
+        db.session.commit()
+
+    pages = max(1, args.users // args.per_page)
+    results = {}
+    for name, serialize in (('per row', per_row), ('bulk', bulk)):
+        with app.test_request_context():
+            start = perf_counter()
+            for i in range(args.pages):
+                #a fresh session and viewer per page, like separate requests get
+                db.session.remove()
+                serialize(User.query.get(1), i % pages + 1, args.per_page)
+            results[name] = args.pages / (perf_counter() - start)
+    #the serializing on its own, the page is already loaded
+    with app.test_request_context():
+        viewer = User.query.get(1)
+        users = User.query.paginate(1, args.per_page, False).items
+        rows = User.paginate_api(User.query, 1, args.per_page, viewer=viewer).items
+        viewer.follow_states(users)
+        for name, serialize in (('per row', lambda: jsonify([user.to_dict(viewer=viewer) for user in users])),
+                                ('bulk', lambda: json_response(User.to_dicts(rows, viewer=viewer)))):
+            start = perf_counter()
+            for i in range(args.pages):
+                serialize()
+            results[name + ' only'] = args.pages / (perf_counter() - start)
+    for name in ('per row', 'bulk'):
+        print('{:8} {:5.0f} pages/s, {:5.0f} pages/s serializing only'.format(
+            name + ':', results[name], results[name + ' only']))
+    print('bulk is {:.1f}x, {:.1f}x serializing only'.format(
+        results['bulk'] / results['per row'], results['bulk only'] / results['per row only']))
+
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer token1'}
+    start = perf_counter()
+    for i in range(args.pages):
+        response = client.get('/api/users?per_page={}&page={}'.format(args.per_page, i % pages + 1), headers=headers)
+        assert response.status_code == 200, response.status_code
+    print('GET /api/users?per_page={}: {:.0f} req/s'.format(args.per_page, args.pages / (perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    main()
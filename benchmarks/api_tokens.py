@@ -0,0 +1,64 @@
+"""API requests per second on /api/users/<id> with the token cache on and off.
+
+Seeds a throwaway SQLite database with users that each hold a token and
+fetches users through the test client, one token per request in turn:
+
+    python benchmarks/api_tokens.py --users 1000 --requests 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def run(ttl, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        REDIS_URL = None
+        TOKEN_CACHE_TTL = ttl
+
+    app = create_app(BenchConfig)
+    expiration = datetime.utcnow() + timedelta(hours=1)
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+             'token': 'token{}'.format(i), 'token_expiration': expiration}
+            for i in range(1, args.users + 1)])
+        db.session.commit()
+
+    client = app.test_client()
+    headers = [{'Authorization': 'Bearer token{}'.format(i)} for i in range(1, args.users + 1)]
+    start = perf_counter()
+    for i in range(args.requests):
+        response = client.get('/api/users/{}'.format(i % 10 + 1), headers=headers[i % args.users])
+        assert response.status_code == 200, response.status_code
+    return args.requests / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+    off = run(0, args)
+    on = run(Config.TOKEN_CACHE_TTL, args)
+    print('cache off: {:.0f} req/s'.format(off))
+    print('cache on:  {:.0f} req/s ({:+.0f}%)'.format(on, (on / off - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Concurrent reads and writes on SQLite with the stock engine and the tuned one.
+
+Seeds a throwaway database, then runs reader threads fetching pages of
+/api/users through the test client while writer threads add posts, for a
+fixed time with DATABASE_TUNING off and on. Reports throughput, latency
+percentiles and "database is locked" errors for each:
+
+    python benchmarks/database.py --readers 8 --writers 2 --seconds 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, len(values) * p // 100)] * 1000 if values else float('nan')
+
+
+def run(tuning, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        REDIS_URL = None
+        FRAGMENT_CACHE_TTL = 0
+        LANGUAGE_DETECTION_ASYNC = False
+        DATABASE_TUNING = tuning
+
+    app = create_app(BenchConfig)
+    now = datetime.utcnow()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i), 'last_seen': now,
+             'token': 'token{}'.format(i), 'token_expiration': now + timedelta(hours=1)}
+            for i in range(1, args.users + 1)])
+        db.session.commit()
+
+    deadline = perf_counter() + args.seconds
+    results = {'read': [], 'write': [], 'errors': 0}
+    lock = threading.Lock()
+
+    def reader(n):
+        client = app.test_client()
+        headers = {'Authorization': 'Bearer token{}'.format(n % args.users + 1)}
+        i = 0
+        while perf_counter() < deadline:
+            start = perf_counter()
+            response = client.get('/api/users?per_page=20&page={}'.format(i % 10 + 1), headers=headers)
+            elapsed = perf_counter() - start
+            with lock:
+                if response.status_code == 200:
+                    results['read'].append(elapsed)
+                else:
+                    results['errors'] += 1
+            i += 1
+
+    def writer(n):
+        with app.app_context():
+            i = 0
+            while perf_counter() < deadline:
+                start = perf_counter()
+                try:
+                    db.session.add(Post(body='post {} from writer {}'.format(i, n), user_id=(i + n) % args.users + 1))
+                    db.session.commit()
+                except OperationalError:
+                    db.session.rollback()
+                    with lock:
+                        results['errors'] += 1
+                    continue
+                finally:
+                    i += 1
+                with lock:
+                    results['write'].append(perf_counter() - start)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)] + \
+        [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+    for name, tuning in (('default', False), ('tuned', True)):
+        results = run(tuning, args)
+        for kind in ('read', 'write'):
+            latencies = sorted(results[kind])
+            print('{:8} {:7} {:7.1f}/s  p50 {:7.1f}ms  p99 {:7.1f}ms'.format(
+                name, kind + 's:', len(latencies) / args.seconds, percentile(latencies, 50), percentile(latencies, 99)))
+        print('{:8} {:7} {}'.format(name, 'errors:', results['errors']))
+
+
+if __name__ == '__main__':
+    main()
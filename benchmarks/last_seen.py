@@ -0,0 +1,96 @@
+"""Write volume and request latency of last_seen tracking, a write per request vs the batched tracker.
+
+Seeds a throwaway SQLite database and has a pool of logged in clients
+fetch user popups side by side, first with every request writing
+last_seen (threshold and flush interval of 0) and then with the
+configured defaults:
+
+    python benchmarks/last_seen.py --users 50 --requests 5000 --threads 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from app import create_app, db
+from app.models import User
+from config import Config
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(threshold, interval, args):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        LAST_SEEN_THRESHOLD = threshold
+        LAST_SEEN_FLUSH_INTERVAL = interval
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        #everyone was last seen an hour ago, so every user is due one write
+        last_seen = datetime.utcnow() - timedelta(hours=1)
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i), 'last_seen': last_seen}
+            for i in range(1, args.users + 1)])
+        db.session.commit()
+        engine = db.engine
+
+    writes = []
+    db.event.listen(engine, 'before_cursor_execute',
+                    lambda conn, cursor, statement, *rest: statement.startswith('UPDATE') and writes.append(1))
+
+    def client_for(id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(id)
+            session['_fresh'] = True
+        return client
+
+    clients = [client_for(i % args.users + 1) for i in range(args.requests)]
+
+    def fetch(i):
+        start = perf_counter()
+        response = clients[i].get('/user/user{}/popup'.format(i % args.users + 1))
+        assert response.status_code == 200, response.status_code
+        return (perf_counter() - start) * 1000
+
+    start = perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        timings = list(pool.map(fetch, range(args.requests)))
+    elapsed = perf_counter() - start
+    #whatever is still pending at the end would be written by the next flush, count it too
+    app.last_seen.flush()
+    return len(writes), timings, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('mode', 'writes', 'req/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for mode, threshold, interval in [('per-req', 0, 0),
+                                      ('batched', Config.LAST_SEEN_THRESHOLD, Config.LAST_SEEN_FLUSH_INTERVAL)]:
+        writes, timings, elapsed = run(threshold, interval, args)
+        print('{:>10} {:>8} {:>8.0f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            mode, writes, args.requests / elapsed, percentile(timings, 50), percentile(timings, 99), max(timings)))
+
+
+if __name__ == '__main__':
+    main()
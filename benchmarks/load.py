@@ -0,0 +1,226 @@
+"""End to end load test of the pages and the API on generated data.
+
+Drives index, explore, user, search and the /api endpoints from a number of
+concurrent clients. By default that is the test client on a throwaway
+SQLite database filled by app/seed.py (or --database, seeded if it has no
+users); with --url it is a running server over HTTP, after "flask seed"
+there. The clients sign in as --login through the login form and get an
+API token from /api/tokens. Reports requests per second and p50/p95/p99
+latency per endpoint, saves them as JSON and, with --compare, shows the
+change from an earlier run:
+
+    python benchmarks/load.py --users 2000 --posts 100000 --requests 300 --concurrency 4
+    python benchmarks/load.py --url http://localhost:5000 --output after.json --compare before.json
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from http.cookiejar import CookieJar
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import build_opener, HTTPCookieProcessor, HTTPRedirectHandler, Request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+#name: path, filled in from the users listed by the API and the search words
+ENDPOINTS = {
+    'index': lambda rng, users, words: '/index',
+    'explore': lambda rng, users, words: '/explore',
+    'user': lambda rng, users, words: '/user/{}'.format(rng.choice(users)['username']),
+    'search': lambda rng, users, words: '/search?q={}'.format(rng.choice(words)),
+    'api.get_users': lambda rng, users, words: '/api/users?page={}'.format(rng.randint(1, 5)),
+    'api.get_user': lambda rng, users, words: '/api/users/{}'.format(rng.choice(users)['id']),
+    'api.get_followers': lambda rng, users, words: '/api/users/{}/followers'.format(rng.choice(users)['id']),
+}
+
+
+class TestClient(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, data=None):
+        response = self.client.open(path, method=method, headers=headers, data=data)
+        return response.status_code, response.get_data()
+
+
+class NoRedirects(HTTPRedirectHandler):
+    #redirects come back as they are, like from the test client
+    def redirect_request(self, *args):
+        return None
+
+
+class ServerClient(object):
+    #keeps its own cookies, like a browser
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirects())
+
+    def request(self, method, path, headers=None, data=None):
+        body = urlencode(data).encode('utf-8') if data is not None else None
+        try:
+            with self.opener.open(Request(self.url + path, data=body, headers=headers or {}, method=method)) as f:
+                return f.status, f.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, len(values) * p // 100)] * 1000 if values else float('nan')
+
+
+def sign_in(client, username, password):
+    status, body = client.request('GET', '/auth/login')
+    match = CSRF_RE.search(body.decode('utf-8'))
+    data = {'username': username, 'password': password}
+    if match:
+        data['csrf_token'] = match.group(1)
+    status, body = client.request('POST', '/auth/login', data=data)
+    #a redirect away from the form means it worked
+    if status != 302:
+        sys.exit('signing in as {} failed with {}'.format(username, status))
+
+
+def api_token(client, username, password):
+    credentials = base64.b64encode('{}:{}'.format(username, password).encode('utf-8')).decode('ascii')
+    status, body = client.request('POST', '/api/tokens', headers={'Authorization': 'Basic ' + credentials})
+    if status != 200:
+        sys.exit('getting a token for {} failed with {}'.format(username, status))
+    return json.loads(body)['token']
+
+
+def local_app(args):
+    from app import create_app, db
+    from app.models import User, Post
+    from app.seed import seed
+    from config import Config
+    directory = tempfile.mkdtemp()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH_PATH = os.path.join(directory, 'search-index')
+        REDIS_URL = None
+        LANGUAGE_DETECTION_ASYNC = False
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        if not User.query.first():
+            start = perf_counter()
+            seed(args.users, args.posts, password=args.password, rng_seed=args.seed)
+            Post.reindex(workers=1)
+            print('seeded {} users and {} posts in {:.1f}s'.format(args.users, args.posts, perf_counter() - start))
+    return app
+
+
+def run(name, make_client, token, users, args):
+    #each worker signs in with its own client, then sends its share of the requests one after the other
+    path = ENDPOINTS[name]
+    headers = {'Authorization': 'Bearer ' + token} if name.startswith('api.') else None
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    clients = []
+    for _ in range(args.concurrency):
+        client = make_client()
+        sign_in(client, args.login, args.password)
+        clients.append(client)
+
+    def worker(n, client):
+        rng = random.Random(n)
+        for _ in range(args.warmup):
+            client.request('GET', path(rng, users, args.words), headers=headers)
+        own, failed = [], 0
+        for _ in range(args.requests // args.concurrency):
+            start = perf_counter()
+            status, _ = client.request('GET', path(rng, users, args.words), headers=headers)
+            own.append(perf_counter() - start)
+            failed += status >= 400
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(n, client)) for n, client in enumerate(clients)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': errors[0], 'throughput': len(latencies) / elapsed,
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else float('nan'),
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='a running server, instead of the test client')
+    parser.add_argument('--database', help='database for the test client, seeded if it has no users')
+    parser.add_argument('--users', type=int, default=1000, help='users to seed')
+    parser.add_argument('--posts', type=int, default=20000, help='posts to seed')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generated data')
+    parser.add_argument('--login', default='user1', help='user the clients sign in as')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='comma separated, of ' +
+                        ', '.join(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4, help='clients sending requests at once')
+    parser.add_argument('--warmup', type=int, default=5, help='requests per client before timing starts')
+    parser.add_argument('--words', default='people,time,world,tiempo,vida', type=lambda value: value.split(','),
+                        help='comma separated search terms')
+    parser.add_argument('--output', help='results file, load-<date>.json by default')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    args = parser.parse_args()
+    names = args.endpoints.split(',')
+    for name in names:
+        if name not in ENDPOINTS:
+            parser.error('unknown endpoint ' + name)
+
+    if args.url:
+        make_client = lambda: ServerClient(args.url)
+    else:
+        app = local_app(args)
+        make_client = lambda: TestClient(app)
+    client = make_client()
+    token = api_token(client, args.login, args.password)
+    status, body = client.request('GET', '/api/users?per_page=100', headers={'Authorization': 'Bearer ' + token})
+    users = json.loads(body)['items']
+
+    results = {}
+    print('{:<18} {:>9} {:>7} {:>9} {:>9} {:>9}'.format('endpoint', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name in names:
+        result = results[name] = run(name, make_client, token, users, args)
+        print('{:<18} {:>9.1f} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            name, result['throughput'], result['errors'], result['p50'], result['p95'], result['p99']))
+
+    output = args.output or 'load-{}.json'.format(datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump({'date': datetime.utcnow().isoformat(), 'args': vars(args), 'results': results}, f, indent=2)
+    print('saved to ' + output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)['results']
+        print('\nchange from {}'.format(args.compare))
+        print('{:<18} {:>9} {:>9} {:>9}'.format('endpoint', 'req/s', 'p50', 'p99'))
+        for name in names:
+            if name in before:
+                print('{:<18} {:>+8.0f}% {:>+8.0f}% {:>+8.0f}%'.format(
+                    name, (results[name]['throughput'] / before[name]['throughput'] - 1) * 100,
+                    (results[name]['p50'] / before[name]['p50'] - 1) * 100,
+                    (results[name]['p99'] / before[name]['p99'] - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Page latency of /explore and the home timeline, OFFSET pagination vs cursor pagination.
+
+Seeds a throwaway SQLite database and times pages at increasing depths
+of Post.query (explore) and User.followed_posts() (home) both ways. The
+cursor pages start from a cursor at that depth, like following the next
+links would get to. With --fanout the home timeline is read from the
+precomputed timeline table:
+
+    python benchmarks/pagination.py --posts 1000000 --per-page 25 --depths 0,1000,100000,500000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from app import create_app, db
+from app.models import User, Post, followers, paginate_posts, encode_cursor
+from config import Config
+
+
+def seed(users, posts):
+    #bulk inserts through the core tables, the ORM would take hours for a million rows
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)}
+        for i in range(1, users + 1)])
+    #user 1 follows half of everyone, so its timeline is a filter over the table and not all of it
+    db.session.execute(followers.insert(), [
+        {'follower_id': 1, 'followed_id': i} for i in range(2, users + 1, 2)])
+    start = datetime.utcnow() - timedelta(seconds=posts)
+    chunk = 50000
+    for first in range(0, posts, chunk):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': 'post {}'.format(i), 'user_id': i % users + 1,
+             'timestamp': start + timedelta(seconds=i), 'language': 'en'}
+            for i in range(first, min(first + chunk, posts))])
+    db.session.commit()
+
+
+def timed(fn, repeat=3):
+    #best of a few runs, the first one also warms the page cache
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        elapsed = (perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--depths', default='0,1000,10000,100000,300000',
+                        help='comma separated, rows before the page that is timed')
+    parser.add_argument('--fanout', action='store_true', help='home timeline from the timeline table')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        TESTING = True
+        ELASTICSEARCH_URL = None
+        LOCAL_SEARCH = False
+        TIMELINE_FANOUT = args.fanout
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        print('seeding {} posts into {}'.format(args.posts, path))
+        print('seeded in {:.1f}s'.format(timed(lambda: seed(args.users, args.posts), 1) / 1000))
+        user = User.query.get(1)
+        if args.fanout:
+            user.rebuild_timeline()
+            db.session.commit()
+        queries = [('explore', Post.query.filter), ('home', user.followed_posts)]
+
+        print('{:>8} {:>8} {:>12} {:>12}'.format('query', 'depth', 'offset ms', 'cursor ms'))
+        for name, query_for in queries:
+            for depth in [int(depth) for depth in args.depths.split(',')]:
+                query = query_for().options(db.joinedload(Post.author)).order_by(None).order_by(Post.timestamp.desc(), Post.id.desc())
+                last = query.offset(depth - 1).first() if depth else None
+                if depth and last is None:
+                    continue
+                offset = timed(lambda: query.offset(depth).limit(args.per_page).all())
+                before = encode_cursor(last) if last else None
+                cursor = timed(lambda: paginate_posts(query_for, args.per_page, before=before).items)
+                print('{:>8} {:>8} {:>12.2f} {:>12.2f}'.format(name, depth, offset, cursor))
+
+
+if __name__ == '__main__':
+    main()
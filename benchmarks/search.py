@@ -0,0 +1,80 @@
+"""Query latency of the in-process search engine on a seeded corpus.
+
+Builds a LocalSearch index of post-sized documents with a Zipf-like word
+distribution, times a batch of one and two word queries, then saves and
+reloads it:
+
+    python benchmarks/search.py --posts 200000 --queries 1000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from app.localsearch import LocalSearch
+
+
+def corpus(posts, vocabulary, rng):
+    words = ['word{}'.format(i) for i in range(vocabulary)]
+    #word i turns up with a weight of 1 / (i + 1), like real text
+    total = 0
+    cumulative = []
+    for i in range(vocabulary):
+        total += 1.0 / (i + 1)
+        cumulative.append(total)
+    for id in range(1, posts + 1):
+        yield id, ' '.join(rng.choices(words, cum_weights=cumulative, k=rng.randint(5, 25)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=10)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    path = tempfile.mkdtemp()
+    engine = LocalSearch(path)
+
+    start = perf_counter()
+    batch = []
+    for id, body in corpus(args.posts, args.vocabulary, rng):
+        batch += [{'index': {'_index': 'post', '_id': id}}, {'body': body}]
+        if len(batch) >= 2000:
+            engine.bulk(batch)
+            batch = []
+    engine.bulk(batch)
+    print('indexed {} posts in {:.1f}s'.format(args.posts, perf_counter() - start))
+
+    #mostly rare words with some common ones mixed in, the common ones are the slow queries
+    queries = [' '.join('word{}'.format(int(rng.paretovariate(0.5))) for _ in range(rng.randint(1, 2)))
+               for _ in range(args.queries)]
+    timings = []
+    for query in queries:
+        start = perf_counter()
+        engine.search('post', query, 0, args.per_page)
+        timings.append((perf_counter() - start) * 1000)
+    print('queries: p50 {:.2f}ms  p95 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms'.format(
+        percentile(timings, 50), percentile(timings, 95), percentile(timings, 99), max(timings)))
+
+    start = perf_counter()
+    engine.save()
+    print('snapshot {:.1f}MB written in {:.1f}s'.format(
+        os.path.getsize(engine.snapshot_file) / 1e6, perf_counter() - start))
+    start = perf_counter()
+    LocalSearch(path)
+    print('reloaded in {:.1f}s'.format(perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import os
 from dotenv import load_dotenv
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
@@ -9,18 +10,115 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     #Signals to the application every time a change is about to be made to the database
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    #read only copies of the database, comma separated. The SELECTs of GET requests go to them, see app/replicas.py
+    SQLALCHEMY_REPLICA_URLS = [url for url in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
+    #seconds a client that wrote something reads from the primary afterwards, more than the replicas fall behind by
+    REPLICA_LAG_TOLERANCE = float(os.environ.get('REPLICA_LAG_TOLERANCE') or 5)
+    #time SQL, search, translation and templates per request, see app/instrumentation.py. The totals go back in a
+    #Server-Timing header, and requests that take longer than SLOW_REQUEST_THRESHOLD milliseconds are logged,
+    #0 doesn't log any
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '1') != '0'
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+    SLOW_REQUEST_THRESHOLD = int(os.environ.get('SLOW_REQUEST_THRESHOLD') or 500)
+    #request counts and latencies, pool checkouts and the mail queue at /metrics for Prometheus, see app/metrics.py.
+    #Under a server with several worker processes point METRICS_DIR at a directory they share, each one writes its
+    #numbers there every METRICS_FLUSH_INTERVAL seconds and /metrics adds them up. /metrics is only there with
+    #METRICS_TOKEN set, scrapers send it as a bearer token
+    METRICS = os.environ.get('METRICS', '1') != '0'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)
+    #the engine settings below, see app/database.py. 0 leaves SQLAlchemy's and SQLite's defaults
+    DATABASE_TUNING = os.environ.get('DATABASE_TUNING', '1') != '0'
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+    #milliseconds to wait for a lock before "database is locked"
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    #negative is in KiB, 64MB of page cache per connection
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64000)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 5)
+    #connections kept open to a server database, and how many more can be opened when they're all in use
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT') or 30)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    #outgoing mail is queued for a few worker threads that reuse their SMTP connection, see app/email.py
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    #a failed message is tried again after MAIL_RETRY_DELAY seconds, doubling every time
+    MAIL_RETRIES = int(os.environ.get('MAIL_RETRIES') or 3)
+    MAIL_RETRY_DELAY = float(os.environ.get('MAIL_RETRY_DELAY') or 5)
+    #seconds a worker keeps its SMTP connection open without anything to send
+    MAIL_IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT') or 10)
     #The recipients of the email
     ADMINS = ['jordantestcs@gmail.com']
     POSTS_PER_PAGE = 3
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.microsofttranslator.com/v2/Ajax.svc/Translate'
+    #seconds to wait on the translator before giving up, and how many calls a batch makes at once
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    TRANSLATOR_WORKERS = int(os.environ.get('TRANSLATOR_WORKERS') or 8)
+    #translations are kept in redis when REDIS_URL is set, otherwise in memory, and also in this file if it's set
+    TRANSLATION_CACHE_PATH = os.environ.get('TRANSLATION_CACHE_PATH')
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 24 * 3600)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    #send index updates from a background thread instead of inside the request that committed
+    ELASTICSEARCH_ASYNC = os.environ.get('ELASTICSEARCH_ASYNC') is not None
+    #without ELASTICSEARCH_URL, search falls back to the in-process engine unless LOCAL_SEARCH is set to 0
+    LOCAL_SEARCH = os.environ.get('LOCAL_SEARCH', '1') != '0'
+    #where the in-process engine keeps its files, None keeps it in memory only
+    LOCAL_SEARCH_PATH = os.environ.get('LOCAL_SEARCH_PATH') or os.path.join(basedir, 'search-index')
+    #render search results from the fields saved in the index, without a database query. Author names in the
+    #results can lag behind a rename until the posts are reindexed
+    SEARCH_STORED_RESULTS = os.environ.get('SEARCH_STORED_RESULTS') is not None
     LANGUAGES = ['en', 'es']
+    #work out the language of new posts in a background thread instead of before the post is saved
+    LANGUAGE_DETECTION_ASYNC = os.environ.get('LANGUAGE_DETECTION_ASYNC', '1') != '0'
+    #keep a precomputed home timeline per user instead of working it out from the followers table on every page view
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') is not None
+    #posts by accounts with more followers than this are not pushed to every follower, they are merged in on read
+    TIMELINE_FANOUT_MAX_FOLLOWERS = int(os.environ.get('TIMELINE_FANOUT_MAX_FOLLOWERS') or 1000)
+    #followers an account has to lose below that limit before its posts are pushed again. The posts it wrote in
+    #between are copied into the timelines in a background thread, or only by "flask timeline push" when
+    #TIMELINE_PUSH_ASYNC is 0
+    TIMELINE_FANOUT_HYSTERESIS = int(os.environ.get('TIMELINE_FANOUT_HYSTERESIS') or 100)
+    TIMELINE_PUSH_ASYNC = os.environ.get('TIMELINE_PUSH_ASYNC', '1') != '0'
+    #seconds before a user's last_seen is worth writing again, and how often the pending ones are written out.
+    #An interval of 0 writes them in the request
+    LAST_SEEN_THRESHOLD = int(os.environ.get('LAST_SEEN_THRESHOLD') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+    #caches that have to agree across worker processes go to redis when this is set (needs the redis package),
+    #otherwise each process keeps its own
+    REDIS_URL = os.environ.get('REDIS_URL')
+    #seconds an API token stays cached before it is looked up again, 0 turns the cache off. Without redis a token
+    #revoked through one process keeps working in the others for up to this long
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    #seconds a rendered post row or user popup is kept, 0 turns the cache off. Changes to a user throw theirs away
+    #straight away, in every process with redis, otherwise only in the process that made the change
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 300)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    #pbkdf2 cost of new password hashes. The defaults are werkzeug's, what the existing hashes were made with, so
+    #they are left alone. Raising them makes every login rehash the user's password once and every later one slower,
+    #in exchange for hashes that take longer to crack: pick the iterations with "flask passwords calibrate". The
+    #hash column fits sha256 but not sha512
+    PASSWORD_HASH_ALGORITHM = os.environ.get('PASSWORD_HASH_ALGORITHM') or 'sha256'
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS') or DEFAULT_PBKDF2_ITERATIONS)
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+    #how many password hashes can run at once, 0 runs them in the request thread without a limit
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)
+    #API responses at least this many bytes are sent gzipped, or brotli compressed when the brotli package is
+    #installed, to clients that accept it. 0 turns compression off
+    API_COMPRESS_MIN_SIZE = int(os.environ.get('API_COMPRESS_MIN_SIZE') or 1024)
 
 #When usign my own email
 # set MAIL_SERVER=smtp.googlemail.com
@@ -1,8 +1,30 @@
 from datetime import datetime, timedelta
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import json
+import sqlite3
+import subprocess
+import sys
+from threading import Thread
+from time import time, sleep
+from urllib.parse import parse_qs, urlparse
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from flask import g, url_for
+from flask_mail import Message
+from werkzeug.security import generate_password_hash
+from app import create_app, db, cli
+from app.models import User, Post, followers, paginate_posts, timeline
 
+from app.search import BulkIndexer, ElasticsearchBackend
+from app.cache import RedisCache, FileCache
+from app.passwords import PasswordHasher, calibrate
+from app.translate import translate
+from app.language import detect_language, fill_languages
+from app.localsearch import LocalSearch
 from config import Config
 
 
@@ -10,9 +32,210 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    LOCAL_SEARCH_PATH = None
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    #full strength hashing only slows the tests down
+    PASSWORD_HASH_ITERATIONS = 1000
+    LANGUAGE_DETECTION_ASYNC = False
+    TIMELINE_PUSH_ASYNC = False
 
 
 
+class FakeElasticsearch(object):
+    #in-memory stand-in for the elasticsearch client, records every request it gets
+    def __init__(self):
+        self.docs = {}
+        self.requests = []
+        self.indices = FakeIndices()
+        #set to a number to make that many bulk requests succeed and the rest fail
+        self.fail_after = None
+
+    def index(self, index, doc_type, id, body):
+        self.requests.append('index')
+        self.docs[(index, str(id))] = body
+
+    def delete(self, index, doc_type, id):
+        self.requests.append('delete')
+        self.docs.pop((index, str(id)), None)
+
+    def bulk(self, body):
+        if self.fail_after is not None and self.requests.count('bulk') >= self.fail_after:
+            raise ConnectionError('search cluster went away')
+        self.requests.append('bulk')
+        actions = iter(body)
+        for action in actions:
+            op, meta = next(iter(action.items()))
+            key = (meta['_index'], str(meta['_id']))
+            if op == 'index':
+                self.docs[key] = next(actions)
+            else:
+                self.docs.pop(key, None)
+
+    def search(self, index, doc_type, body):
+        self.requests.append('search')
+        words = body['query']['multi_match']['query'].lower().split()
+        hits = [{'_id': id, '_source': doc} for (i, id), doc in sorted(self.docs.items())
+                if i == index and any(w in str(doc.get(f, '')).lower() for f in body['query']['multi_match']['fields']
+                                      for w in words)]
+        return {'hits': {'hits': hits[body['from']:body['from'] + body['size']], 'total': len(hits)}}
+
+
+class FakeIndices(object):
+    def __init__(self):
+        self.names = set()
+        self.aliases = {}
+
+    def exists(self, index):
+        return index in self.names
+
+    def create(self, index):
+        self.names.add(index)
+
+    def delete(self, index):
+        self.names.discard(index)
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            op, args = next(iter(action.items()))
+            if op == 'add':
+                self.aliases[args['alias']] = args['index']
+            elif op == 'remove_index':
+                self.names.discard(args['index'])
+
+
+class FakeRedis(object):
+    #the few redis commands the caches use, expiry times are recorded but never acted on
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode('utf-8')
+        self.expiry[key] = ex
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class StubTranslator(object):
+    #local stand-in for Microsoft Translator on a free port. Answers with the text prefixed by the target language,
+    #fails on "fail", never answers "slow" and takes a third of a second over anything starting with "wait"
+    def __init__(self):
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                args = parse_qs(urlparse(self.path).query)
+                text = args['text'][0]
+                stub.requests.append(text)
+                if text == 'slow':
+                    #the client has given up by now, there is no one to answer
+                    sleep(1)
+                    return
+                elif text.startswith('wait'):
+                    sleep(0.3)
+                if text == 'fail':
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                body = json.dumps('[{}] {}'.format(args['to'][0], text)).encode('utf-8-sig')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/Translate'.format(self.server.server_port)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubSMTP(object):
+    #just enough of an SMTP server for flask-mail on a free port. Records the connections and the messages, and
+    #answers the first fail_first messages with a temporary error
+    def __init__(self, fail_first=0):
+        self.connections = 0
+        self.messages = []
+        self.fail_first = fail_first
+        stub = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                stub.connections += 1
+                self.reply('220 stub ready')
+                data = None
+                for line in self.rfile:
+                    if data is not None:
+                        if line.rstrip(b'\r\n') != b'.':
+                            data.append(line)
+                        elif stub.fail_first:
+                            stub.fail_first -= 1
+                            self.reply('451 try again later')
+                        else:
+                            stub.messages.append(b''.join(data).decode('utf-8'))
+                            self.reply('250 ok')
+                        if line.rstrip(b'\r\n') == b'.':
+                            data = None
+                        continue
+                    command = line[:4].upper()
+                    if command == b'DATA':
+                        data = []
+                        self.reply('354 go ahead')
+                    elif command == b'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('250 ok')
+
+            def reply(self, text):
+                self.wfile.write((text + '\r\n').encode('utf-8'))
+
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueryCounter(object):
+    #counts the SQL statements run inside the with block
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        db.event.listen(db.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         #create application instance
@@ -37,6 +260,35 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        u = User(username='susan')
+        #a hash from before the settings changed
+        u.password_hash = generate_password_hash('cat', 'pbkdf2:sha256:500', 8)
+        old = u.password_hash
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(u.password_hash, old)
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(self.app.password_hasher.needs_rehash(u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+        #the same through a bounded pool
+        self.app.password_hasher.pool = ThreadPoolExecutor(2)
+        u.set_password('dog')
+        self.assertTrue(u.check_password('dog'))
+        self.assertFalse(u.check_password('cat'))
+        self.app.password_hasher.pool.shutdown()
+
+    def test_default_settings(self):
+        #hashes werkzeug made with its own defaults, like every existing one, are kept as they are
+        self.app.config.update(PASSWORD_HASH_ITERATIONS=Config.PASSWORD_HASH_ITERATIONS,
+                               PASSWORD_SALT_LENGTH=Config.PASSWORD_SALT_LENGTH)
+        self.assertFalse(PasswordHasher(self.app).needs_rehash(generate_password_hash('cat')))
+
+    def test_calibrate(self):
+        iterations = calibrate(50)
+        self.assertGreater(iterations, 1000)
+        self.assertEqual(iterations % 1000, 0)
+
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -61,6 +313,56 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_states(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        me = users[0]
+        me.follow(users[1])
+        me.follow(users[3])
+        db.session.commit()
+        #a page of users straight from a query, like the API and templates get them
+        users = User.query.order_by(User.id).all()
+        with QueryCounter() as counter:
+            states = me.follow_states(users)
+            #asking again, or one at a time, is answered from the cache
+            self.assertTrue(me.is_following(users[3]))
+            self.assertFalse(me.is_following(users[4]))
+        self.assertEqual(states, {users[0].id: False, users[1].id: True, users[2].id: False,
+                                  users[3].id: True, users[4].id: False})
+        self.assertEqual(counter.count, 1)
+        me.unfollow(users[1])
+        self.assertFalse(me.is_following(users[1]))
+        db.session.commit()
+        #the commit expires the cache along with the rest of the object
+        self.assertNotIn('_follow_states', me.__dict__)
+        self.assertEqual(me.follow_states(users[1:2]), {users[1].id: False})
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.follower_count, u1.followed_count), (0, 0, 0))
+        u1.follow(u2)
+        u1.follow(u2)
+        p1 = Post(body='post from susan', author=u2)
+        db.session.add_all([p1, Post(body='another post from susan', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count, u2.post_count), (1, 1, 2))
+        u1.unfollow(u2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count, u2.post_count), (0, 0, 1))
+
+        #counters that drifted are put right by the repair
+        u1.followed.append(u2)
+        u2.post_count = 7
+        db.session.commit()
+        User.repair_counters()
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count, u2.post_count, u1.post_count), (1, 1, 1, 0))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -99,6 +401,1437 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_paginate_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        #two posts share a timestamp so the id has to break the tie
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u2 if i % 2 else u1,
+                      timestamp=now + timedelta(seconds=i // 2)) for i in range(7)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        page1 = paginate_posts(u1.followed_posts, 3)
+        self.assertEqual(page1.items, newest_first[:3])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+        page2 = paginate_posts(u1.followed_posts, 3, before=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[3:6])
+        self.assertTrue(page2.has_prev)
+        page3 = paginate_posts(u1.followed_posts, 3, before=page2.next_cursor)
+        self.assertEqual(page3.items, newest_first[6:])
+        self.assertFalse(page3.has_next)
+
+        #walking back with the prev cursor returns the same pages
+        back = paginate_posts(u1.followed_posts, 3, after=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        back = paginate_posts(u1.followed_posts, 3, after=back.prev_cursor)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        self.assertEqual(paginate_posts(u2.posts.filter, 10).items,
+                         [p for p in newest_first if p.author == u2])
+        #a garbled cursor falls back to the first page
+        self.assertEqual(paginate_posts(Post.query.filter, 3, before='junk').items, page1.items)
+
+
+class FanoutConfig(TestConfig):
+    TIMELINE_FANOUT = True
+    TIMELINE_FANOUT_MAX_FOLLOWERS = 1
+    TIMELINE_FANOUT_HYSTERESIS = 0
+
+
+class PusherConfig(FanoutConfig):
+    TIMELINE_PUSH_ASYNC = True
+
+
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(FanoutConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, body, seconds):
+        post = Post(body=body, author=author, timestamp=datetime.utcnow() + timedelta(seconds=seconds))
+        db.session.add(post)
+        post.fan_out()
+        db.session.commit()
+        return post
+
+    def test_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        p1 = self.post(u2, 'old post from susan', 1)
+        u1.follow(u2)
+        db.session.commit()
+        #following backfills the posts made before the follow
+        self.assertEqual(u1.followed_posts().all(), [p1])
+        p2 = self.post(u2, 'new post from susan', 2)
+        p3 = self.post(u1, 'post from john', 3)
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+
+        #susan now has more followers than the limit, her new posts are read instead of pushed
+        u3.follow(u2)
+        db.session.commit()
+        p4 = self.post(u2, 'celebrity post', 4)
+        self.assertEqual(db.session.query(timeline).filter_by(post_id=p4.id).count(), 1)
+        self.assertEqual(u1.followed_posts().all(), [p4, p3, p2, p1])
+        self.assertEqual(u3.followed_posts().all(), [p4, p2, p1])
+        for user in [u1, u2, u3]:
+            self.assertEqual(user.check_timeline(), (set(), set()))
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3])
+        self.assertEqual(u1.check_timeline(), (set(), set()))
+        #back down to the limit. The post that was read is copied after the request, until then mary still pulls it
+        self.assertTrue(u2.pushing)
+        self.assertEqual(db.session.query(timeline).filter_by(post_id=p4.id).count(), 1)
+        self.assertEqual(u3.followed_posts().all(), [p4, p2, p1])
+        p5 = self.post(u2, 'pushed again', 5)
+        self.assertEqual(db.session.query(timeline).filter_by(post_id=p5.id).count(), 2)
+        #what the background pusher does, the command picks up the ones a process didn't get to
+        ids = [p.id for p in [u2, u3, p5, p4, p2, p1]]
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['timeline', 'push'])
+        self.assertIn('susan: 1 timeline rows added', result.output)
+        u2, u3 = [User.query.get(id) for id in ids[:2]]
+        self.assertIsNone(u2.pulled_since)
+        self.assertEqual(db.session.query(timeline).filter_by(post_id=ids[3]).count(), 2)
+        self.assertEqual([p.id for p in u3.followed_posts()], ids[2:])
+        self.assertEqual(u3.check_timeline(), (set(), set()))
+
+    def test_hysteresis(self):
+        self.app.config['TIMELINE_FANOUT_HYSTERESIS'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        p1 = self.post(u2, 'pushed post', 1)
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        self.assertTrue(u2.is_celebrity())
+        #back at the limit but not below the band, so still pulled
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertTrue(u2.is_celebrity())
+        p2 = self.post(u2, 'pulled post', 2)
+        self.assertEqual(db.session.query(timeline).filter_by(post_id=p2.id).count(), 1)
+        u1.follow(u2)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertTrue(u2.is_celebrity())
+        self.assertFalse(u2.pushing)
+        u3.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u2.is_celebrity())
+        self.assertTrue(u2.pushing)
+        #going back over the limit before the push ran keeps the posts pulled from the first time on
+        since = u2.pulled_since
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        self.assertTrue(u2.is_celebrity())
+        self.assertEqual(u2.pulled_since, since)
+        self.assertEqual(u1.followed_posts().all(), [p2, p1])
+
+    def test_pusher(self):
+        #a file, the background thread needs its own connection
+        path = os.path.join(tempfile.mkdtemp(), 'test.db')
+        db.session.remove()
+        self.app_context.pop()
+        PusherConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        self.app = create_app(PusherConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        p1 = self.post(u2, 'pulled post', 1)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.app.timeline_pusher.flush()
+        db.session.expire_all()
+        self.assertIsNone(u2.pulled_since)
+        self.assertEqual(u3.check_timeline(), (set(), set()))
+        self.assertEqual(db.session.query(timeline).filter_by(user_id=u3.id, post_id=p1.id).count(), 1)
+
+    def test_rebuild_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.followed.append(u2)
+        #posts written straight to the table skip fan_out, the check catches them and a rebuild repairs it
+        p1 = Post(body='post from susan', author=u2, timestamp=datetime.utcnow())
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(u1.check_timeline(), ({p1.id}, set()))
+        u1.rebuild_timeline()
+        db.session.commit()
+        self.assertEqual(u1.check_timeline(), (set(), set()))
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+
+class SearchSyncCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.elasticsearch = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.app.elasticsearch)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_one_bulk_request_per_commit(self):
+        es = self.app.elasticsearch
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first post', author=u)
+        p2 = Post(body='second post', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        self.assertEqual(es.requests, ['bulk'])
+        self.assertEqual(es.docs[('post', str(p1.id))]['body'], 'first post')
+        self.assertEqual(es.docs[('post', str(p2.id))]['body'], 'second post')
+        self.assertEqual(es.docs[('post', str(p2.id))]['stored']['username'], 'john')
+
+        #edited rows get reindexed
+        p1.body = 'edited post'
+        db.session.commit()
+        self.assertEqual(es.docs[('post', str(p1.id))]['body'], 'edited post')
+
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertNotIn(('post', str(p2.id)), es.docs)
+        self.assertEqual(es.requests, ['bulk'] * 3)
+
+        #commits that don't touch searchable models don't send anything
+        u.about_me = 'hi'
+        db.session.commit()
+        self.assertEqual(len(es.requests), 3)
+
+    def test_changes_flushed_before_commit(self):
+        es = self.app.elasticsearch
+        p1 = Post(body='flushed early')
+        db.session.add(p1)
+        db.session.flush()
+        p1.body = 'flushed twice'
+        db.session.flush()
+        db.session.commit()
+        self.assertEqual(list(es.docs), [('post', str(p1.id))])
+        self.assertEqual(es.docs[('post', str(p1.id))]['body'], 'flushed twice')
+        self.assertEqual(es.requests, ['bulk'])
+
+        #rolled back changes never reach the index
+        db.session.add(Post(body='rolled back'))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(len(es.docs), 1)
+
+    def test_background_indexer(self):
+        es = self.app.elasticsearch
+        self.app.search_indexer = BulkIndexer(self.app)
+        posts = [Post(body='post {}'.format(i)) for i in range(5)]
+        for post in posts:
+            db.session.add(post)
+            db.session.commit()
+        self.app.search_indexer.flush()
+        self.assertEqual(len(es.docs), 5)
+        self.assertLessEqual(len(es.requests), 5)
+
+
+    def test_reindex_resumes_from_checkpoint(self):
+        es = self.app.elasticsearch
+        db.session.add_all([Post(body='post {}'.format(i)) for i in range(10)])
+        db.session.commit()
+        es.docs.clear()
+        es.requests = []
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+
+        #the third bulk request fails, the first two chunks are saved in the checkpoint
+        es.fail_after = 2
+        with self.assertRaises(ConnectionError):
+            Post.reindex(chunk_size=3, workers=1, checkpoint=checkpoint)
+        self.assertTrue(os.path.exists(checkpoint))
+        self.assertEqual(len(es.docs), 6)
+
+        es.fail_after = None
+        indexed = []
+        self.assertEqual(Post.reindex(chunk_size=3, workers=2, checkpoint=checkpoint, progress=indexed.append), 4)
+        self.assertEqual(indexed, [3, 1])
+        self.assertEqual(len(es.docs), 10)
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_reindex_swap_alias(self):
+        es = self.app.elasticsearch
+        db.session.add_all([Post(body='post {}'.format(i)) for i in range(4)])
+        db.session.commit()
+        #the old setup indexed straight into a real index called post
+        es.indices.create('post')
+        self.assertEqual(Post.reindex(chunk_size=3, swap_alias=True), 4)
+        new = es.indices.aliases['post']
+        self.assertTrue(new.startswith('post-'))
+        self.assertEqual(es.indices.names, {new})
+        self.assertEqual(len([key for key in es.docs if key[0] == new]), 4)
+
+
+class LocalSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search(self):
+        p1 = Post(body='flask is a python web framework')
+        p2 = Post(body='python python python')
+        p3 = Post(body='nothing to see here')
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('python', 1, 10)
+        self.assertEqual(total, 2)
+        #more occurrences in a shorter post ranks higher
+        self.assertEqual(posts.all(), [p2, p1])
+        posts, total = Post.search('Flask framework', 1, 1)
+        self.assertEqual((posts.all(), total), ([p1], 1))
+
+        #edits and deletes go through the same commit hooks
+        p3.body = 'flask tutorial'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('flask python', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p3})
+        self.assertEqual(Post.search('unknown', 1, 10)[1], 0)
+
+    def test_search_results(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='python and flask', author=u, language='en', timestamp=datetime(2019, 3, 19, 19, 46))
+        p2 = Post(body='python python', author=u, language='en')
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        posts, total = Post.search_results('python flask', 1, 10)
+        self.assertEqual((posts, total), ([p1, p2], 2))
+        self.assertIn('search', g.search_timings)
+
+        db.session.expire_all()
+        posts, total = Post.search_results('flask', 1, 10, stored=True)
+        self.assertEqual(total, 1)
+        post = posts[0]
+        #built straight from the index, not loaded from the session
+        self.assertNotIn(post, db.session)
+        self.assertEqual((post.id, post.body, post.timestamp, post.language), (p1.id, p1.body, p1.timestamp, 'en'))
+        self.assertEqual(post.author.username, 'john')
+        self.assertEqual(Post.search_results('django', 1, 10), ([], 0))
+
+    def test_persistence(self):
+        path = tempfile.mkdtemp()
+        engine = LocalSearch(path)
+        engine.bulk([{'index': {'_index': 'post', '_id': 1}}, {'body': 'hola mundo'},
+                     {'index': {'_index': 'post', '_id': 2}}, {'body': 'hello world'}])
+        engine.bulk([{'delete': {'_index': 'post', '_id': 2}}])
+        #a fresh engine replays the journal
+        self.assertEqual(LocalSearch(path).search('post', 'mundo world', 0, 10), ([1], 1))
+        #and after compaction reads the snapshot
+        engine.save()
+        self.assertEqual(os.path.getsize(engine.journal_file), 0)
+        reloaded = LocalSearch(path)
+        self.assertEqual(reloaded.search('post', 'hola', 0, 10), ([1], 1))
+        self.assertEqual(reloaded.search('post', 'hello', 0, 10), ([], 0))
+
+    def test_processes(self):
+        #two workers on one path see each other's changes, and compaction by one keeps what the other wrote
+        path = tempfile.mkdtemp()
+        first, second = LocalSearch(path), LocalSearch(path)
+        first.bulk([{'index': {'_index': 'post', '_id': 1}}, {'body': 'hola mundo'}])
+        second.bulk([action for i in range(2, 400) for action in (
+            {'index': {'_index': 'post', '_id': i}}, {'body': 'hello world {}'.format(i)})])
+        self.assertEqual(first.search('post', 'world', 0, 1)[1], 398)
+        self.assertEqual(second.search('post', 'mundo', 0, 10), ([1], 1))
+        first.save()
+        second.bulk([{'delete': {'_index': 'post', '_id': 2}}])
+        self.assertEqual(first.search('post', 'world', 0, 1)[1], 397)
+        self.assertEqual(LocalSearch(path).search('post', 'hola world', 0, 1)[1], 398)
+
+    def test_reindex_resumes_swap_alias(self):
+        self.app.search_backend = LocalSearch()
+        db.session.add_all([Post(body='post {}'.format(i)) for i in range(10)])
+        db.session.commit()
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+        bulk = self.app.search_backend.bulk
+        calls = []
+
+        def failing_bulk(actions):
+            calls.append(actions)
+            if len(calls) == 3:
+                raise ConnectionError('interrupted')
+            bulk(actions)
+        self.app.search_backend.bulk = failing_bulk
+        with self.assertRaises(ConnectionError):
+            Post.reindex(chunk_size=3, workers=1, checkpoint=checkpoint, swap_alias=True)
+        #resuming it without swap_alias would put the rest straight into the live index
+        with self.assertRaises(ValueError):
+            Post.reindex(chunk_size=3, workers=1, checkpoint=checkpoint)
+        self.assertEqual(len(calls), 3)
+        #the resumed run goes on with the index it started, without emptying it
+        self.assertEqual(Post.reindex(chunk_size=3, workers=1, checkpoint=checkpoint, swap_alias=True), 4)
+        self.assertEqual(Post.search('post', 1, 20)[1], 10)
+
+
+class PageConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+
+class PageQueryCase(unittest.TestCase):
+    #a page of posts has to cost a fixed number of queries, however many posts are on it
+    def setUp(self):
+        self.app = create_app(PageConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def queries_for(self, url, posts_per_page):
+        self.app.config['POSTS_PER_PAGE'] = posts_per_page
+        db.session.remove()
+        with QueryCounter() as counter:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True).count('<span id="post'), posts_per_page)
+        return counter.count
+
+    def test_post_lists(self):
+        me = User(username='john', email='john@example.com')
+        authors = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(10)]
+        db.session.add(me)
+        db.session.add_all(authors)
+        db.session.add_all([Post(body='post {} word'.format(i), author=authors[i % 10],
+                                 timestamp=datetime.utcnow() + timedelta(seconds=i)) for i in range(20)])
+        for author in authors:
+            me.follow(author)
+        db.session.commit()
+        self.login(me)
+        for url in ['/index', '/explore', '/user/user1', '/search?q=word']:
+            if url == '/user/user1':
+                self.assertEqual(self.queries_for(url, 1), self.queries_for(url, 2), url)
+            else:
+                self.assertEqual(self.queries_for(url, 2), self.queries_for(url, 10), url)
+
+
+
+class LastSeenConfig(PageConfig):
+    LAST_SEEN_FLUSH_INTERVAL = 3600
+
+
+class LastSeenCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(LastSeenConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tracker = self.app.last_seen
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def last_seen(self, user):
+        return db.session.query(User.last_seen).filter_by(id=user.id).scalar()
+
+    def test_batched_writes(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        start = u1.last_seen
+        now = start + timedelta(minutes=5)
+        #under the threshold nothing is queued
+        self.tracker.touch(u1, start + timedelta(seconds=10))
+        self.assertEqual(self.tracker.pending, {})
+        self.tracker.touch(u1, now)
+        self.tracker.touch(u2, now)
+        self.tracker.touch(u1, now + timedelta(seconds=1))
+        self.assertEqual(self.last_seen(u1), start)
+        with QueryCounter() as counter:
+            self.assertEqual(self.tracker.flush(), 2)
+        #both users go out in a single executemany
+        self.assertEqual(len([s for s in counter.statements if s.startswith('UPDATE')]), 1)
+        self.assertEqual(self.last_seen(u1), now + timedelta(seconds=1))
+        self.assertEqual(self.last_seen(u2), now)
+        #a queued time older than the stored one doesn't move it back
+        self.tracker.touch(u2, start + timedelta(minutes=2))
+        self.tracker.flush()
+        self.assertEqual(self.last_seen(u2), now)
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_fragments(self):
+        #a flush makes the popups show the new time, the post rows don't show it and are kept
+        user = User(username='john', email='john@example.com', last_seen=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(user)
+        db.session.commit()
+        cache = self.app.fragment_cache
+        with self.app.test_request_context():
+            version = cache.version('john')
+            posts_version = cache.version('john', 'posts')
+        self.tracker.touch(user)
+        self.tracker.flush()
+        with self.app.test_request_context():
+            self.assertNotEqual(cache.version('john'), version)
+            self.assertEqual(cache.version('john', 'posts'), posts_version)
+
+    def test_requests(self):
+        self.app.last_seen.interval = 0
+        user = User(username='john', email='john@example.com', last_seen=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(user)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+        with QueryCounter() as counter:
+            for _ in range(5):
+                #a fresh session each time, like separate requests get
+                db.session.remove()
+                self.assertEqual(client.get('/explore').status_code, 200)
+        #only the first request finds the stored time stale
+        self.assertEqual(len([s for s in counter.statements if s.startswith('UPDATE')]), 1)
+        self.assertGreater(self.last_seen(user), datetime.utcnow() - timedelta(minutes=1))
+
+
+
+class TokenCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        self.token = self.user.get_token()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, token):
+        #a fresh session each time, like separate requests get
+        db.session.remove()
+        return self.client.get(url, headers={'Authorization': 'Bearer ' + token})
+
+    def token_lookups(self, counter):
+        return len([s for s in counter.statements if 'user.token =' in s])
+
+    def test_cached_lookup(self):
+        with QueryCounter() as counter:
+            self.assertEqual(self.get('/api/users/{}'.format(self.user.id), self.token).status_code, 200)
+            self.assertEqual(self.get('/api/users/{}'.format(self.user.id), self.token).status_code, 200)
+        self.assertEqual(self.token_lookups(counter), 1)
+        self.assertEqual(self.get('/api/users/1', 'not a token').status_code, 401)
+        #the cached entry never outlives the token
+        User.query.get(self.user.id).token_expiration = datetime.utcnow() + timedelta(seconds=5)
+        db.session.commit()
+        self.app.token_cache.delete(self.token)
+        self.assertEqual(self.get('/api/users/{}'.format(self.user.id), self.token).status_code, 200)
+        value, expires = self.app.token_cache.entries[self.token]
+        self.assertLessEqual(expires - time(), 5)
+
+    def test_revoke_and_rotate(self):
+        url = '/api/users/{}'.format(self.user.id)
+        self.assertEqual(self.get(url, self.token).status_code, 200)
+        self.assertEqual(self.client.delete('/api/tokens', headers={'Authorization': 'Bearer ' + self.token}).status_code, 204)
+        self.assertEqual(self.get(url, self.token).status_code, 401)
+        user = User.query.get(self.user.id)
+        token = user.get_token()
+        db.session.commit()
+        self.assertEqual(self.get(url, token).status_code, 200)
+        #a rotated token is dropped when the new one is committed, not before
+        user = User.query.get(self.user.id)
+        user.token_expiration = datetime.utcnow()
+        new_token = user.get_token()
+        self.assertIsNotNone(self.app.token_cache.get(token))
+        db.session.commit()
+        self.assertIsNone(self.app.token_cache.get(token))
+        self.assertEqual(self.get(url, token).status_code, 401)
+        self.assertEqual(self.get(url, new_token).status_code, 200)
+
+    def test_shared_cache(self):
+        #two processes sharing one redis, a revoke in one of them reaches the other
+        redis = FakeRedis()
+        other = create_app(TestConfig)
+        self.app.token_cache = RedisCache(redis, 'token:')
+        other.token_cache = RedisCache(redis, 'token:')
+        url = '/api/users/{}'.format(self.user.id)
+        self.assertEqual(self.get(url, self.token).status_code, 200)
+        self.assertEqual(redis.get('token:' + self.token), str(self.user.id).encode('utf-8'))
+        self.assertLessEqual(redis.expiry['token:' + self.token], TestConfig.TOKEN_CACHE_TTL)
+        with other.test_request_context():
+            self.assertEqual(User.check_token(self.token).id, self.user.id)
+            user = User.query.get(self.user.id)
+            user.revoke_token()
+            db.session.commit()
+        self.assertIsNone(redis.get('token:' + self.token))
+        self.assertEqual(self.get(url, self.token).status_code, 401)
+
+
+
+class TranslateConfig(PageConfig):
+    MS_TRANSLATOR_KEY = 'key'
+    TRANSLATOR_TIMEOUT = 0.5
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TranslateConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.stub = StubTranslator()
+        self.app.translator.url = self.stub.url
+
+    def tearDown(self):
+        self.stub.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_translate(self):
+        self.assertEqual(translate('hola', 'es', 'en'), '[en] hola')
+        self.assertEqual(translate('hola', 'es', 'en'), '[en] hola')
+        self.assertEqual(translate('hola', 'es', 'fr'), '[fr] hola')
+        self.assertEqual(self.stub.requests, ['hola', 'hola'])
+        #failures are not cached. The error messages are translated too, which takes a request
+        with self.app.test_request_context():
+            self.assertIn('failed', translate('fail', 'es', 'en'))
+            self.assertIn('failed', translate('fail', 'es', 'en'))
+            self.assertEqual(self.stub.requests.count('fail'), 2)
+            start = time()
+            self.assertIn('failed', translate('slow', 'es', 'en'))
+            self.assertLess(time() - start, 0.9)
+
+    def test_batch(self):
+        user = User(username='john', email='john@example.com')
+        posts = [Post(body='hola', language='es', author=user), Post(body='hola', language='es', author=user),
+                 Post(body='hello', language='en', author=user), Post(body='adios', language='es', author=user)]
+        posts += [Post(body='wait {}'.format(i), language='es', author=user) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+        start = time()
+        response = client.post('/translate/batch', json={'posts': [post.id for post in posts], 'dest_language': 'en'})
+        #the four slow ones went upstream side by side
+        self.assertLess(time() - start, 0.9)
+        translations = response.get_json()['translations']
+        self.assertEqual(translations[str(posts[0].id)], '[en] hola')
+        self.assertEqual(translations[str(posts[1].id)], '[en] hola')
+        self.assertNotIn(str(posts[2].id), translations)
+        self.assertEqual(translations[str(posts[7].id)], '[en] wait 3')
+        self.assertEqual(sorted(self.stub.requests), ['adios', 'hola', 'wait 0', 'wait 1', 'wait 2', 'wait 3'])
+        self.assertEqual(client.post('/translate/batch', json={'posts': ['x']}).status_code, 400)
+        #the single post translate link shares the cache
+        response = client.post('/translate', data={'text': 'adios', 'source_language': 'es', 'dest_language': 'en'})
+        self.assertEqual(response.get_json()['text'], '[en] adios')
+        self.assertEqual(len(self.stub.requests), 6)
+
+    def test_file_cache(self):
+        path = os.path.join(tempfile.mkdtemp(), 'translations.jsonl')
+        cache = FileCache(path, max_size=2)
+        cache.set('a', 'x', 60)
+        cache.set('b', 'y', 60)
+        cache.delete('a')
+        cache.set('c', 'z', 60)
+        cache.set('d', 'w', 60)
+        #least recently used goes first, and the file was compacted along the way
+        reloaded = FileCache(path, max_size=2)
+        self.assertEqual([reloaded.get(key) for key in 'abcd'], [None, None, 'z', 'w'])
+        with open(path) as f:
+            self.assertLessEqual(len(f.readlines()), 4)
+
+
+
+class MailConfig(PageConfig):
+    MAIL_SERVER = '127.0.0.1'
+    MAIL_SUPPRESS_SEND = False
+    MAIL_RETRY_DELAY = 0.05
+    MAIL_IDLE_TIMEOUT = 5
+
+
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.smtp = StubSMTP()
+        self.app.extensions['mail'].port = self.smtp.port
+        self.queue = self.app.mail_queue
+
+    def tearDown(self):
+        self.smtp.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def message(self, i):
+        msg = Message('message {}'.format(i), sender='test@example.com', recipients=['user@example.com'])
+        msg.body = 'hello'
+        return msg
+
+    def test_connection_reuse(self):
+        for i in range(20):
+            self.assertTrue(self.queue.put(self.message(i)))
+        self.assertTrue(self.queue.flush(5))
+        self.assertEqual(len(self.smtp.messages), 20)
+        #one connection per worker for the whole burst
+        self.assertLessEqual(self.smtp.connections, self.app.config['MAIL_WORKERS'])
+        stats = self.queue.stats()
+        self.assertEqual((stats['sent'], stats['depth'], stats['failed']), (20, 0, 0))
+        self.assertIsNotNone(stats['latency_p99'])
+
+    def test_retry(self):
+        self.smtp.fail_first = 2
+        self.queue.put(self.message(1))
+        self.assertTrue(self.queue.flush(5))
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(self.queue.stats()['retried'], 2)
+        #past MAIL_RETRIES it gives up
+        self.smtp.fail_first = 10
+        self.queue.put(self.message(2))
+        self.assertTrue(self.queue.flush(5))
+        stats = self.queue.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['retried']), (1, 1, 5))
+
+    def test_full_queue(self):
+        self.queue.queue.maxsize = 2
+        self.queue.workers = 0
+        self.assertTrue(self.queue.put(self.message(1)))
+        self.assertTrue(self.queue.put(self.message(2)))
+        self.assertFalse(self.queue.put(self.message(3)))
+        self.assertEqual(self.queue.stats()['dropped'], 1)
+        self.assertEqual(self.queue.stats()['depth'], 2)
+
+    def test_password_reset(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.commit()
+        response = self.app.test_client().post('/auth/reset_password_request', data={'email': 'john@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.queue.flush(5))
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertIn('john@example.com', self.smtp.messages[0])
+
+
+
+ENGLISH = 'This is a longer English sentence about the weather and the city we live in.'
+SPANISH = 'Esta es una frase en español sobre el tiempo y la ciudad donde vivimos.'
+
+
+class LanguageConfig(PageConfig):
+    LANGUAGE_DETECTION_ASYNC = True
+
+
+class LanguageCase(unittest.TestCase):
+    def setUp(self):
+        #a file, the background thread needs its own connection
+        self.path = os.path.join(tempfile.mkdtemp(), 'test.db')
+        LanguageConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.path
+        self.app = create_app(LanguageConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        os.remove(self.path)
+
+    def test_detect_language(self):
+        self.assertEqual(detect_language(SPANISH), 'es')
+        hits = detect_language.cache_info().hits
+        self.assertEqual(detect_language(SPANISH), 'es')
+        self.assertEqual(detect_language.cache_info().hits, hits + 1)
+        self.assertEqual(detect_language('ok'), '')
+
+    def test_new_post(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(self.user.id)
+            session['_fresh'] = True
+        self.assertEqual(client.post('/index', data={'post': SPANISH}).status_code, 302)
+        self.app.language_detector.flush()
+        db.session.remove()
+        self.assertEqual(Post.query.one().language, 'es')
+
+    def test_exit(self):
+        #a process that exits with posts still queued detects them on the way out
+        db.session.add_all([Post(body=SPANISH, author=self.user) for i in range(50)])
+        db.session.commit()
+        script = (
+            'from tests import LanguageConfig\n'
+            'from app import create_app\n'
+            'from app.models import Post\n'
+            'LanguageConfig.SQLALCHEMY_DATABASE_URI = {!r}\n'
+            'app = create_app(LanguageConfig)\n'
+            'with app.app_context():\n'
+            '    for id, in Post.query.with_entities(Post.id):\n'
+            '        app.language_detector.put(id)\n').format('sqlite:///' + self.path)
+        subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        db.session.remove()
+        self.assertEqual(Post.query.filter(Post.language == None).count(), 0)
+
+    def test_backfill(self):
+        db.session.add_all([Post(body=ENGLISH if i % 2 else SPANISH, author=self.user) for i in range(10)])
+        db.session.add(Post(body='ok', author=self.user, language='xx'))
+        db.session.commit()
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['language', 'backfill', '--chunk-size', '3', '--workers', '2'])
+        self.assertIsNone(result.exception, result.output)
+        db.session.remove()
+        languages = [post.language for post in Post.query.order_by(Post.id)]
+        #posts that already have a language are left alone
+        self.assertEqual(languages, ['es', 'en'] * 5 + ['xx'])
+
+
+
+class FragmentCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(PageConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.me = User(username='john', email='john@example.com')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.me, self.susan])
+        db.session.add(Post(body='hello from susan', author=self.susan, language='es'))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(self.me.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **kwargs):
+        #a fresh session each time, like separate requests get
+        db.session.remove()
+        return self.client.get(url, **kwargs)
+
+    def fragments(self, prefix):
+        return [key for key in self.app.fragment_cache.cache.entries if key.startswith(prefix)]
+
+    def test_post_rows(self):
+        html = self.get('/explore').get_data(as_text=True)
+        self.assertEqual(len(self.fragments('post:')), 1)
+        self.assertEqual(self.get('/explore').get_data(as_text=True), html)
+        self.assertEqual(len(self.fragments('post:')), 1)
+        #another locale is another copy, it has no translate link for a spanish post
+        html = self.get('/explore', headers={'Accept-Language': 'es'}).get_data(as_text=True)
+        self.assertEqual(len(self.fragments('post:')), 2)
+        self.assertNotIn('javascript:translate(', html)
+        #a new follower changes the author's popup, not the rows of their posts
+        self.assertEqual(self.get('/follow/susan').status_code, 302)
+        self.get('/explore')
+        self.assertEqual(len(self.fragments('post:')), 2)
+        #renaming the author shows up straight away
+        susan = User.query.filter_by(username='susan').one()
+        susan.username = 'susan2'
+        db.session.commit()
+        html = self.get('/explore').get_data(as_text=True)
+        self.assertIn('susan2', html)
+        self.assertEqual(len(self.fragments('post:')), 3)
+
+    def test_popup(self):
+        response = self.get('/user/susan/popup')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+        self.assertIn('Follow', response.get_data(as_text=True))
+        with QueryCounter() as counter:
+            response = self.get('/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        #only the one flask-login needs to load the viewer
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(self.get('/follow/susan').status_code, 302)
+        response = self.get('/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Unfollow', response.get_data(as_text=True))
+        self.assertIn('1 followers', response.get_data(as_text=True))
+        self.assertEqual(self.get('/user/nobody/popup').status_code, 404)
+        #a profile edit through the API is seen too
+        user = User.query.filter_by(username='susan').one()
+        token = user.get_token()
+        db.session.commit()
+        self.client.put('/api/users/{}'.format(user.id), json={'about_me': 'new bio'},
+                        headers={'Authorization': 'Bearer ' + token})
+        self.assertIn('new bio', self.get('/user/susan/popup').get_data(as_text=True))
+
+
+
+class ApiCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(30)]
+        db.session.add_all(self.users)
+        self.token = self.users[0].get_token()
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **headers):
+        db.session.remove()
+        headers['Authorization'] = 'Bearer ' + self.token
+        return self.client.get(url, headers=headers)
+
+    def test_user(self):
+        url = '/api/users/{}'.format(self.ids[1])
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        tag = response.headers['ETag']
+        modified = response.headers['Last-Modified']
+        with QueryCounter() as counter:
+            response = self.get(url, **{'If-None-Match': tag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        #the token (cached) and the user, no follow state lookup
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(self.get(url, **{'If-Modified-Since': modified}).status_code, 304)
+        #each kind of change gives a new tag: a profile edit, a post (a core UPDATE), following them
+        for change in (lambda user: setattr(user, 'about_me', 'hi'),
+                       lambda user: db.session.add(Post(body='post', author=user)),
+                       lambda user: User.query.get(self.ids[0]).follow(user)):
+            change(User.query.get(self.ids[1]))
+            db.session.commit()
+            response = self.get(url, **{'If-None-Match': tag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], tag)
+            tag = response.headers['ETag']
+        self.assertTrue(response.get_json()['is_following'])
+
+    def test_collections(self):
+        response = self.get('/api/users?per_page=5')
+        tag = response.headers['ETag']
+        self.assertEqual(self.get('/api/users?per_page=5', **{'If-None-Match': tag}).status_code, 304)
+        #another page, or the same page with more users after it
+        self.assertEqual(self.get('/api/users?per_page=5&page=2', **{'If-None-Match': tag}).status_code, 200)
+        db.session.add(User(username='new', email='new@example.com'))
+        db.session.commit()
+        self.assertEqual(self.get('/api/users?per_page=5', **{'If-None-Match': tag}).status_code, 200)
+        url = '/api/users/{}/followers'.format(self.ids[1])
+        tag = self.get(url).headers['ETag']
+        self.assertEqual(self.get(url, **{'If-None-Match': tag}).status_code, 304)
+        User.query.get(self.ids[2]).follow(User.query.get(self.ids[1]))
+        db.session.commit()
+        response = self.get(url, **{'If-None-Match': tag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.get_json()['items']], [self.ids[2]])
+
+    def test_bulk_serializer(self):
+        viewer = User.query.get(self.ids[0])
+        for user in self.users[1:10:2]:
+            viewer.follow(user)
+        db.session.commit()
+        with self.app.test_request_context():
+            rows = User.paginate_api(User.query.order_by(User.id), 1, 10, viewer=viewer).items
+            users = User.query.order_by(User.id).limit(10).all()
+            self.assertEqual(User.to_dicts(rows, viewer=viewer), [user.to_dict(viewer=viewer) for user in users])
+        #the token is cached, then the page with the follow states and the total
+        self.get('/api/users?per_page=20')
+        with QueryCounter() as counter:
+            response = self.get('/api/users?per_page=20')
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(response.get_json()['_meta']['total_items'], 30)
+        self.assertEqual([item.get('is_following') for item in response.get_json()['items']][:4],
+                         [None, True, False, True])
+
+    def test_compression(self):
+        plain = self.get('/api/users?per_page=100')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        response = self.get('/api/users?per_page=100', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(response.headers['ETag'], plain.headers['ETag'])
+        #small ones aren't worth it
+        response = self.get('/api/users/{}'.format(self.ids[1]), **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(25)]
+        db.session.add_all(self.users)
+        self.token = self.users[0].get_token()
+        db.session.add_all([Post(body='post {}'.format(i), author=self.users[i % 25]) for i in range(60)])
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def export(self, url):
+        db.session.remove()
+        response = self.client.get(url, headers={'Authorization': 'Bearer ' + self.token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        return [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+
+    def test_resume(self):
+        users = self.export('/api/export/users')
+        self.assertEqual([user['id'] for user in users], self.ids)
+        self.assertEqual(users[3]['post_count'], 3)
+        self.assertNotIn('email', users[3])
+        posts = self.export('/api/export/posts')
+        self.assertEqual(len(posts), 60)
+        #carrying on from the last id seen gets the rest, and only the rest
+        rest = self.export('/api/export/posts?after_id={}'.format(posts[39]['id']))
+        self.assertEqual(posts[40:], rest)
+        self.assertEqual(self.client.get('/api/export/posts').status_code, 401)
+
+    def test_since(self):
+        since = (datetime.utcnow() + timedelta(seconds=1)).isoformat() + 'Z'
+        self.assertEqual(self.export('/api/export/users?since=' + since), [])
+        sleep(1.1)
+        users = [User.query.get(id) for id in self.ids]
+        users[1].follow(users[2])
+        users[1].follow(users[3])
+        users[4].about_me = 'changed'
+        db.session.add(Post(body='new', author=users[5]))
+        #an older post whose language was only just detected is sent again
+        fill_languages([Post.query.filter_by(body='post 0').one().id])
+        db.session.commit()
+        changed = {user['id'] for user in self.export('/api/export/users?since=' + since)}
+        self.assertEqual(changed, set(self.ids[1:6]))
+        posts = self.export('/api/export/posts?since=' + since)
+        self.assertEqual([post['body'] for post in posts], ['post 0', 'new'])
+        self.assertEqual(posts[0]['language'], '')
+        graph = self.export('/api/export/followers?since=' + since)
+        self.assertIn({'id': self.ids[1], 'followed': self.ids[2:4]}, graph)
+        self.assertIn({'id': self.ids[2], 'followed': []}, graph)
+        #the whole graph has every user, following someone or not
+        self.assertEqual(len(self.export('/api/export/followers')), 25)
+        response = self.client.get('/api/export/users?since=yesterday',
+                                   headers={'Authorization': 'Bearer ' + self.token})
+        self.assertEqual(response.status_code, 400)
+
+
+class ReplicaConfig(TestConfig):
+    REPLICA_LAG_TOLERANCE = 5
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        #two files stand in for the primary and its replica, replicate() copies one onto the other
+        path = tempfile.mkdtemp()
+        self.primary = os.path.join(path, 'primary.db')
+        self.replica = os.path.join(path, 'replica.db')
+        ReplicaConfig.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+        ReplicaConfig.SQLALCHEMY_REPLICA_URLS = ['sqlite:///' + self.replica]
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.replicate()
+        self.client = self.app.test_client()
+        users = [User(username=name, email=name + '@example.com') for name in ('john', 'susan')]
+        db.session.add_all(users)
+        self.tokens = [user.get_token() for user in users]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        self.replicate()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def replicate(self):
+        source, target = sqlite3.connect(self.primary), sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def get(self, url, token):
+        db.session.remove()
+        return self.client.get(url, headers={'Authorization': 'Bearer ' + token})
+
+    def test_session(self):
+        db.session.remove()
+        db.session.add(Post(body='not replicated', author=User.query.get(self.ids[0])))
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(Post.query.count(), 0)
+        #after a write the session reads its own writes
+        user = User.query.get(self.ids[0])
+        user.about_me = 'hello'
+        db.session.flush()
+        self.assertEqual(Post.query.count(), 1)
+
+    def test_requests(self):
+        url = '/api/users/{}'.format(self.ids[0])
+        response = self.client.put(url, json={'about_me': 'hello'},
+                                   headers={'Authorization': 'Bearer ' + self.tokens[0]})
+        self.assertEqual(response.status_code, 200)
+        #the client that wrote it sees it, someone else gets the replica until it catches up
+        self.assertEqual(self.get(url, self.tokens[0]).get_json()['about_me'], 'hello')
+        self.assertIsNone(self.get(url, self.tokens[1]).get_json()['about_me'])
+        self.replicate()
+        self.assertEqual(self.get(url, self.tokens[1]).get_json()['about_me'], 'hello')
+
+    def test_new_token(self):
+        db.session.remove()
+        user = User.query.get(self.ids[1])
+        user.revoke_token()
+        token = user.get_token()
+        db.session.commit()
+        #the replica doesn't have it yet
+        self.assertEqual(self.get('/api/users/{}'.format(self.ids[0]), token).status_code, 200)
+
+
+class DatabaseCase(unittest.TestCase):
+    def engine(self, tuning):
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+            DATABASE_TUNING = tuning
+        app = create_app(FileConfig)
+        return db.get_engine(app)
+
+    def pragma(self, engine, name):
+        with engine.connect() as connection:
+            return connection.execute('PRAGMA ' + name).scalar()
+
+    def test_tuned(self):
+        engine = self.engine(True)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(engine, 'synchronous'), 1)
+        self.assertEqual(self.pragma(engine, 'busy_timeout'), 5000)
+        self.assertEqual(self.pragma(engine, 'cache_size'), -64000)
+        self.assertEqual(engine.pool.size(), 5)
+
+    def test_defaults(self):
+        engine = self.engine(False)
+        self.assertEqual(self.pragma(engine, 'journal_mode'), 'delete')
+        self.assertEqual(type(engine.pool).__name__, 'NullPool')
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(PageConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.add_all([Post(body='post {} word'.format(i), author=user) for i in range(5)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def timings(self, response):
+        #{name: (milliseconds, description)} from the Server-Timing header
+        timings = {}
+        for metric in response.headers['Server-Timing'].split(', '):
+            name, duration, *desc = metric.split(';')
+            timings[name] = (float(duration[len('dur='):]), desc[0][len('desc='):].strip('"') if desc else None)
+        return timings
+
+    def test_server_timing(self):
+        db.session.remove()
+        with QueryCounter() as counter:
+            response = self.client.get('/search?q=word')
+        timings = self.timings(response)
+        self.assertEqual(timings['sql'][1], '{} queries'.format(counter.count))
+        self.assertIn('search', timings)
+        self.assertIn('render', timings)
+        self.assertNotIn('translate', timings)
+        self.assertLessEqual(timings['render'][0], timings['total'][0])
+
+    def test_slow_requests(self):
+        self.app.instrumentation.threshold = 0.000001
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/explore')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Slow request GET /explore?', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class MetricsConfig(PageConfig):
+            METRICS_DIR = self.directory
+            METRICS_FLUSH_INTERVAL = 3600
+            METRICS_TOKEN = 'scraper'
+        self.app = create_app(MetricsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.add_all([Post(body='post {} word'.format(i), author=user) for i in range(5)])
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def scrape(self):
+        #{sample with its labels: value} from /metrics
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if not line.startswith('#'):
+                sample, value = line.rsplit(' ', 1)
+                samples[sample] = float(value)
+        return samples
+
+    def test_requests(self):
+        #setUp's commit sent the posts to the index
+        indexed = self.scrape()['search_duration_seconds_count']
+        self.client.get('/explore')
+        self.client.get('/explore')
+        self.client.get('/search?q=word')
+        self.client.get('/nowhere')
+        samples = self.scrape()
+        self.assertEqual(samples['http_requests_total{endpoint="main.explore",method="GET",status="200"}'], 2)
+        self.assertEqual(samples['http_requests_total{endpoint="none",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['http_requests_total{endpoint="metrics",method="GET",status="200"}'], 1)
+        self.assertEqual(samples['http_request_duration_seconds_count{endpoint="main.explore"}'], 2)
+        self.assertEqual(samples['http_request_duration_seconds_bucket{endpoint="main.explore",le="+Inf"}'], 2)
+        self.assertGreater(samples['http_request_duration_seconds_sum{endpoint="main.explore"}'], 0)
+        self.assertEqual(samples['search_duration_seconds_count'], indexed + 1)
+        self.assertGreater(samples['db_pool_checkouts_total{bind="default"}'], 0)
+        self.assertEqual(samples['mail_queue_depth'], 0)
+
+    def test_processes(self):
+        #another worker's file, and one of a worker that has gone whose gauges no longer count
+        self.client.get('/explore')
+        self.app.metrics.write()
+        for pid, name in [(os.getppid(), 'live'), (2 ** 22 + 1, 'gone')]:
+            with open(os.path.join(self.directory, '{}-{}.json'.format(pid, name)), 'w') as f:
+                json.dump({'pid': pid,
+                           'counters': [['http_requests_total',
+                                         [['endpoint', 'main.explore'], ['method', 'GET'], ['status', '200']], 3]],
+                           'histograms': [], 'gauges': [['mail_queue_depth', [], 2]]}, f)
+        samples = self.scrape()
+        self.assertEqual(samples['http_requests_total{endpoint="main.explore",method="GET",status="200"}'], 7)
+        self.assertEqual(samples['mail_queue_depth'], 2)
+        #the file of the one that has gone was added to the archive, once
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith('.json'))
+        self.assertEqual(files, sorted([os.path.basename(self.app.metrics.path), '{}-live.json'.format(os.getppid()),
+                                        'archive.json']))
+        samples = self.scrape()
+        self.assertEqual(samples['http_requests_total{endpoint="main.explore",method="GET",status="200"}'], 7)
+        #a file the archive already has, left behind by a crash before it was deleted, isn't added again
+        with open(os.path.join(self.directory, 'archive.json')) as f:
+            self.assertEqual(json.load(f)['folded'], ['{}-gone.json'.format(2 ** 22 + 1)])
+        with open(os.path.join(self.directory, '{}-gone.json'.format(2 ** 22 + 1)), 'w') as f:
+            json.dump({'pid': 2 ** 22 + 1, 'counters': [['http_requests_total', [['endpoint', 'main.explore'],
+                       ['method', 'GET'], ['status', '200']], 3]], 'histograms': [], 'gauges': []}, f)
+        samples = self.scrape()
+        self.assertEqual(samples['http_requests_total{endpoint="main.explore",method="GET",status="200"}'], 7)
+        self.assertNotIn('{}-gone.json'.format(2 ** 22 + 1), os.listdir(self.directory))
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+        #without a token there is nothing at /metrics, the numbers are still collected
+        app = create_app(PageConfig)
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+        self.assertIsNotNone(app.metrics)
+
+    def test_threads(self):
+        #a thread per request, like the development server. Finished threads' numbers are kept, their shards aren't
+        for _ in range(50):
+            thread = Thread(target=self.app.test_client().get, args=('/about',))
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(self.app.metrics.shards), 2)
+        self.assertEqual(self.scrape()['http_requests_total{endpoint="main.about",method="GET",status="200"}'], 50)
+
+    def test_fork(self):
+        #workers forked from a process that already made the app write their own files
+        self.client.get('/about')
+        self.app.metrics.write()
+        pid = os.fork()
+        if not pid:
+            try:
+                self.app.test_client().get('/about')
+                self.app.metrics.write()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith('.json'))
+        self.assertEqual(sorted(int(f.split('-')[0]) for f in files), sorted([os.getpid(), pid]))
+        self.assertEqual(self.scrape()['http_requests_total{endpoint="main.about",method="GET",status="200"}'], 2)
+
+
+class SeedCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        cli.register(self.app)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_seed(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['seed', '--users', '50', '--posts', '400', '--seed', '1',
+                                                         '--chunk-size', '64'])
+        self.assertIsNone(result.exception)
+        self.assertEqual(User.query.count(), 51)
+        self.assertEqual(Post.query.count(), 400)
+        self.assertEqual(User.query.filter_by(username='user2').one().id, 2)
+        self.assertTrue(User.query.get(2).check_password('password'))
+        self.assertFalse(db.session.query(followers).filter(followers.c.follower_id == followers.c.followed_id)
+                         .count())
+        #the counters were worked out as the rows were made, they agree with the tables
+        counts = [(u.post_count, u.follower_count, u.followed_count) for u in User.query.order_by(User.id)]
+        db.session.expire_all()
+        User.repair_counters()
+        self.assertEqual(counts, [(u.post_count, u.follower_count, u.followed_count)
+                                  for u in User.query.order_by(User.id)])
+        self.assertEqual(counts[0], (0, 0, 0))
+        #a power law, the most followed user has many times the average
+        followed = sorted(count[1] for count in counts)
+        self.assertGreater(followed[-1], 3 * sum(followed) / len(followed))
+        languages = {language for language, in db.session.query(Post.language).distinct()}
+        self.assertIn('en', languages)
+        self.assertLessEqual(languages, {'en', 'es', 'pt', 'fr', 'de', 'it'})
+        self.assertLessEqual(db.session.query(db.func.max(Post.timestamp)).scalar(), datetime.utcnow())
+        self.assertGreater(db.session.query(db.func.min(Post.timestamp)).scalar(),
+                           datetime.utcnow() - timedelta(days=366))
+
+
+class StaticFilesCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.test_request_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_avatars(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(10)]
+        db.session.add_all(users)
+        db.session.commit()
+        urls = [user.avatar(70) for user in users]
+        self.assertEqual(urls, [user.avatar(70, user.username) for user in users])
+        #both stock avatars get used
+        self.assertEqual({url.split('70.')[0] for url in urls}, {'/static/python', '/static/flask'})
+        self.assertRegex(urls[0], r'^/static/(python70\.\w{12}\.jpg|flask70\.\w{12}\.png)$')
+        #sizes that don't exist get the next one up, or the biggest there is
+        self.assertIn('128.', users[0].avatar(100))
+        jordan = User(username='Jordan', email='jordan@example.com')
+        self.assertIn('/static/J70.', jordan.avatar(256))
+
+    def test_cache_headers(self):
+        client = self.app.test_client()
+        url = url_for('static', filename='style.css')
+        self.assertRegex(url, r'^/static/style\.\w{12}\.css$')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        response.close()
+        response = client.get('/static/style.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        response.close()
+        self.assertEqual(client.get('/static/style.0123456789ab.css').status_code, 404)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file